@@ -0,0 +1,247 @@
+"""
+CardDAV client downloading the address books changed since the last sync.
+
+Address books are only downloaded if their ctag changed, and only the changed
+vCards are fetched using WebDAV sync (RFC 6578) or by comparing ETags. The
+vCards are stored in the layout vdirsyncer used: one directory per address
+book, one .vcf file per card.
+"""
+import logging
+import os
+import posixpath
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from urllib.parse import unquote, urljoin
+
+DAV = "DAV:"
+CARDDAV = "urn:ietf:params:xml:ns:carddav"
+CALSERVER = "http://calendarserver.org/ns/"
+
+AddressBook = namedtuple("AddressBook", ["href", "name", "ctag", "sync_token"])
+
+PROPFIND_BOOKS = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<d:propfind xmlns:d="DAV:" xmlns:cs="http://calendarserver.org/ns/">'
+    "<d:prop><d:resourcetype/><cs:getctag/><d:sync-token/></d:prop>"
+    "</d:propfind>"
+)
+
+PROPFIND_ETAGS = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<d:propfind xmlns:d="DAV:"><d:prop><d:getetag/></d:prop></d:propfind>'
+)
+
+SYNC_COLLECTION = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<d:sync-collection xmlns:d="DAV:">'
+    "<d:sync-token>{token}</d:sync-token><d:sync-level>1</d:sync-level>"
+    "<d:prop><d:getetag/></d:prop>"
+    "</d:sync-collection>"
+)
+
+MULTIGET = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<c:addressbook-multiget xmlns:d="DAV:" xmlns:c="urn:ietf:params:xml:ns:carddav">'
+    "<d:prop><d:getetag/><c:address-data/></d:prop>"
+    "{hrefs}"
+    "</c:addressbook-multiget>"
+)
+
+
+class SyncTokenError(Exception):
+    """The server does not accept the sync token (anymore)"""
+
+
+class CardDAVClient:
+    """
+    A minimal CardDAV client using a single pooled HTTP session.
+    """
+
+    multiget_size = 100
+
+    def __init__(self, url, username, password, session=None, timeout=60):
+        self.url = url if url.endswith("/") else url + "/"
+        if session is None:
+            import requests  # pylint: disable=import-outside-toplevel
+
+            session = requests.Session()
+        self.session = session
+        self.session.auth = (username, password)
+        self.timeout = timeout
+
+    def _request(self, method, url, body, depth=None):
+        """Send a WebDAV request and return the parsed multistatus response"""
+        headers = {"Content-Type": "application/xml; charset=utf-8"}
+        if depth is not None:
+            headers["Depth"] = str(depth)
+        response = self.session.request(
+            method,
+            urljoin(self.url, url),
+            data=body.encode("utf-8"),
+            headers=headers,
+            timeout=self.timeout,
+        )
+        if method == "REPORT" and response.status_code in (400, 403, 409):
+            # invalid or expired sync token (RFC 6578 valid-sync-token)
+            raise SyncTokenError(response.text)
+        response.raise_for_status()
+        return ET.fromstring(response.content)
+
+    def address_books(self):
+        """Find the address books below (or at) the configured URL"""
+        books = []
+        tree = self._request("PROPFIND", self.url, PROPFIND_BOOKS, depth=1)
+        for response in tree.iter("{%s}response" % DAV):
+            href = response.findtext("{%s}href" % DAV)
+            prop = _ok_prop(response)
+            if (
+                prop is None
+                or prop.find("{%s}resourcetype/{%s}addressbook" % (DAV, CARDDAV))
+                is None
+            ):
+                continue
+            books.append(
+                AddressBook(
+                    href=href,
+                    name=unquote(posixpath.basename(href.rstrip("/"))),
+                    ctag=prop.findtext("{%s}getctag" % CALSERVER),
+                    sync_token=prop.findtext("{%s}sync-token" % DAV),
+                )
+            )
+        return books
+
+    def etags(self, book):
+        """Return the ETags of all vCards in an address book"""
+        tree = self._request("PROPFIND", book.href, PROPFIND_ETAGS, depth=1)
+        etags = {}
+        for response in tree.iter("{%s}response" % DAV):
+            href = response.findtext("{%s}href" % DAV)
+            prop = _ok_prop(response)
+            if prop is None or href.rstrip("/") == book.href.rstrip("/"):
+                continue
+            etag = prop.findtext("{%s}getetag" % DAV)
+            if etag is not None:
+                etags[href] = etag
+        return etags
+
+    def changes(self, book, token):
+        """
+        Ask the server for the vCards changed since the sync token
+
+        :return: tuple of changed {href: etag}, deleted hrefs and the new token
+        """
+        tree = self._request(
+            "REPORT", book.href, SYNC_COLLECTION.format(token=_escape(token)), depth=0
+        )
+        changed = {}
+        deleted = []
+        for response in tree.iter("{%s}response" % DAV):
+            href = response.findtext("{%s}href" % DAV)
+            status = response.findtext("{%s}status" % DAV) or ""
+            prop = _ok_prop(response)
+            if " 404 " in status or prop is None:
+                deleted.append(href)
+            else:
+                changed[href] = prop.findtext("{%s}getetag" % DAV)
+        return changed, deleted, tree.findtext("{%s}sync-token" % DAV)
+
+    def multiget(self, book, hrefs):
+        """Yield href, ETag and vCard of the requested vCards"""
+        hrefs = list(hrefs)
+        for start in range(0, len(hrefs), self.multiget_size):
+            body = MULTIGET.format(
+                hrefs="".join(
+                    "<d:href>%s</d:href>" % _escape(href)
+                    for href in hrefs[start : start + self.multiget_size]
+                )
+            )
+            tree = self._request("REPORT", book.href, body, depth=1)
+            for response in tree.iter("{%s}response" % DAV):
+                prop = _ok_prop(response)
+                if prop is None:
+                    continue
+                yield (
+                    response.findtext("{%s}href" % DAV),
+                    prop.findtext("{%s}getetag" % DAV),
+                    prop.findtext("{%s}address-data" % CARDDAV),
+                )
+
+
+def fetch_address_books(client, state, directory, include=None):
+    """
+    Download the changed vCards of all address books into directory
+
+    :param client: CardDAVClient
+    :param state: SyncState remembering ctags, sync tokens and ETags
+    :param directory: base directory, one subdirectory per address book
+    :param include: optional function returning whether to download the
+                    address book of the given name
+    :return: dict of address book name to the number of changed vCards
+    """
+    result = {}
+    for book in client.address_books():
+        if include is not None and not include(book.name):
+            continue
+        book_dir = os.path.join(directory, book.name)
+        os.makedirs(book_dir, exist_ok=True)
+        ctag, token = state.collection(book.name)
+        if book.ctag is not None and book.ctag == ctag:
+            logging.debug("address book %s unchanged", book.name)
+            result[book.name] = 0
+            continue
+
+        known = state.items(book.name)
+        changed = deleted = None
+        if token is not None and book.sync_token is not None:
+            try:
+                changed, deleted, new_token = client.changes(book, token)
+            except SyncTokenError:
+                logging.info("sync token of %s expired, comparing ETags", book.name)
+        if changed is None:
+            etags = client.etags(book)
+            changed = {
+                href: etag for href, etag in etags.items() if known.get(href) != etag
+            }
+            deleted = [href for href in known if href not in etags]
+            new_token = book.sync_token
+
+        for href, etag, vcard in client.multiget(book, changed):
+            with open(_item_path(book_dir, href), "w", encoding="utf-8") as file:
+                file.write(vcard)
+            state.save_item(book.name, href, etag)
+        for href in deleted:
+            path = _item_path(book_dir, href)
+            if os.path.exists(path):
+                os.remove(path)
+            state.delete_item(book.name, href)
+        state.save_collection(book.name, book.ctag, new_token)
+
+        logging.info(
+            "address book %s: %s vCards changed, %s deleted",
+            book.name,
+            len(changed),
+            len(deleted),
+        )
+        result[book.name] = len(changed)
+    return result
+
+
+def _ok_prop(response):
+    """Return the prop element with status 200 of a multistatus response"""
+    for propstat in response.findall("{%s}propstat" % DAV):
+        if " 200 " in (propstat.findtext("{%s}status" % DAV) or ""):
+            return propstat.find("{%s}prop" % DAV)
+    return None
+
+
+def _item_path(book_dir, href):
+    """Return the local file name of a vCard"""
+    name = unquote(posixpath.basename(href)).replace(os.sep, "_")
+    if not name.endswith(".vcf"):
+        name += ".vcf"
+    return os.path.join(book_dir, name)
+
+
+def _escape(text):
+    """Escape text for XML"""
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
@@ -3,19 +3,182 @@
 Hatchbuck parser. Run from command line or import as module.
 """
 import binascii
+import collections
+import contextlib
+import copy
+import functools
+import itertools
 import logging
 import os
 import pprint
 import re
 import sys
-
-import phonenumbers
-import vobject
-from hatchbuck import Hatchbuck
-from pycountry import countries
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from .cli import parse_arguments
+from .duplicates import DuplicateDetector, UnionFind
+from .ingest import card_uid, iter_cards, iter_files
+from .metrics import FAST_BUCKETS, Metrics
+from .mirror import ContactMirror
+from .normalize import normalize_card
 from .notifications import NotificationService
+from .phones import PhoneCache, PhoneIndex, country_code
+from .profiling import Profiler, phase
+from .ratelimit import TokenBucket
+from .state import SyncState
+
+
+# company names left over from broken imports
+UNCLEAN_COMPANY_PATTERN = re.compile(r";$|\|")
+# cards resolved, imported and synced together, bounds the memory of a run
+CHUNK_SIZE = 1000
+
+
+# the Hatchbuck bindings and requests are imported when they are first used,
+# so the command line help and errors don't wait for them
+# pylint: disable=import-outside-toplevel
+
+
+def create_client(args, metrics=None):
+    """Create the Hatchbuck client, shared by all workers"""
+    from .client import Client
+    from .plan import PlanningClient
+    from .transport import Transport
+
+    limiter = TokenBucket(args.rate) if args.rate else None
+    # a connection per thread sending requests, all address books share it
+    transport = Transport(
+        timeout=args.timeout,
+        retries=args.retries,
+        pool_size=max(1, args.workers) * max(1, args.books),
+    )
+    return (PlanningClient if args.plan else Client)(
+        args.hatchbuck,
+        noop=args.noop,
+        limiter=limiter,
+        metrics=metrics,
+        transport=transport,
+    )
+
+
+def create_profiler(args):
+    """Create the Profiler if --profile or --profile-stats is set"""
+    if not args.profile and not args.profile_stats:
+        return None
+    return Profiler(args.profile_top, args.profile_stats)
+
+
+def finish_profile(profiler, args):
+    """Write the report of the slowest cards to --profile"""
+    if args.profile:
+        profiler.write(args.profile)
+
+
+def normalize_entry(card, fast=False):
+    """
+    Normalize a card read by HatchbuckParser.read_cards
+
+    :param fast: use the fast tokenizer, see normalize.normalize_card
+    """
+    file, text, key = card
+    try:
+        return file, normalize_card(text, fast), key
+    except binascii.Error as error:
+        logging.error("error parsing: %s", error)
+        return file, None, key
+
+
+def _pool_map(executor, workers, func, items):
+    """Like map, but calls func in a pool reading only a few items ahead"""
+    with executor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# pylint: disable=too-many-arguments
+def report_duplicates(
+    duplicates, state=None, noop=False, notifications=None, plan=None
+):
+    """
+    Send a notification per cluster of duplicate contacts, posted together
+
+    With a sync state, clusters reported in a previous run (or contained
+    in one) are left out, so a daemon doesn't repeat them every interval.
+    A cluster counts as reported once its notification is posted.
+
+    :param notifications: NotificationService to use, a new one is closed
+                          once the report is posted
+    :param plan: Plan to add the report to instead of sending it
+    """
+    clusters = duplicates.clusters()
+    if state is not None:
+        reported = state.reported_duplicates()
+        clusters = [
+            cluster
+            for cluster in clusters
+            if not any(set(cluster) <= known for known in reported)
+        ]
+    if not clusters:
+        return
+    logging.info("reporting %s clusters of duplicates", len(clusters))
+    if plan is not None:
+        plan.duplicates = [duplicates.describe(cluster) for cluster in clusters]
+        return
+
+    def reported(index):
+        """Remember a cluster once its notification is posted"""
+        state.save_duplicates([clusters[index]])
+
+    send_report(
+        [duplicates.describe(cluster) for cluster in clusters],
+        notifications,
+        reported if state is not None and not noop else None,
+    )
+
+
+def send_report(lines, notifications=None, on_sent=None):
+    """
+    Send each line as a notification, posted together in as few digests
+    as RocketChat accepts
+
+    :param on_sent: called with the index of a line once it is posted
+    """
+    service = notifications or NotificationService()
+    for index, line in enumerate(lines):
+        service.send_message(
+            line, functools.partial(on_sent, index) if on_sent is not None else None
+        )
+    if notifications is None:
+        service.close()
+
+
+def finish_plan(duplicates, state, args, hatchbuck):
+    """Add the duplicates to the plan of a --plan run and write it"""
+    report_duplicates(duplicates, state, plan=hatchbuck.plan)
+    hatchbuck.plan.write(args.plan)
+
+
+class ContactTable:  # pylint: disable=too-few-public-methods
+    """
+    Email to Hatchbuck contact lookup table, per-email and per-contact locks
+
+    Shared by the parsers of address books synced in parallel, so a contact
+    created for one address book is found by all others.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contacts = {}
+        self.email_locks = {}
+        self.contact_locks = {}
+        # contactId and tag of the tags added in this run
+        self.tagged = set()
 
 
 class HatchbuckParser:
@@ -23,400 +186,713 @@ class HatchbuckParser:
     An object that does all the parsing for/with Hatchbuck.
     """
 
-    def __init__(self, args):
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        args,
+        hatchbuck=None,
+        state=None,
+        stop=None,
+        table=None,
+        tag=None,
+        user=None,
+        files=None,
+        dirs=None,
+        metrics=None,
+        phones=None,
+        mirror=None,
+        duplicates=None,
+        profiler=None,
+    ):
+        """
+        :param args: parsed command line arguments
+        :param hatchbuck: Hatchbuck client to share between runs
+        :param state: SyncState to share between runs
+        :param stop: threading.Event to stop syncing cards when set
+        :param table: ContactTable to share between parsers
+        :param tag, user, files, dirs: address book settings overriding args
+        :param metrics: Metrics to record to, cumulative between parsers
+        :param phones: PhoneCache to share between parsers
+        :param mirror: ContactMirror to share between parsers
+        :param duplicates: DuplicateDetector to share between parsers, the
+                           owner reports the duplicates found
+        :param profiler: Profiler to share between parsers, the owner writes
+                         the report of the slowest cards
+        """
         self.args = args
         self.stats = {}
-        self.hatchbuck = None
+        self.hatchbuck = hatchbuck
+        self.state = state
+        self.stop = stop
+        self.table = table or ContactTable()
+        self.tag = tag if tag is not None else args.tag
+        self.user = user if user is not None else args.user
+        self.vcf_files = files if files is not None else args.file
+        self.dirs = dirs if dirs is not None else args.dir
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.phones = phones if phones is not None else PhoneCache(store=state)
+        self.mirror = mirror
+        self.duplicates = duplicates or DuplicateDetector()
+        self.owns_duplicates = duplicates is None
+        self.profiler = profiler
+        self.owns_profiler = profiler is None
+        self.lock = threading.Lock()
+        self.failed_files = set()
 
     def main(self):
         """Parsing gets kicked off here"""
         logging.debug("starting with arguments: %s", self.args)
-        self.init_hatchbuck()
-        self.parse_files()
+        if self.hatchbuck is None:
+            self.init_hatchbuck()
+        if self.args.apply:
+            self.apply()
+            return
+        if self.owns_duplicates:
+            self.duplicates = DuplicateDetector()
+        if self.owns_profiler:
+            self.profiler = create_profiler(self.args)
+        owned_state = self.state is None
+        if owned_state:
+            self.init_state()
+            if self.phones.store is None:
+                # remember formatted phone numbers between runs
+                self.phones.store = self.state
+        self.init_mirror()
+        try:
+            if self.owns_profiler and self.profiler is not None:
+                with self.profiler.run():
+                    self.parse_files()
+                finish_profile(self.profiler, self.args)
+            else:
+                self.parse_files()
+            if self.owns_duplicates and self.args.plan:
+                finish_plan(self.duplicates, self.state, self.args, self.hatchbuck)
+            elif self.owns_duplicates:
+                report_duplicates(self.duplicates, self.state, self.args.noop)
+        finally:
+            if owned_state and self.state is not None:
+                self.phones.store = None
+                self.mirror = None
+                self.state.close()
+                self.state = None
+
+    def apply(self):
+        """Send the changes of a plan written with --plan to Hatchbuck"""
+        from .plan import Plan, apply_plan
+
+        plan = Plan.load(self.args.apply)
+        logging.info(
+            "applying %s: %s creates, %s updates",
+            self.args.apply,
+            len(plan.creates),
+            len(plan.updates),
+        )
+        owned_state = self.state is None
+        if owned_state:
+            # checkpoints the changes sent, see apply_plan
+            self.init_state()
+        try:
+            self.stats = apply_plan(self.hatchbuck, plan, self.args.workers, self.state)
+        finally:
+            if owned_state and self.state is not None:
+                self.state.close()
+                self.state = None
+        if plan.duplicates:
+            send_report(plan.duplicates)
 
     def show_summary(self):
         """Show some statistics"""
         logging.info(self.stats)
 
+    def count(self, key):
+        """Increase a statistics counter, safe to call from any worker"""
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def count_card(self, result):
+        """Count the result of a card in the statistics and the metrics"""
+        self.count(result)
+        self.metrics.inc("carddav2hatchbuck_cards_total", result=result)
+
+    def lock_emails(self, emails):
+        """Process only one card at a time per email address"""
+        return self.lock_keys(
+            self.table.email_locks, (email.lower() for email in emails)
+        )
+
+    def lock_contacts(self, contact_ids):
+        """Update a Hatchbuck contact from only one card at a time"""
+        return self.lock_keys(self.table.contact_locks, contact_ids)
+
+    @contextlib.contextmanager
+    def lock_keys(self, table_locks, keys):
+        """Hold the locks of the keys, taken in sorted order to not deadlock"""
+        with self.table.lock:
+            locks = [
+                table_locks.setdefault(key, threading.Lock())
+                for key in sorted(set(keys))
+            ]
+        with contextlib.ExitStack() as stack:
+            for lock in locks:
+                stack.enter_context(lock)
+            yield
+
     def init_hatchbuck(self):
         """Initialize hatchbuck API incl. authentication"""
         if not self.args.hatchbuck:
             logging.error("No hatchbuck_key found.")
             sys.exit(1)
 
-        self.hatchbuck = Hatchbuck(self.args.hatchbuck, noop=self.args.noop)
+        self.hatchbuck = create_client(self.args, self.metrics)
+
+    def init_state(self):
+        """Open the sync state store to skip cards unchanged since the last run"""
+        if self.args.state:
+            logging.debug("using sync state %s", self.args.state)
+            self.state = SyncState(self.args.state)
+
+    def init_mirror(self):
+        """Match cards against the local contact mirror if enabled"""
+        if self.mirror is None and self.args.mirror and self.state is not None:
+            self.mirror = ContactMirror(
+                self.hatchbuck, self.state, self.args.mirror_ttl
+            )
 
     def parse_files(self):
         """Start parsing files"""
-        if self.args.file:
-            for file in self.args.file:
-                logging.debug("parsing file %s", file)
-                self.parse_file(file)
-        elif self.args.dir:
-            for direc in self.args.dir:
-                logging.debug("using directory %s", direc)
-                for file in os.listdir(direc):
-                    if file.endswith(".vcf"):
-                        file_path = os.path.join(direc, file)
-                        logging.info("parsing file %s", file_path)
-                        try:
-                            self.parse_file(file_path)
-                        except binascii.Error as error:
-                            logging.error("error parsing: %s", error)
-        else:
+        self.stats = {}
+        self.failed_files = set()
+        if not self.vcf_files and not self.dirs:
             logging.info("Nothing to do.")
+            return
+
+        # every changed card is parsed once, streamed in chunks through all
+        # passes so only CHUNK_SIZE records are held at a time
+        entries = self.normalize(self.read_cards())
+        while True:
+            chunk = list(itertools.islice(entries, CHUNK_SIZE))
+            if not chunk:
+                break
+            self.resolve_emails(chunk)
+            if self.args.initial_import:
+                self.import_contacts(chunk)
+            for _ in self.map(self.sync_entry, chunk):
+                pass
+
+    def files(self):
+        """Iterate over the files to parse"""
+        if self.vcf_files:
+            return iter(self.vcf_files)
+        return iter_files(self.dirs)
+
+    def map(self, func, items):
+        """
+        Call func for all items and yield the results in order
 
-    # pylint: disable=too-many-branches
-    # pylint: disable=too-many-locals
-    # pylint: disable=too-many-statements
-    def parse_file(self, file):
+        With more than one worker the items are processed by a thread pool,
+        only a few items per worker are read ahead.
         """
-        Parse a single address book file
+        if self.args.workers <= 1:
+            return map(func, items)
+        return _pool_map(ThreadPoolExecutor, self.args.workers, func, items)
+
+    def normalize(self, cards):
         """
-        prin = pprint.PrettyPrinter()
-        self.stats = {}
+        Parse and normalize the cards read by read_cards
+
+        This stage is CPU bound and runs in worker processes if configured.
+        """
+        normalize = functools.partial(normalize_entry, fast=self.args.fast_vcard)
+        if self.args.processes <= 1:
+            return map(normalize, cards)
+        return _pool_map(ProcessPoolExecutor, self.args.processes, normalize, cards)
+
+    def resolve_emails(self, entries):
+        """
+        Look up all email addresses of a chunk of cards in one pass
 
-        for vob in vobject.readComponents(open(file)):
-            content = vob.contents
-            if self.args.verbose:
-                logging.debug("parsing %s:", file)
-                prin.pprint(content)
+        Every distinct address is searched in Hatchbuck only once per run,
+        parse_card reads the results from the lookup table.
 
-            if "n" not in content:
-                self.stats["noname"] = self.stats.get("noname", 0) + 1
+        :param entries: a chunk of the cards to sync, normalized by normalize
+        """
+        emails = {}
+        for _, record, _ in entries:
+            if record is None or record.skip:
+                continue
+            for email in record.emails:
+                emails.setdefault(email["address"].lower(), email["address"])
+
+        with self.table.lock:
+            missing = [
+                email for key, email in emails.items() if key not in self.table.contacts
+            ]
+        logging.info("resolving %s email addresses", len(missing))
+        for email, profile in zip(missing, self.map(self.lookup_email, missing)):
+            with self.table.lock:
+                # keep contacts created by a parallel parser meanwhile
+                self.table.contacts.setdefault(email.lower(), profile)
+
+    def import_contacts(self, entries):
+        """
+        Create the contacts of a chunk of cards not found in Hatchbuck up front
+
+        Cards sharing an email address become a single contact, cards of
+        later chunks find it in the lookup table. Up to
+        args.workers contacts are created in parallel, the regular sync
+        afterwards adds the remaining fields. With a sync state every
+        contact is checkpointed, an interrupted import doesn't create the
+        contacts again.
+
+        :param entries: a chunk of the cards to sync, normalized by normalize
+        """
+        contacts = self.import_payloads(entries)
+        logging.info("importing %s new contacts", len(contacts))
+        for _ in self.map(self.import_contact, contacts):
+            pass
+        stopped = self.stop is not None and self.stop.is_set()
+        if self.state is not None and not stopped and not self.args.noop:
+            self.state.clear_imports()
+
+    def import_payloads(self, entries):
+        """Return the profiles to create for the cards, merged by email address"""
+        sets = UnionFind()
+        records = []
+        for _, record, _ in entries:
+            if record is None or record.skip or not record.emails:
+                continue
+            keys = [email["address"].lower() for email in record.emails]
+            with self.table.lock:
+                if any(self.table.contacts.get(key) for key in keys):
+                    # exists, synced as usual
+                    continue
+            for key in keys:
+                sets.union(keys[0], key)
+            records.append(record)
+
+        contacts = collections.OrderedDict()
+        for record in records:
+            root = sets.find(record.emails[0]["address"].lower())
+            if root not in contacts:
+                contacts[root] = self.new_contact(record)
+                continue
+            emails = contacts[root]["emails"]
+            known = set(email["address"].lower() for email in emails)
+            emails.extend(
+                email
+                for email in record.emails
+                if email["address"].lower() not in known
+            )
+        return list(contacts.values())
+
+    def import_contact(self, profile):
+        """Create a contact of the initial import unless it was created before"""
+        if self.stop is not None and self.stop.is_set():
+            return
+        emails = [email["address"].lower() for email in profile["emails"]]
+        checkpoints = self.state is not None and not self.args.noop
+        found, contact_id = (
+            self.state.import_checkpoint(emails) if checkpoints else (False, None)
+        )
+        if found:
+            # created by an interrupted import, maybe the response got lost
+            existing = None
+            if contact_id is not None:
+                existing = self.hatchbuck.search_contact_id(contact_id)
+            for email in emails:
+                if existing is None:
+                    existing = self.hatchbuck.search_email(email)
+            if existing is not None:
+                logging.debug("already imported: %s", existing["contactId"])
+                self.remember(existing)
+                self.state.save_import(emails, existing["contactId"])
                 return
-            if "email" not in content or not re.match(
-                r"^[^@]+@[^@]+\.[^@]+$", content["email"][0].value
+        if checkpoints:
+            self.state.save_import(emails)
+        created = self.hatchbuck.create(profile)
+        logging.info("imported contact: %s", created)
+        if created is None:
+            return
+        self.count("imported")
+        self.remember(created)
+        if checkpoints:
+            self.state.save_import(emails, created["contactId"])
+
+    def new_contact(self, record):
+        """Return the Hatchbuck profile to create for a valid vCard"""
+        profile = dict()
+        profile["firstName"] = record.given
+        profile["lastName"] = record.family
+        if record.title is not None:
+            profile["title"] = record.title
+        if record.company is not None:
+            profile["company"] = record.company
+
+        profile["subscribed"] = True
+        profile["status"] = {"name": "Lead"}
+
+        if self.args.source:
+            profile["source"] = {"id": self.args.source}
+
+        # override hatchbuck sales rep username if set
+        # (default: api key owner)
+        if self.user:
+            profile["salesRep"] = {"username": self.user}
+
+        profile["emails"] = [dict(email) for email in record.emails]
+        return profile
+
+    def search_email(self, email):
+        """Find the Hatchbuck contact of an email address"""
+        with self.table.lock:
+            if email.lower() in self.table.contacts:
+                return copy.deepcopy(self.table.contacts[email.lower()])
+        profile = self.lookup_email(email)
+        with self.table.lock:
+            profile = self.table.contacts.setdefault(email.lower(), profile)
+        return copy.deepcopy(profile)
+
+    def lookup_email(self, email):
+        """Search an email address in the mirror if enabled, else in Hatchbuck"""
+        if self.mirror is not None:
+            return self.mirror.search_email(email)
+        return self.hatchbuck.search_email(email)
+
+    def remember(self, profile, mirror=True):
+        """
+        Update the lookup table with a created or updated contact
+
+        :param mirror: False if the profile may differ from Hatchbuck's
+        """
+        with self.table.lock:
+            for email in profile.get("emails", []):
+                self.table.contacts[email["address"].lower()] = copy.deepcopy(profile)
+        if self.mirror is not None and mirror and not self.args.noop:
+            self.mirror.save(profile)
+
+    def read_cards(self):
+        """Yield the cards of all files that changed since the last sync"""
+        for file in self.files():
+            logging.info("parsing file %s", file)
+            yield from self.read_file(file)
+
+    def read_file(self, file):
+        """
+        Read the cards of an address book file that changed since the last sync
+
+        Yields the file name, the vCard text and the key to mark it synced with.
+        """
+        collection = os.path.basename(os.path.dirname(os.path.abspath(file)))
+
+        for index, text in enumerate(iter_cards(file)):
+            if self.state is None:
+                yield file, text, None
+                continue
+
+            uid = card_uid(text) or "%s#%s" % (os.path.basename(file), index)
+            digest = SyncState.card_hash(text, self.tag, self.user, self.args.source)
+            if self.state.unchanged(collection, uid, digest):
+                logging.debug("skipping unchanged card %s in %s", uid, file)
+                self.count_card("unchanged")
+                continue
+            yield file, text, (collection, uid, digest)
+
+    def parse_file(self, file):
+        """
+        Parse a single address book file
+        """
+        for card in self.read_file(file):
+            self.sync_entry(normalize_entry(card, self.args.fast_vcard))
+
+    def sync_entry(self, entry):
+        """Sync a card normalized by normalize and mark it synced"""
+        file, record, key = entry
+        if self.stop is not None and self.stop.is_set():
+            # shutting down, the card is synced in the next run
+            return
+        if record is None:
+            # not parsable, logged by normalize_entry
+            self.metrics.inc("carddav2hatchbuck_errors_total", kind="parse")
+            self.fail_file(file)
+            return
+        self.metrics.inc("carddav2hatchbuck_cards_total", result="parsed")
+        self.metrics.observe(
+            "carddav2hatchbuck_vcard_parse_seconds",
+            record.timings["parse"],
+            FAST_BUCKETS,
+        )
+        for seconds in record.timings["phones"]:
+            self.metrics.observe(
+                "carddav2hatchbuck_phone_normalize_seconds",
+                seconds,
+                FAST_BUCKETS,
+                stage="parse",
+            )
+        if self.profiler is None:
+            contact_ids = self.parse_card(record, file)
+        else:
+            uid = record.uid or (key[1] if key is not None else None)
+            with self.profiler.card(
+                file, uid, record.timings["parse"], record.timings["phones"]
             ):
-                self.stats["noemail"] = self.stats.get("noemail", 0) + 1
-                return
-            self.stats["valid"] = self.stats.get("valid", 0) + 1
+                contact_ids = self.parse_card(record, file)
+        if contact_ids is None:
+            self.fail_file(file)
+        elif key is not None and not self.args.noop:
+            self.state.mark_synced(*key, contact_ids=contact_ids)
+
+    def fail_file(self, file):
+        """Remember a file with a card that could not be synced"""
+        with self.lock:
+            self.failed_files.add(file)
+
+    def parse_card(self, record, file):
+        """
+        Sync a single normalized vCard with Hatchbuck
 
-            # aggregate stats what kind of fields we have available
-            for i in content:
-                # if i in c:
-                self.stats[i] = self.stats.get(i, 0) + 1
+        Returns the list of Hatchbuck contactIds the card resolved to, or None
+        if the card could not be synced.
+        """
+        if self.args.verbose:
+            logging.debug("parsing %s:", file)
+            pprint.PrettyPrinter().pprint(record)
 
-            emails = []
-            for email in content.get("email", []):
-                if re.match(r"^[^@äöü]+@[^@]+\.[^@]+$", email.value):
-                    emails.append(email.value)
+        if record.skip:
+            self.count_card(record.skip)
+            return []
+        self.count("valid")
 
-            profile_list = []
-            for email in emails:
-                profile = self.hatchbuck.search_email(email)
-                if profile:
-                    profile_list.append(profile)
-                else:
-                    continue
+        # aggregate stats what kind of fields we have available
+        for i in record.fields:
+            self.count(i)
 
-            # No contacts found
-            if not profile_list:
-                # create new contact
-                profile = dict()
-                profile["firstName"] = content["n"][0].value.given
-                profile["lastName"] = content["n"][0].value.family
-                if "title" in content:
-                    profile["title"] = content["title"][0].value
-                if "org" in content:
-                    profile["company"] = content["org"][0].value
-
-                profile["subscribed"] = True
-                profile["status"] = {"name": "Lead"}
-
-                if self.args.source:
-                    profile["source"] = {"id": self.args.source}
-
-                # override hatchbuck sales rep username if set
-                # (default: api key owner)
-                if self.args.user:
-                    profile["salesRep"] = {"username": self.args.user}
-
-                profile["emails"] = []
-                for email in content.get("email", []):
-                    if not re.match(r"^[^@äöü]+@[^@]+\.[^@]+$", email.value):
-                        continue
-                    if "WORK" in email.type_paramlist:
-                        kind = "Work"
-                    elif "HOME" in email.type_paramlist:
-                        kind = "Home"
-                    else:
-                        kind = "Other"
-                    profile["emails"].append({"address": email.value, "type": kind})
+        emails = [email["address"] for email in record.emails]
+        with self.lock_emails(emails):
+            return self.sync_card(record, emails, file)
 
-                profile = self.hatchbuck.create(profile)
-                logging.info("added contact: %s", profile)
+    def sync_card(self, record, emails, file):
+        """
+        Create or update the Hatchbuck contacts of a valid vCard
 
-            for profile in profile_list:
-                if profile["firstName"] == "" or "@" in profile["firstName"]:
-                    profile = self.hatchbuck.profile_add(
-                        profile, "firstName", None, content["n"][0].value.given
-                    )
+        Returns the list of Hatchbuck contactIds the card resolved to, or None
+        if the card could not be synced.
+        """
+        profile_list = self.search_emails(emails)
+
+        # No contacts found
+        if not profile_list:
+            # create new contact
+            with phase("update"):
+                profile = self.hatchbuck.create(self.new_contact(record))
+            logging.info("added contact: %s", profile)
+            if profile is None:
+                return None
+            self.count_card("created")
+            self.remember(profile)
+            with phase("notify"):
+                self.duplicates.add([profile], file)
+            return [profile["contactId"]]
+
+        contact_ids = [profile["contactId"] for profile in profile_list]
+        with self.lock_contacts(contact_ids):
+            # cards with other emails of these contacts may have updated them
+            return self.update_contacts(record, self.search_emails(emails), file)
+
+    def has_tag(self, profile):
+        """Return whether a contact has the tag or it was added in this run"""
+        if self.hatchbuck.profile_contains(profile, "tags", "name", self.tag):
+            return True
+        with self.table.lock:
+            return (profile["contactId"], self.tag) in self.table.tagged
+
+    def search_emails(self, emails):
+        """Return the Hatchbuck contacts found for the email addresses"""
+        profile_list = []
+        for email in emails:
+            with phase("lookup"):
+                profile = self.search_email(email)
+            if profile:
+                profile_list.append(profile)
+            else:
+                continue
+        return profile_list
 
-                if profile["lastName"] == "" or "@" in profile["lastName"]:
-                    profile = self.hatchbuck.profile_add(
-                        profile, "lastName", None, content["n"][0].value.family
+    # pylint: disable=too-many-branches
+    # pylint: disable=too-many-locals
+    # pylint: disable=too-many-statements
+    def update_contacts(self, record, profile_list, file):
+        """
+        Update the Hatchbuck contacts found for a valid vCard
+
+        Returns the list of Hatchbuck contactIds the card resolved to, or None
+        if an update was refused.
+        """
+        from .profile import LocalHatchbuck
+
+        local = LocalHatchbuck(self.hatchbuck, phones=self.phones)
+        tagged = False
+        synced = []
+        for profile in profile_list:
+            # collect all changes locally and send them as one update
+            profile = local.checkout(profile)
+            if profile["firstName"] == "" or "@" in profile["firstName"]:
+                profile = local.profile_add(profile, "firstName", None, record.given)
+
+            if profile["lastName"] == "" or "@" in profile["lastName"]:
+                profile = local.profile_add(profile, "lastName", None, record.family)
+
+            if record.title is not None and profile.get("title", "") == "":
+                profile = local.profile_add(profile, "title", None, record.title)
+            if "company" in profile:
+                if record.company is not None and profile.get("company", "") == "":
+                    profile = local.profile_add(
+                        profile, "company", None, record.company
+                    )
+                if profile["company"] == "":
+                    # empty company name ->
+                    # maybe we can guess the company name from the email
+                    # address?
+                    # logging.warning("empty company with emails: %s",
+                    #                  profile['emails'])
+                    pass
+
+                # clean up company name
+                if UNCLEAN_COMPANY_PATTERN.match(profile["company"]):
+                    logging.warning(
+                        "found unclean company name: %s", profile["company"]
                     )
 
-                if "title" in content and profile.get("title", "") == "":
-                    profile = self.hatchbuck.profile_add(
-                        profile, "title", None, content["title"][0].value
+            for address in record.addresses:
+                logging.debug("adding address %s %s", address, profile)
+                profile = local.profile_add_address(profile, address, address["type"])
+
+            phone_index = PhoneIndex(tel["number"] for tel in profile.get("phones", []))
+            for telefon in record.phones:
+                number = telefon["number"]
+                kind = telefon["type"]
+
+                if telefon["formatted"] is None:
+                    # number could not be parsed, e.g. because it is a
+                    # local number without country code
+                    logging.warning(
+                        "could not parse number %s as %s in %s, "
+                        "trying to guess country from address",
+                        telefon["value"],
+                        number,
+                        self.hatchbuck.short_contact(profile),
                     )
-                if "company" in profile:
-                    if "org" in content and profile.get("company", "") == "":
-                        profile = self.hatchbuck.profile_add(
-                            profile, "company", None, content["org"][0].value
-                        )
-                    if profile["company"] == "":
-                        # empty company name ->
-                        # maybe we can guess the company name from the email
-                        # address?
-                        # logging.warning("empty company with emails: %s",
-                        #                  profile['emails'])
-                        pass
-
-                    # clean up company name
-                    if re.match(r";$", profile["company"]):
+                    pformatted = number
+
+                    # try to guess the country from the addresses
+                    countries_found = []
+                    for addr in profile.get("addresses", []):
+                        if (
+                            addr.get("country", False)
+                            and addr["country"] not in countries_found
+                        ):
+                            countries_found.append(addr["country"])
+                    logging.debug("countries found %s", countries_found)
+
+                    countrycode = None
+                    if len(countries_found) == 1:
+                        countrycode = country_code(countries_found[0])
+                        logging.debug("countrycode %s", countrycode)
+                    if countrycode is not None:
+                        # lets try to parse the number with the country
+                        with phase("phones"):
+                            guess = self.phones.format(number, countrycode)
+                        if guess is not None:
+                            logging.debug("guess %s", guess)
+                            profile = local.profile_add(
+                                profile,
+                                "phones",
+                                "number",
+                                guess,
+                                {"type": kind},
+                            )
+                            phone_index.add(guess)
+                            # if we got here we now have a full number
+                            continue
                         logging.warning(
-                            "found unclean company name: %s", profile["company"]
+                            "could not parse number %s as %s using country %s in %s",
+                            telefon["value"],
+                            number,
+                            countrycode,
+                            self.hatchbuck.short_contact(profile),
                         )
 
-                    if re.match(r"\|", profile["company"]):
-                        logging.warning(
-                            "found unclean company name: %s", profile["company"]
-                        )
+                    # check that there is not an international/longer
+                    # number there already
+                    # e.g. +41 76 4000 464 compared to 0764000464
 
-                for addr in content.get("adr", []):
-                    address = {
-                        "street": addr.value.street,
-                        "zip_code": addr.value.code,
-                        "city": addr.value.city,
-                        "country": addr.value.country,
-                    }
-                    try:
-                        if "WORK" in addr.type_paramlist:
-                            kind = "Work"
-                        elif "HOME" in addr.type_paramlist:
-                            kind = "Home"
-                        else:
-                            kind = "Other"
-                    except AttributeError:
-                        # if there is no type at all
-                        kind = "Other"
-                    logging.debug("adding address %s %s", address, profile)
-                    profile = self.hatchbuck.profile_add_address(profile, address, kind)
-
-                for telefon in content.get("tel", []):
-                    # number cleanup
-                    number = telefon.value
-                    for rep in "()-\xa0":
-                        # clean up number
-                        number = number.replace(rep, "")
-                    number = number.replace("+00", "+").replace("+0", "+")
-
-                    try:
-                        if "WORK" in telefon.type_paramlist:
-                            kind = "Work"
-                        elif "HOME" in telefon.type_paramlist:
-                            kind = "Home"
-                        else:
-                            kind = "Other"
-                    except AttributeError:
-                        # if there is no type at all
-                        kind = "Other"
-
-                    redundant = False
-
-                    try:
-                        phonenumber = phonenumbers.parse(number, None)
-                        pformatted = phonenumbers.format_number(
-                            phonenumber, phonenumbers.PhoneNumberFormat.INTERNATIONAL
-                        )
-                    except phonenumbers.phonenumberutil.NumberParseException:
-                        # number could not be parsed, e.g. because it is a
-                        # local number without country code
+                    # skip the 0 in front
+                    num = number.replace(" ", "")[1:]
+                    if phone_index.has_suffix(num):
                         logging.warning(
-                            "could not parse number %s as %s in %s, "
-                            "trying to guess country from address",
-                            telefon.value,
-                            number,
+                            "not adding number %s from %s because it "
+                            "is a suffix of an existing number",
+                            num,
                             self.hatchbuck.short_contact(profile),
                         )
-                        pformatted = number
-
-                        # try to guess the country from the addresses
-                        countries_found = []
-                        for addr in profile.get("addresses", []):
-                            if (
-                                addr.get("country", False)
-                                and addr["country"] not in countries_found
-                            ):
-                                countries_found.append(addr["country"])
-                        logging.debug("countries found %s", countries_found)
-
-                        if len(countries_found) == 1:
-                            # lets try to parse the number with the country
-                            countrycode = countries.lookup(countries_found[0]).alpha_2
-                            logging.debug("countrycode %s", countrycode)
-                            try:
-                                phonenumber = phonenumbers.parse(number, countrycode)
-                                pformatted = phonenumbers.format_number(
-                                    phonenumber,
-                                    phonenumbers.PhoneNumberFormat.INTERNATIONAL,
-                                )
-                                logging.debug("guess %s", pformatted)
-                                profile = self.hatchbuck.profile_add(
-                                    profile,
-                                    "phones",
-                                    "number",
-                                    pformatted,
-                                    {"type": kind},
-                                )
-                                # if we got here we now have a full number
-                                continue
-                            except phonenumbers.phonenumberutil.NumberParseException:
-                                logging.warning(
-                                    "could not parse number %s as %s using country %s in %s",
-                                    telefon.value,
-                                    number,
-                                    countrycode,
-                                    self.hatchbuck.short_contact(profile),
-                                )
-                                pformatted = number
-
-                        # check that there is not an international/longer
-                        # number there already
-                        # e.g. +41 76 4000 464 compared to 0764000464
-
-                        # skip the 0 in front
-                        num = number.replace(" ", "")[1:]
-                        for tel2 in profile["phones"]:
-                            # check for suffix match
-                            if tel2["number"].replace(" ", "").endswith(num):
-                                logging.warning(
-                                    "not adding number %s from %s because it "
-                                    "is a suffix of existing %s",
-                                    num,
-                                    self.hatchbuck.short_contact(profile),
-                                    tel2["number"],
-                                )
-                                redundant = True
-                                break
-
-                        if not redundant:
-                            profile = self.hatchbuck.profile_add(
-                                profile, "phones", "number", pformatted, {"type": kind}
-                            )
-                # clean & deduplicate all phone numbers
-                profile = self.hatchbuck.clean_all_phone_numbers(profile)
-
-                for skype in content.get("x-skype", []):
-                    profile = self.hatchbuck.profile_add(
-                        profile,
-                        "instantMessaging",
-                        "address",
-                        skype.value,
-                        {"type": "Skype"},
-                    )
+                    else:
+                        profile = local.profile_add(
+                            profile, "phones", "number", pformatted, {"type": kind}
+                        )
+                        phone_index.add(pformatted)
+            # clean & deduplicate all phone numbers
+            with phase("phones"), self.metrics.time(
+                "carddav2hatchbuck_phone_normalize_seconds",
+                FAST_BUCKETS,
+                stage="clean",
+            ):
+                profile = local.clean_all_phone_numbers(profile)
+
+            for messenger in record.instant_messaging:
+                profile = local.profile_add(
+                    profile,
+                    "instantMessaging",
+                    "address",
+                    messenger["address"],
+                    {"type": messenger["type"]},
+                )
 
-                for msn in content.get("x-msn", []):
-                    profile = self.hatchbuck.profile_add(
-                        profile,
-                        "instantMessaging",
-                        "address",
-                        msn.value,
-                        {"type": "Messenger"},
-                    )
+            for network in record.social_networks:
+                profile = local.profile_add(
+                    profile,
+                    "socialNetworks",
+                    "address",
+                    network["address"],
+                    {"type": network["type"]},
+                )
 
-                for msn in content.get("x-msnim", []):
-                    profile = self.hatchbuck.profile_add(
-                        profile,
-                        "instantMessaging",
-                        "address",
-                        msn.value,
-                        {"type": "Messenger"},
-                    )
+            for website in record.websites:
+                profile = local.profile_add(profile, "website", "websiteUrl", website)
 
-                for twitter in content.get("x-twitter", []):
-                    if "twitter.com" in twitter.value:
-                        value = twitter.value
-                    else:
-                        value = "http://twitter.com/" + twitter.value.replace("@", "")
-                    profile = self.hatchbuck.profile_add(
-                        profile, "socialNetworks", "address", value, {"type": "Twitter"}
-                    )
+            for date in record.birthdays:
+                profile = local.profile_add_birthday(profile, dict(date))
 
-                for url in content.get("url", []) + content.get("x-socialprofile", []):
-                    value = url.value
-                    if not value.startswith("http"):
-                        value = "http://" + value
-                    if "facebook.com" in value:
-                        profile = self.hatchbuck.profile_add(
-                            profile,
-                            "socialNetworks",
-                            "address",
-                            value,
-                            {"type": "Facebook"},
-                        )
-                    elif "twitter.com" in value:
-                        profile = self.hatchbuck.profile_add(
-                            profile,
-                            "socialNetworks",
-                            "address",
-                            value,
-                            {"type": "Twitter"},
-                        )
-                    else:
-                        profile = self.hatchbuck.profile_add(
-                            profile, "website", "websiteUrl", value
-                        )
+            with phase("update"):
+                profile = local.commit(profile)
 
-                for bday in content.get("bday", []):
-                    date = {
-                        "year": bday.value[0:4],
-                        "month": bday.value[5:7],
-                        "day": bday.value[8:10],
-                    }
-                    profile = self.hatchbuck.profile_add_birthday(profile, date)
-
-                if self.args.tag:
-                    if not self.hatchbuck.profile_contains(
-                        profile, "tags", "name", self.args.tag
-                    ):
-                        self.hatchbuck.add_tag(profile["contactId"], self.args.tag)
-
-            # get the list of unique contacts IDs to detect if there are
-            # multiple contacts in hatchbuck for this one contact in CardDAV
-            profile_contactids = []
-            message = ""
-            for profile in profile_list:
-                if profile["contactId"] not in profile_contactids:
-                    profile_contactids.append(profile["contactId"])
-
-                    email_profile = " "
-                    for email_add in profile.get("emails", []):
-                        email_profile = email_add["address"] + " "
-
-                    number_profile = " "
-                    for phone_number in profile.get("phones", []):
-                        number_profile = phone_number["number"] + " "
-
-                    message += (
-                        "{0} {1} ({2}, {3}, {4})".format(
-                            profile["firstName"],
-                            profile["lastName"],
-                            email_profile,
-                            number_profile,
-                            profile["contactUrl"],
-                        )
-                        + ", "
-                    )
+            if self.tag and not self.has_tag(profile):
+                with phase("tag"):
+                    self.hatchbuck.add_tag(profile["contactId"], self.tag)
+                tagged = True
+                with self.table.lock:
+                    self.table.tagged.add((profile["contactId"], self.tag))
 
-            if len(profile_contactids) > 1:
-                # there are duplicates
-                NotificationService().send_message(
-                    "Duplicates: %s from file: %s" % (message[:-2], file)
-                )
+            self.remember(profile, mirror=not local.failures)
+            synced.append(profile)
+        self.count_card("updated" if local.updates or tagged else "unchanged")
+
+        # multiple contacts in hatchbuck for this one contact in CardDAV are
+        # reported together with all other duplicates at the end of the run
+        with phase("notify"):
+            self.duplicates.add(synced, file)
+        if local.failures:
+            # not marked synced, so the refused update is retried next run
+            return None
+        return list(dict.fromkeys(profile["contactId"] for profile in profile_list))
 
 
 def main():
@@ -425,6 +901,8 @@ def main():
     parser = HatchbuckParser(args)
     parser.main()
     parser.show_summary()
+    if args.metrics_file:
+        parser.metrics.write_json(args.metrics_file)
 
 
 if __name__ == "__main__":
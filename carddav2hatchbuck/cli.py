@@ -18,6 +18,11 @@ def parse_arguments():
     vdirsync_user = os.environ.get("VDIRSYNC_USER")
     vdirsync_pass = os.environ.get("VDIRSYNC_PASS")
     vdirsync_url = os.environ.get("VDIRSYNC_URL")
+    state = os.environ.get("SYNC_STATE")
+    interval = int(os.environ.get("SYNC_INTERVAL", 600))
+    metrics_file = os.environ.get("METRICS_FILE")
+    metrics_port = os.environ.get("METRICS_PORT")
+    worker_id = os.environ.get("SYNC_WORKER_ID")
 
     usage_style = (
         argparse.ArgumentDefaultsHelpFormatter
@@ -88,6 +93,142 @@ def parse_arguments():
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--plan",
+        help="don't post anything to hatchbuck, write the changes to this JSON"
+        " file instead",
+    )
+    parser.add_argument(
+        "--apply",
+        help="post the changes of a plan written by --plan to hatchbuck,"
+        " without reading any vCards",
+    )
+    parser.add_argument(
+        "--state",
+        help="SQLite file remembering synced vCards, unchanged vCards are skipped"
+        " (env: SYNC_STATE)",
+        default=state,
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="number of vCards synced in parallel",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--timeout",
+        help="seconds to wait for a Hatchbuck API response",
+        type=float,
+        default=30,
+    )
+    parser.add_argument(
+        "--retries",
+        help="number of times a failed or throttled Hatchbuck API request is"
+        " retried",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--fast-vcard",
+        help="read the vCards with a tokenizer extracting only the synced"
+        " properties, cards it can't read are parsed by vobject",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--initial-import",
+        help="create all new contacts before syncing the vCards, for the first"
+        " sync of large address books, resumable with --state",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--books",
+        help="number of address books synced in parallel by the sync command",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--processes",
+        help="number of processes parsing vCards in parallel",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--rate",
+        help="maximum number of Hatchbuck API requests per second, shared by"
+        " all workers (default: unlimited)",
+        type=float,
+    )
+    parser.add_argument(
+        "--daemon",
+        help="keep running and sync every --interval seconds until SIGTERM",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--interval",
+        help="seconds between the start of two syncs in daemon mode"
+        " (env: SYNC_INTERVAL)",
+        type=int,
+        default=interval,
+    )
+    parser.add_argument(
+        "--worker-id",
+        help="name of this sync worker, workers sharing the carddav directory"
+        " and sync state split the address books between them"
+        " (env: SYNC_WORKER_ID)",
+        default=worker_id,
+    )
+    parser.add_argument(
+        "--lease-ttl",
+        help="seconds after which the address books of a worker that stopped"
+        " sending heartbeats are taken over (default: 3 intervals)",
+        type=int,
+    )
+    parser.add_argument(
+        "--mirror",
+        help="match cards against a local mirror of the Hatchbuck contacts kept"
+        " in the sync state, needs --state",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--mirror-ttl",
+        help="seconds a mirrored contact is used before it is fetched again",
+        type=int,
+        default=86400,
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="write counters and timings as JSON to this file after a run"
+        " (env: METRICS_FILE)",
+        default=metrics_file,
+    )
+    parser.add_argument(
+        "--metrics-port",
+        help="serve Prometheus metrics on this port in daemon mode"
+        " (env: METRICS_PORT)",
+        type=int,
+        default=int(metrics_port) if metrics_port else None,
+    )
+    parser.add_argument(
+        "--profile",
+        help="write the slowest cards with their API requests and the time per"
+        " phase to this file",
+    )
+    parser.add_argument(
+        "--profile-top",
+        help="number of cards in the --profile report",
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        "--profile-stats",
+        help="profile the sync with cProfile and write the pstats to this"
+        " file, covers the main thread only (use --workers 1 and --books 1)",
+    )
     parser.add_argument(
         "-f",
         "--file",
@@ -97,4 +238,7 @@ def parse_arguments():
     )
     parser.add_argument("dir", help="read all vcf files from directories", nargs="*")
     args = parser.parse_args()
+    if args.plan:
+        # planning never writes, neither to Hatchbuck nor to the sync state
+        args.noop = True
     return args
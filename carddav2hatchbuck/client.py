@@ -0,0 +1,172 @@
+"""
+Hatchbuck API client used by the sync
+"""
+import contextlib
+import logging
+
+from hatchbuck import Hatchbuck
+
+from .profiling import count_request
+from .transport import Transport
+
+
+class Client(Hatchbuck):
+    """
+    Hatchbuck API bindings that share a rate limiter between all workers.
+
+    The API requests of the bindings are sent through a Transport, which
+    keeps connections alive, times out and retries failed requests.
+    With metrics the latency of every API request is recorded per endpoint,
+    failed creates and updates are counted as errors.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, key, noop=False, limiter=None, metrics=None, transport=None):
+        super().__init__(key, noop=noop)
+        self.limiter = limiter
+        self.metrics = metrics
+        self.transport = transport if transport is not None else Transport()
+
+    def _throttle(self, search=False):
+        """Wait for the rate limiter before sending an API request"""
+        # searches are sent to the API even in noop mode
+        if self.limiter is not None and (search or not self.noop):
+            self.limiter.acquire()
+
+    @contextlib.contextmanager
+    def _timed(self, endpoint, search=False):
+        """Measure the latency of an API request, count failed requests"""
+        if self.metrics is None or (self.noop and not search):
+            yield
+            return
+        try:
+            with self.metrics.time(
+                "carddav2hatchbuck_api_request_seconds", endpoint=endpoint
+            ):
+                yield
+        except Exception:
+            self.metrics.inc("carddav2hatchbuck_errors_total", kind=endpoint)
+            raise
+
+    def _failed(self, endpoint, result):
+        """Count a create or update Hatchbuck refused"""
+        if result is None and self.metrics is not None and not self.noop:
+            self.metrics.inc("carddav2hatchbuck_errors_total", kind=endpoint)
+        return result
+
+    def _request(self, method, path, body, idempotent=True):
+        """Send an API request through the transport"""
+        count_request()
+        return self.transport.request(
+            method,
+            self.url + path + "?api_key=" + self.key,
+            idempotent=idempotent,
+            json=body,
+        )
+
+    def _search(self, query):
+        """
+        Send a contact search
+
+        :return: the profiles found, empty if none
+        """
+        logging.debug("searching for %s", query)
+        self._throttle(search=True)
+        with self._timed("search", search=True):
+            req = self._request("POST", "contact/search", query)
+        if req.status_code == 200:
+            return req.json() or []
+        if req.status_code == 401:
+            logging.error("Hatchbuck API code wrong or expired?")
+        else:
+            logging.debug("not found")
+        return []
+
+    def search_email(self, email):
+        """Search for a profile by email address, see Hatchbuck.search_email"""
+        result = None
+        for profile in self._search({"emails": [{"address": email}]}):
+            if self.profile_contains(profile, "emails", "address", email):
+                logging.debug("found: %s", profile)
+                result = self._add_countries(profile)
+            else:
+                logging.debug("found profile without matching address: %s", profile)
+        return result
+
+    def search_contact_id(self, contact_id):
+        """
+        Fetch a contact by its contactId
+
+        :return: the profile or None if there is no such contact
+        """
+        found = self._search({"contactId": contact_id})
+        return self._add_countries(found[0]) if found else None
+
+    def search_name(self, first, last):
+        """Search for a profile by name, see Hatchbuck.search_name"""
+        found = self._search({"firstName": first, "lastName": last})
+        return self._add_countries(found[0]) if found else None
+
+    def update(self, contact_id, profile):
+        """Update an existing contact, see Hatchbuck.update"""
+        profile["contactId"] = contact_id
+        logging.debug("updating %s", profile)
+        if self.noop:
+            logging.debug("skipping update")
+            return profile
+        self._throttle()
+        with self._timed("update"):
+            req = self._request("PUT", "contact", profile)
+        return self._failed("update", self._profile(req))
+
+    def create(self, profile):
+        """Create a new contact, see Hatchbuck.create"""
+        logging.debug("creating %s", profile)
+        if self.noop:
+            profile["contactId"] = None
+            return profile
+        self._throttle()
+        with self._timed("create"):
+            # a create that timed out may have been processed, not resent
+            req = self._request("POST", "contact", profile, idempotent=False)
+        return self._failed("create", self._profile(req))
+
+    def add_tag(self, contact_id, tagname):
+        """Add a tag to a contact, see Hatchbuck.add_tag"""
+        logging.debug("adding tag %s to contact %s", tagname, contact_id)
+        self._tags("POST", "add_tag", contact_id, tagname)
+
+    def remove_tag(self, contact_id, tagname):
+        """Remove a tag from a contact, see Hatchbuck.remove_tag"""
+        logging.debug("removing tag %s from contact %s", tagname, contact_id)
+        self._tags("DELETE", "remove_tag", contact_id, tagname)
+
+    def _tags(self, method, endpoint, contact_id, tagname):
+        """Add or remove a tag"""
+        if self.noop:
+            return
+        self._throttle()
+        with self._timed(endpoint):
+            req = self._request(
+                method, "contact/" + contact_id + "/Tags", [{"name": tagname}]
+            )
+        if req.status_code == 201:
+            logging.debug("success: %s", req.text)
+        elif req.status_code == 401:
+            logging.error("Hatchbuck API code wrong or expired?")
+        else:
+            logging.debug("fail: %s", req.text)
+
+    def _profile(self, req):
+        """Return the profile of a create or update response, None if it failed"""
+        if req.status_code == 200:
+            value = req.json()
+            logging.debug("success: %s", value)
+            return self._add_countries(value)
+        if req.status_code == 401:
+            logging.error("Hatchbuck API code wrong or expired?")
+        else:
+            # this happens e.g. when trying to add an email address
+            # that already belongs to another contact
+            logging.debug("fail: %s", req.text)
+        return None
@@ -0,0 +1,133 @@
+"""
+Detection of duplicate Hatchbuck contacts across all synced address books
+"""
+import threading
+
+from .phones import PhoneIndex
+
+# shorter numbers are extensions or service numbers, not worth comparing
+MIN_PHONE_DIGITS = 7
+
+
+def blocking_keys(profile):
+    """
+    Return the keys two contacts must share to be considered duplicates
+
+    An email address belongs to a single person. Phone numbers are shared
+    within companies (switchboards), so they only match together with the
+    last name, names only together with the company.
+    """
+    keys = set()
+    for email in profile.get("emails", []):
+        if email.get("address"):
+            keys.add(("email", email["address"].strip().lower()))
+    last = (profile.get("lastName") or "").strip().lower()
+    if last:
+        for phone in profile.get("phones", []):
+            digits = PhoneIndex.canonical(phone.get("number") or "")
+            if len(digits) >= MIN_PHONE_DIGITS:
+                keys.add(("phone", digits, last))
+    first = (profile.get("firstName") or "").strip().lower()
+    company = profile.get("company") or ""
+    if isinstance(company, list):
+        # ORG as parsed by vobject, not yet stored by Hatchbuck (noop mode)
+        company = ";".join(company)
+    company = company.strip().lower()
+    if first and last and company:
+        keys.add(("name", first, last, company))
+    return keys
+
+
+class UnionFind:
+    """Disjoint sets with path compression and union by size"""
+
+    def __init__(self):
+        self.parents = {}
+        self.sizes = {}
+
+    def find(self, item):
+        """Return the representative of the set of item, adding it if new"""
+        if item not in self.parents:
+            self.parents[item] = item
+            self.sizes[item] = 1
+            return item
+        root = item
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[item] != root:
+            self.parents[item], item = root, self.parents[item]
+        return root
+
+    def union(self, first, second):
+        """Merge the sets of first and second"""
+        first, second = self.find(first), self.find(second)
+        if first == second:
+            return
+        if self.sizes[first] < self.sizes[second]:
+            first, second = second, first
+        self.parents[second] = first
+        self.sizes[first] += self.sizes[second]
+
+    def groups(self):
+        """Return all sets as lists"""
+        groups = {}
+        for item in self.parents:
+            groups.setdefault(self.find(item), []).append(item)
+        return list(groups.values())
+
+
+class DuplicateDetector:
+    """
+    Clusters the Hatchbuck contacts synced in a run into duplicates
+
+    Contacts are added per vCard, safe to call from any worker and shared
+    by the parsers of all address books. Contacts a single vCard resolved
+    to are duplicates, as are contacts sharing a blocking key. Each key is
+    looked up in a dict, so no pairs of contacts are compared.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sets = UnionFind()
+        self.owners = {}
+        self.contacts = {}
+        self.files = {}
+
+    def add(self, profiles, file):
+        """Add the Hatchbuck contacts a vCard from file was synced to"""
+        profiles = [profile for profile in profiles if profile.get("contactId")]
+        with self.lock:
+            for profile in profiles:
+                contact_id = profile["contactId"]
+                self.contacts[contact_id] = profile
+                self.files.setdefault(contact_id, set()).add(file)
+                self.sets.union(profiles[0]["contactId"], contact_id)
+                for key in blocking_keys(profile):
+                    self.sets.union(self.owners.setdefault(key, contact_id), contact_id)
+
+    def clusters(self):
+        """Return the sorted contactIds of all clusters of duplicates"""
+        with self.lock:
+            return sorted(
+                sorted(group) for group in self.sets.groups() if len(group) > 1
+            )
+
+    def describe(self, cluster):
+        """Return a line describing a cluster for the report"""
+        with self.lock:
+            contacts = [self.contacts[contact_id] for contact_id in cluster]
+            files = sorted(set().union(*(self.files[key] for key in cluster)))
+        return "Duplicates: %s from files: %s" % (
+            ", ".join(
+                "%s %s (%s, %s, %s)"
+                % (
+                    profile.get("firstName", ""),
+                    profile.get("lastName", ""),
+                    " ".join(email["address"] for email in profile.get("emails", [])),
+                    " ".join(phone["number"] for phone in profile.get("phones", [])),
+                    profile.get("contactUrl", profile["contactId"]),
+                )
+                for profile in contacts
+            ),
+            ", ".join(files),
+        )
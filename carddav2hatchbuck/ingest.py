@@ -0,0 +1,50 @@
+"""
+Streaming ingestion of vCard files, one card at a time
+"""
+import logging
+import os
+import re
+
+UID_RE = re.compile(r"^UID(?:;[^:\r\n]*)?:(.*?)\r?$", re.MULTILINE | re.IGNORECASE)
+
+
+def iter_files(directories):
+    """Lazily yield the paths of the vcf files in the directories"""
+    for direc in directories:
+        logging.debug("using directory %s", direc)
+        for entry in os.scandir(direc):
+            if entry.name.endswith(".vcf") and entry.is_file():
+                yield entry.path
+
+
+def iter_cards(file):
+    """
+    Yield the text of each vCard in a file
+
+    Only one card is held in memory at a time, so multi-card exports of any
+    size can be read.
+    """
+    with open(file, encoding="utf-8") as handle:
+        lines = []
+        depth = 0
+        for line in handle:
+            keyword = line.strip().upper()
+            if keyword == "BEGIN:VCARD":
+                depth += 1
+            if depth:
+                lines.append(line)
+            if keyword == "END:VCARD" and depth:
+                depth -= 1
+                if not depth:
+                    yield "".join(lines)
+                    lines = []
+        if lines:
+            logging.warning("ignoring incomplete vCard at the end of %s", file)
+
+
+def card_uid(text):
+    """Return the UID of a vCard or None if it has none"""
+    match = UID_RE.search(text)
+    if match is None or not match.group(1).strip():
+        return None
+    return match.group(1).strip()
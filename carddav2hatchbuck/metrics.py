@@ -0,0 +1,208 @@
+"""
+Counters and histograms of the sync, exported as Prometheus text or JSON
+"""
+import bisect
+import contextlib
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# seconds, for API requests and whole sync runs
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# seconds, for CPU bound steps like parsing a single vCard
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+DESCRIPTIONS = {
+    "carddav2hatchbuck_cards_total": "vCards processed, by result",
+    "carddav2hatchbuck_errors_total": "errors, by kind",
+    "carddav2hatchbuck_vcard_parse_seconds": "time to parse and normalize a vCard",
+    "carddav2hatchbuck_phone_normalize_seconds": "time to normalize a phone number",
+    "carddav2hatchbuck_api_request_seconds": "Hatchbuck API latency, by endpoint",
+    "carddav2hatchbuck_sync_run_seconds": "duration of a complete sync run",
+}
+
+
+class Histogram:
+    """Observations counted in cumulative buckets, like Prometheus"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add an observation"""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Return (upper bound, cumulative count) pairs, "+Inf" last"""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """
+    A thread-safe registry of labelled counters and histograms.
+
+    Values are cumulative for the lifetime of the registry, so the daemon
+    reports totals over all runs and address books.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter"""
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        """Add an observation to a histogram"""
+        key = self._key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def time(self, name, buckets=DEFAULT_BUCKETS, **labels):
+        """Observe the duration of the with block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, buckets, **labels)
+
+    def value(self, name, **labels):
+        """Return the value of a counter, 0 if it was never increased"""
+        with self.lock:
+            return self.counters.get(self._key(name, labels), 0)
+
+    def to_prometheus(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+            for name in sorted(set(name for (name, _), _ in counters)):
+                lines.extend(_header(name, "counter"))
+                for (other, labels), value in counters:
+                    if other == name:
+                        lines.append("%s%s %s" % (name, _labels(labels), value))
+            for name in sorted(set(name for (name, _), _ in histograms)):
+                lines.extend(_header(name, "histogram"))
+                for (other, labels), histogram in histograms:
+                    if other != name:
+                        continue
+                    for bound, count in histogram.cumulative():
+                        lines.append(
+                            "%s_bucket%s %s"
+                            % (name, _labels(labels + (("le", bound),)), count)
+                        )
+                    lines.append("%s_sum%s %r" % (name, _labels(labels), histogram.sum))
+                    lines.append(
+                        "%s_count%s %s" % (name, _labels(labels), histogram.count)
+                    )
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        """Return all metrics as JSON serializable dict"""
+        result = {"counters": {}, "histograms": {}}
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                result["counters"].setdefault(name, []).append(
+                    {"labels": dict(labels), "value": value}
+                )
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                result["histograms"].setdefault(name, []).append(
+                    {
+                        "labels": dict(labels),
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "buckets": [
+                            [str(bound), count]
+                            for bound, count in histogram.cumulative()
+                        ],
+                    }
+                )
+        return result
+
+    def write_json(self, path):
+        """Write all metrics to a JSON file"""
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file, indent=2, sort_keys=True)
+        logging.info("metrics written to %s", path)
+
+    def serve(self, port, host=""):
+        """
+        Serve the metrics for Prometheus on http://host:port/metrics
+
+        :return: the HTTP server, running in a daemon thread
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Answers GET /metrics"""
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """Scrapes are not worth a log line"""
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Render the metrics"""
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = _MetricsServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info("serving metrics on port %s", server.server_port)
+        return server
+
+
+class _MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _header(name, kind):
+    """HELP and TYPE lines of a metric"""
+    return [
+        "# HELP %s %s" % (name, DESCRIPTIONS.get(name, name)),
+        "# TYPE %s %s" % (name, kind),
+    ]
+
+
+def _labels(labels):
+    """Render labels as {name="value",...}"""
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"'
+        % (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in labels
+    )
@@ -0,0 +1,68 @@
+"""
+Local mirror of the Hatchbuck contacts the sync has seen
+"""
+import logging
+import time
+
+
+class ContactMirror:
+    """
+    Hatchbuck contacts kept in the sync state, found by email.
+
+    The mirror is filled with every contact found by a search or written by
+    the sync. Email lookups are answered locally while the mirrored contact
+    is younger than ttl seconds, older contacts are refreshed by contactId.
+    Addresses not in the mirror are searched in Hatchbuck, so contacts
+    created in the CRM meanwhile are still found.
+    """
+
+    def __init__(self, client, state, ttl=86400):
+        self.client = client
+        self.state = state
+        self.ttl = ttl
+        self.hits = 0
+        self.refreshed = 0
+
+    def search_email(self, email):
+        """Find the contact of an email address, like Hatchbuck.search_email"""
+        contact_id = self.state.mirrored_email(email)
+        if contact_id is not None:
+            profile = self.contact(contact_id)
+            if profile is not None and _has_email(profile, email):
+                return profile
+        profile = self.client.search_email(email)
+        if profile is not None:
+            self.save(profile)
+        return profile
+
+    def contact(self, contact_id):
+        """Return a mirrored contact, refreshed if it is older than the ttl"""
+        mirrored = self.state.mirrored_contact(contact_id)
+        if mirrored is not None and time.time() - mirrored[1] < self.ttl:
+            self.hits += 1
+            return mirrored[0]
+        profile = self.client.search_contact_id(contact_id)
+        self.refreshed += 1
+        if profile is None:
+            logging.debug("contact %s no longer exists", contact_id)
+            self.state.drop_mirror(contact_id)
+            return None
+        self.save(profile)
+        return profile
+
+    def save(self, profile):
+        """Mirror a contact found or written by the sync"""
+        if not profile or not profile.get("contactId"):
+            # e.g. created in noop mode
+            return
+        self.state.save_mirror(
+            profile,
+            set(email["address"].lower() for email in profile.get("emails", [])),
+        )
+
+
+def _has_email(profile, email):
+    """Return True if the profile has the email address"""
+    return any(
+        item["address"].lower() == email.lower() for item in profile.get("emails", [])
+    )
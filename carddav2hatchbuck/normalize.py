@@ -0,0 +1,227 @@
+"""
+Parsing and normalization of vCards, independent of the Hatchbuck API.
+
+normalize_card turns the text of a vCard into a NormalizedContact holding
+everything the sync needs (plain dicts, lists and strings). It does not talk to
+any API and can run in worker processes.
+"""
+import functools
+import re
+import time
+
+from .phones import format_number
+from .vcard import tokenize_card
+
+# a card is synced if its first email address looks valid
+EMAIL_PATTERN = re.compile(r"^[^@]+@[^@]+\.[^@]+$")
+# addresses with umlauts in the local part are not synced
+SYNCED_EMAIL_PATTERN = re.compile(r"^[^@äöü]+@[^@]+\.[^@]+$")
+PHONE_JUNK = str.maketrans("", "", "()-\xa0")
+
+
+class NormalizedContact:  # pylint: disable=too-few-public-methods
+    """
+    The fields of a vCard synced to Hatchbuck
+
+    skip names the reason if the card can't be synced ("noname" or
+    "noemail"), only fields is set then. emails, phones, addresses etc. are
+    lists of dicts in the format of Hatchbuck profiles.
+    """
+
+    __slots__ = (
+        "fields",
+        "skip",
+        "uid",
+        "given",
+        "family",
+        "title",
+        "company",
+        "emails",
+        "addresses",
+        "phones",
+        "instant_messaging",
+        "social_networks",
+        "websites",
+        "birthdays",
+        "timings",
+    )
+
+    def __init__(self, fields, skip=None, **values):
+        self.fields = fields
+        self.skip = skip
+        for name in self.__slots__[2:]:
+            setattr(self, name, values.get(name))
+
+    def __repr__(self):
+        return "NormalizedContact(%s)" % ", ".join(
+            "%s=%r" % (name, getattr(self, name)) for name in self.__slots__
+        )
+
+
+def normalize_card(text, fast=False):
+    """
+    Parse a vCard and extract the fields synced to Hatchbuck
+
+    :param text: a single vCard
+    :param fast: read the card with vcard.tokenize_card, falling back to
+                 vobject for cards it doesn't handle
+    :return: the NormalizedContact, its timings hold the time spent parsing
+             the card and normalizing each phone number
+    """
+    started = time.perf_counter()
+    phones = []
+    content = tokenize_card(text) if fast else None
+    if content is not None:
+        record = normalize_contents(content, phones)
+    else:
+        import vobject  # pylint: disable=import-outside-toplevel
+
+        record = normalize_vcard(vobject.readOne(text), phones)
+    record.timings = {"parse": time.perf_counter() - started, "phones": phones}
+    return record
+
+
+def normalize_vcard(vob, timings=None):
+    """
+    Extract the fields synced to Hatchbuck from a vobject vCard
+
+    :param timings: list to append the time to normalize each phone number to
+    :return: the NormalizedContact
+    """
+    return normalize_contents(vob.contents, timings)
+
+
+def normalize_contents(content, timings=None):
+    """
+    Extract the fields synced to Hatchbuck from the properties of a vCard
+
+    The properties are grouped by name, every group is visited once.
+
+    :param content: dict of lower case property names to lists of
+                    properties, vobject's contents or vcard.tokenize_card
+    :param timings: list to append the time to normalize each phone number to
+    :return: the NormalizedContact
+    """
+    fields = list(content)
+
+    if "n" not in content:
+        return NormalizedContact(fields, "noname")
+    emails = content.get("email")
+    if not emails or not EMAIL_PATTERN.match(emails[0].value):
+        return NormalizedContact(fields, "noemail")
+
+    name = content["n"][0].value
+    social_networks = []
+    websites = []
+    for twitter in content.get("x-twitter", []):
+        if "twitter.com" in twitter.value:
+            value = twitter.value
+        else:
+            value = "http://twitter.com/" + twitter.value.replace("@", "")
+        social_networks.append({"address": value, "type": "Twitter"})
+
+    for url in content.get("url", []) + content.get("x-socialprofile", []):
+        value = url.value
+        if not value.startswith("http"):
+            value = "http://" + value
+        if "facebook.com" in value:
+            social_networks.append({"address": value, "type": "Facebook"})
+        elif "twitter.com" in value:
+            social_networks.append({"address": value, "type": "Twitter"})
+        else:
+            websites.append(value)
+
+    return NormalizedContact(
+        fields,
+        uid=_first_value(content, "uid"),
+        given=name.given,
+        family=name.family,
+        title=_first_value(content, "title"),
+        company=_first_value(content, "org"),
+        emails=[
+            {"address": email.value, "type": _kind(email)}
+            for email in emails
+            if SYNCED_EMAIL_PATTERN.match(email.value)
+        ],
+        addresses=[
+            {
+                "street": addr.value.street,
+                "zip_code": addr.value.code,
+                "city": addr.value.city,
+                "country": addr.value.country,
+                "type": _kind(addr),
+            }
+            for addr in content.get("adr", [])
+        ],
+        phones=[_phone(telefon, timings) for telefon in content.get("tel", [])],
+        instant_messaging=(
+            [
+                {"address": skype.value, "type": "Skype"}
+                for skype in content.get("x-skype", [])
+            ]
+            + [
+                {"address": msn.value, "type": "Messenger"}
+                for msn in content.get("x-msn", []) + content.get("x-msnim", [])
+            ]
+        ),
+        social_networks=social_networks,
+        websites=websites,
+        birthdays=[
+            {
+                "year": bday.value[0:4],
+                "month": bday.value[5:7],
+                "day": bday.value[8:10],
+            }
+            for bday in content.get("bday", [])
+        ],
+    )
+
+
+def _first_value(content, name):
+    """Return the value of the first property called name, None if missing"""
+    return content[name][0].value if name in content else None
+
+
+def _phone(telefon, timings=None):
+    """Normalize a TEL property, see normalize_phone"""
+    started = time.perf_counter()
+    number, formatted = normalize_phone(telefon.value)
+    if timings is not None:
+        timings.append(time.perf_counter() - started)
+    return {
+        "value": telefon.value,
+        "number": number,
+        "formatted": formatted,
+        "type": _kind(telefon),
+    }
+
+
+@functools.lru_cache(maxsize=10000)
+def normalize_phone(value):
+    """
+    Clean up a phone number and format it in international format
+
+    Memoized, the same numbers appear on many cards.
+
+    :param value: phone number as found in the vCard
+    :return: tuple of the cleaned number and the formatted number, which is
+             None if the number can't be parsed without knowing the country
+    """
+    number = value.translate(PHONE_JUNK)
+    number = number.replace("+00", "+").replace("+0", "+")
+    # None if the number could not be parsed, e.g. because it is a
+    # local number without country code
+    return number, format_number(number)
+
+
+def _kind(prop):
+    """Map the TYPE parameter of a vCard property to a Hatchbuck type"""
+    try:
+        if "WORK" in prop.type_paramlist:
+            return "Work"
+        if "HOME" in prop.type_paramlist:
+            return "Home"
+    except AttributeError:
+        # if there is no type at all
+        pass
+    return "Other"
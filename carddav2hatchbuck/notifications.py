@@ -1,30 +1,184 @@
 """
 Notification to pro-actively features for un
 """
+import collections
 import os
 import logging
+import queue
+import threading
+import time
 
-from rocketchat_API.rocketchat import RocketChat
+# RocketChat refuses messages longer than 5000 characters by default
+MAX_LENGTH = 4000
+# seconds to wait for RocketChat
+TIMEOUT = 30
 
 
-# pylint: disable=too-few-public-methods
 class NotificationService:
     """
     An alerting service for unresolvable import or merge issues.
+
+    Messages are queued and posted by a background thread, so the sync never
+    waits for RocketChat. The thread logs in once and keeps the session,
+    messages queued within batch_delay seconds are posted as one digest and
+    a message sent within the last repeat_window seconds is not sent again.
+    Messages RocketChat refused are not remembered as sent.
     """
 
-    def __init__(self):
+    def __init__(self, batch_delay=None, repeat_window=None):
         """A RocketChat channel"""
         self.user = os.environ.get("ROCKETCHAT_USER")
         self.password = os.environ.get("ROCKETCHAT_PASS")
         self.url = os.environ.get("ROCKETCHAT_URL")
-        self.service = RocketChat(self.user, self.password, server_url=self.url)
+        self.service = None
+        # keeps the connection to RocketChat alive between posts, created
+        # with the first post like the RocketChat client
+        self.session = None
         self.channel = os.environ.get("ROCKETCHAT_CHANNEL", "hatchbuck")
         self.alias = os.environ.get("ROCKETCHAT_ALIAS", "carddav2hatchbuck")
+        if batch_delay is None:
+            batch_delay = float(os.environ.get("ROCKETCHAT_BATCH_DELAY", 2))
+        if repeat_window is None:
+            repeat_window = float(os.environ.get("ROCKETCHAT_REPEAT_WINDOW", 3600))
+        self.batch_delay = batch_delay
+        self.repeat_window = repeat_window
+        self.sent = {}
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def send_message(self, message, on_sent=None):
+        """
+        Queue a message for the RocketChat channel
+
+        :param on_sent: called by the background thread once the message is
+                        posted, or was posted within the repeat window
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        self.queue.put((message, on_sent))
+
+    def flush(self):
+        """Wait until all queued messages are posted"""
+        self.queue.join()
+
+    def close(self):
+        """Post the queued messages and stop the background thread"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+    def _run(self):
+        """Post digests of the queued messages until close"""
+        while True:
+            messages = [self.queue.get()]
+            deadline = time.monotonic() + self.batch_delay
+            while messages[-1] is not None:
+                try:
+                    messages.append(
+                        self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                    )
+                except queue.Empty:
+                    break
+            try:
+                self._post([message for message in messages if message is not None])
+            except Exception:  # pylint: disable=broad-except
+                # notifications must never break the sync, log in again
+                # next time in case the session expired
+                logging.exception("sending notification failed")
+                self.service = None
+            finally:
+                for _ in messages:
+                    self.queue.task_done()
+            if messages[-1] is None:
+                return
+
+    def _post(self, messages):
+        """
+        Post new messages, split into digests RocketChat accepts
+
+        :param messages: tuples of message and on_sent callback or None
+        """
+        now = time.monotonic()
+        for message, sent in list(self.sent.items()):
+            if now - sent >= self.repeat_window:
+                del self.sent[message]
+        fresh = []
+        callbacks = collections.defaultdict(list)
+        for message, on_sent in messages:
+            if on_sent is not None:
+                callbacks[message].append(on_sent)
+            if message in self.sent:
+                logging.debug("not repeating notification: %s", message)
+            elif message not in fresh:
+                fresh.append(message)
+        for message in self.sent:
+            for on_sent in callbacks.pop(message, []):
+                on_sent()
+        for digest, packed in _digests(fresh):
+            if self.service is None:
+                if self.session is None:
+                    self.session = _session()
+                self.service = _rocketchat_client(
+                    self.user,
+                    self.password,
+                    server_url=self.url,
+                    timeout=TIMEOUT,
+                    session=self.session,
+                )
+            response = self.service.chat_post_message(
+                digest, channel=self.channel, alias=self.alias
+            )
+            result = response.json()
+            logging.debug(result)
+            if not result.get("success"):
+                # e.g. an expired session, log in again for the next digest
+                logging.warning("RocketChat refused the notification: %s", result)
+                self.service = None
+                continue
+            for message in packed:
+                self.sent[message] = now
+                for on_sent in callbacks.pop(message, []):
+                    on_sent()
+
 
-    def send_message(self, message):
-        """Send a message to the RocketChat channel"""
-        response = self.service.chat_post_message(
-            message, channel=self.channel, alias=self.alias
-        )
-        logging.debug(response.json())
+def _rocketchat_client(*args, **kwargs):
+    """Create a RocketChat client, rocketchat_API is imported on first use"""
+    # pylint: disable=import-outside-toplevel
+    from rocketchat_API.rocketchat import RocketChat
+
+    return RocketChat(*args, **kwargs)
+
+
+def _session():
+    """Create the HTTP session, requests is imported on first use"""
+    import requests  # pylint: disable=import-outside-toplevel
+
+    return requests.Session()
+
+
+def _digests(messages):
+    """
+    Join messages into as few digests of at most MAX_LENGTH as possible
+
+    Longer messages are cut. Yields the text of each digest and the
+    messages it contains.
+    """
+    digest = ""
+    packed = []
+    for message in messages:
+        text = message
+        if len(text) > MAX_LENGTH:
+            text = text[: MAX_LENGTH - 3] + "..."
+        if digest and len(digest) + len(text) + 2 > MAX_LENGTH:
+            yield digest, packed
+            digest = ""
+            packed = []
+        digest = "%s\n\n%s" % (digest, text) if digest else text
+        packed.append(message)
+    if digest:
+        yield digest, packed
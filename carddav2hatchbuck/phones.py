@@ -0,0 +1,184 @@
+"""
+Memoized phone number formatting and country name resolution
+
+Shared contacts and company switchboard numbers appear on many cards in many
+address books, every distinct number is only parsed once. The same goes for
+country names, pycountry's fuzzy search takes tens of milliseconds.
+
+phonenumbers and pycountry are imported on first use, importing them and
+indexing the countries is a good part of the startup time.
+"""
+import collections
+import functools
+import threading
+
+# country names used in address books that pycountry doesn't know,
+# the same mapping as Hatchbuck._clean_country_name
+COUNTRY_ALIASES = {
+    "suisse": "CH",
+    "svizzera": "CH",
+    "schweiz": "CH",
+    "deutschland": "DE",
+    "brasil": "BR",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _country_index():
+    """Map lower case names and codes of all countries to alpha-2 codes"""
+    from pycountry import countries  # pylint: disable=import-outside-toplevel
+
+    index = {}
+    for country in countries:
+        for attribute in ("alpha_2", "alpha_3", "numeric", "name"):
+            index[getattr(country, attribute).lower()] = country.alpha_2
+        for attribute in ("official_name", "common_name"):
+            value = getattr(country, attribute, None)
+            if value:
+                index.setdefault(value.lower(), country.alpha_2)
+    for alias, code in COUNTRY_ALIASES.items():
+        index.setdefault(alias, code)
+    return index
+
+
+def country_code(name):
+    """
+    Return the alpha-2 code of a country name, None if it is unknown
+
+    Exact names and codes are resolved from an index, anything else falls
+    back to the (slow, memoized) fuzzy search of pycountry.
+    """
+    if not name or not name.strip():
+        return None
+    key = name.strip().lower()
+    index = _country_index()
+    if key in index:
+        return index[key]
+    country = search_country(key)
+    return country.alpha_2 if country is not None else None
+
+
+@functools.lru_cache(maxsize=1024)
+def search_country(name):
+    """
+    Memoized pycountry fuzzy search
+
+    :return: the best matching country, None if nothing matches
+    """
+    from pycountry import countries  # pylint: disable=import-outside-toplevel
+
+    try:
+        return countries.search_fuzzy(name)[0]
+    except LookupError:
+        return None
+
+
+def format_number(number, country=None):
+    """
+    Format a phone number in international format
+
+    :param country: alpha-2 code to parse local numbers with
+    :return: the formatted number, None if it can't be parsed
+    """
+    import phonenumbers  # pylint: disable=import-outside-toplevel
+
+    try:
+        phonenumber = phonenumbers.parse(number, country)
+    except phonenumbers.phonenumberutil.NumberParseException:
+        return None
+    return phonenumbers.format_number(
+        phonenumber, phonenumbers.PhoneNumberFormat.INTERNATIONAL
+    )
+
+
+class PhoneCache:
+    """
+    A bounded LRU cache of formatted phone numbers, safe to share between
+    threads, keyed by the number and the country it is parsed with.
+
+    With a store (SyncState) numbers formatted in previous runs are looked
+    up there before parsing them again.
+    """
+
+    def __init__(self, maxsize=10000, store=None):
+        self.maxsize = maxsize
+        self.store = store
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def format(self, number, country=None):
+        """Format a phone number, see format_number"""
+        key = (number, country)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        found = False
+        if self.store is not None:
+            found, formatted = self.store.phone(number, country)
+        if not found:
+            formatted = format_number(number, country)
+            if self.store is not None:
+                self.store.save_phone(number, country, formatted)
+
+        with self.lock:
+            self.entries[key] = formatted
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return formatted
+
+
+class PhoneIndex:
+    """
+    Index of the phone numbers of a profile for duplicate checks
+
+    Numbers are compared in a digit-only canonical form. All suffixes of
+    every number are counted, so checking whether a local number is the end
+    of an international one doesn't scan the profile.
+    """
+
+    def __init__(self, numbers=()):
+        self.numbers = collections.Counter()
+        self.suffixes = collections.Counter()
+        for number in numbers:
+            self.add(number)
+
+    @staticmethod
+    def canonical(number):
+        """Return the digits of a phone number"""
+        return "".join(char for char in number if char.isdigit())
+
+    def add(self, number):
+        """Add a number to the index"""
+        digits = self.canonical(number)
+        self.numbers[digits] += 1
+        for start in range(len(digits) + 1):
+            self.suffixes[digits[start:]] += 1
+
+    def remove(self, number):
+        """Remove a number added before"""
+        digits = self.canonical(number)
+        self.numbers[digits] -= 1
+        for start in range(len(digits) + 1):
+            self.suffixes[digits[start:]] -= 1
+
+    def __contains__(self, number):
+        return self.numbers[self.canonical(number)] > 0
+
+    def has_suffix(self, number, exclude=None):
+        """
+        Return True if a number in the index ends with the digits of number
+
+        :param exclude: a number in the index not to compare with
+        """
+        digits = self.canonical(number)
+        count = self.suffixes[digits]
+        if exclude is not None and self.canonical(exclude).endswith(digits):
+            count -= 1
+        return count > 0
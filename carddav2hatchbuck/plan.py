@@ -0,0 +1,239 @@
+"""
+Change plans: the writes of a sync collected for review, applied later
+"""
+import copy
+import hashlib
+import itertools
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .client import Client
+
+# prefix of the contactIds of contacts created by a plan
+PLAN_ID = "plan-"
+
+
+class Plan:
+    """
+    The creates, updates and tags a sync would send to Hatchbuck.
+
+    All changes to a contact are merged, so applying the plan sends at most
+    one create or update per contact. Contacts created by the plan have a
+    placeholder contactId starting with PLAN_ID until it is applied.
+    Loaded plans have a digest of their file to checkpoint applying them.
+    """
+
+    def __init__(self, creates=None, updates=None, tags=None):
+        self.creates = creates or {}
+        self.updates = updates or {}
+        self.tags = tags or {}
+        self.duplicates = []
+        self.digest = None
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def create(self, profile):
+        """Add a contact to create, return it with a placeholder contactId"""
+        with self.lock:
+            contact_id = "%s%s" % (PLAN_ID, next(self.ids))
+            profile = copy.deepcopy(profile)
+            profile["contactId"] = contact_id
+            for value in profile.values():
+                if isinstance(value, list):
+                    for item in value:
+                        if isinstance(item, dict):
+                            item["id"] = "%s%s" % (PLAN_ID, next(self.ids))
+            self.creates[contact_id] = profile
+            return copy.deepcopy(profile)
+
+    def update(self, contact_id, delta):
+        """Add changes to a contact, see profile.profile_delta"""
+        delta = {key: value for key, value in delta.items() if key != "contactId"}
+        with self.lock:
+            if contact_id in self.creates:
+                # not created yet, create it with the changes right away
+                _merge(self.creates[contact_id], delta, self.ids)
+                return
+            update = self.updates.setdefault(contact_id, {})
+            for key, value in delta.items():
+                if isinstance(value, list):
+                    update.setdefault(key, []).extend(copy.deepcopy(value))
+                else:
+                    update[key] = value
+
+    def tag(self, contact_id, tag):
+        """Add a tag to add to a contact"""
+        with self.lock:
+            tags = self.tags.setdefault(contact_id, [])
+            if tag not in tags:
+                tags.append(tag)
+
+    def to_dict(self):
+        """Return the plan as JSON serializable dict"""
+        with self.lock:
+            return {
+                "creates": {
+                    contact_id: _without_ids(profile)
+                    for contact_id, profile in self.creates.items()
+                },
+                "updates": self.updates,
+                "tags": self.tags,
+                "duplicates": self.duplicates,
+            }
+
+    def write(self, path):
+        """Write the plan to a JSON file"""
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file, indent=1, sort_keys=True)
+        logging.info(
+            "plan written to %s: %s creates, %s updates, %s tags",
+            path,
+            len(self.creates),
+            len(self.updates),
+            sum(len(tags) for tags in self.tags.values()),
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Read a plan written by write"""
+        with open(path, "rb") as file:
+            content = file.read()
+        data = json.loads(content.decode("utf-8"))
+        plan = cls(data["creates"], data["updates"], data["tags"])
+        plan.duplicates = data["duplicates"]
+        plan.digest = hashlib.sha256(content).hexdigest()
+        return plan
+
+
+class PlanningClient(Client):
+    """
+    Hatchbuck client adding all writes to a Plan instead of sending them.
+
+    Searches are still sent to Hatchbuck (or answered by the mirror).
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs["noop"] = True
+        super().__init__(*args, **kwargs)
+        self.plan = Plan()
+
+    def create(self, profile):
+        """Plan to create a contact"""
+        return self.plan.create(profile)
+
+    def update(self, contact_id, profile):
+        """Plan to update a contact"""
+        self.plan.update(contact_id, profile)
+        return profile
+
+    def add_tag(self, contact_id, tagname):
+        """Plan to tag a contact"""
+        self.plan.tag(contact_id, tagname)
+
+
+def apply_plan(client, plan, workers=1, state=None):
+    """
+    Send the changes of a plan to Hatchbuck
+
+    The contacts are created first, then all other contacts are updated and
+    tagged, workers contacts at a time. With a sync state every change sent
+    is checkpointed, applying an interrupted or partly failed plan again
+    only sends the remaining changes.
+
+    :return: dict with the number of created, updated and tagged contacts,
+             failed requests and changes skipped as applied before
+    """
+    stats = {"created": 0, "updated": 0, "tagged": 0, "failed": 0, "skipped": 0}
+    lock = threading.Lock()
+    checkpoints = state is not None and plan.digest is not None
+    applied = state.applied_actions(plan.digest) if checkpoints else {}
+    contact_ids = {}
+
+    def count(key):
+        """Count a result"""
+        with lock:
+            stats[key] += 1
+
+    def checkpoint(action, contact_id=None):
+        """Remember a change sent to Hatchbuck"""
+        if checkpoints:
+            state.save_applied(plan.digest, action, contact_id)
+
+    def create(item):
+        """Create a planned contact"""
+        planned, profile = item
+        action = "create %s" % planned
+        if action in applied:
+            count("skipped")
+            contact_ids[planned] = applied[action]
+            return
+        created = client.create(copy.deepcopy(profile))
+        count("created" if created is not None else "failed")
+        contact_ids[planned] = created["contactId"] if created is not None else None
+        if created is not None:
+            checkpoint(action, created["contactId"])
+
+    def change(planned):
+        """Update and tag a contact"""
+        contact_id = contact_ids.get(planned, planned)
+        if contact_id is None:
+            # its create failed
+            return
+        action = "update %s" % planned
+        if planned in plan.updates and action in applied:
+            count("skipped")
+        elif planned in plan.updates:
+            updated = client.update(contact_id, copy.deepcopy(plan.updates[planned]))
+            count("updated" if updated is not None else "failed")
+            if updated is not None:
+                checkpoint(action)
+        for tag in plan.tags.get(planned, []):
+            action = "tag %s %s" % (planned, tag)
+            if action in applied:
+                count("skipped")
+                continue
+            client.add_tag(contact_id, tag)
+            count("tagged")
+            checkpoint(action)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(create, plan.creates.items()))
+        changed = dict.fromkeys(itertools.chain(plan.updates, plan.tags))
+        list(pool.map(change, changed))
+    if stats["failed"]:
+        logging.warning(
+            "%s changes failed, apply the plan again to retry them", stats["failed"]
+        )
+    return stats
+
+
+def _merge(profile, delta, ids):
+    """Apply an update to a planned contact like Hatchbuck does"""
+    for key, value in delta.items():
+        if not isinstance(value, list):
+            profile[key] = value
+            continue
+        items = profile.setdefault(key, [])
+        for item in value:
+            existing = [old for old in items if item.get("id") == old.get("id")]
+            if not item.get("id") or not existing:
+                items.append(dict(item, id="%s%s" % (PLAN_ID, next(ids))))
+            elif all(field in ("id", "type") or not val for field, val in item.items()):
+                # empty fields delete the entry
+                items.remove(existing[0])
+            else:
+                existing[0].update(item)
+
+
+def _without_ids(profile):
+    """Return a planned contact without its placeholder ids"""
+    profile = copy.deepcopy(profile)
+    profile.pop("contactId", None)
+    for value in profile.values():
+        if isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    item.pop("id", None)
+    return profile
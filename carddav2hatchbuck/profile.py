@@ -0,0 +1,234 @@
+"""
+Local profile changes, collected and sent to Hatchbuck as a single update
+"""
+import collections
+import copy
+import itertools
+import logging
+
+from hatchbuck import Hatchbuck
+
+from .phones import PhoneIndex, country_code, search_country
+
+# prefix for the ids of list entries that only exist in the local profile
+LOCAL_ID = "local-"
+
+
+class LocalHatchbuck(Hatchbuck):
+    """
+    Hatchbuck bindings applying all profile changes to a local copy.
+
+    The profile_add* and clean_* helpers of Hatchbuck work unchanged, commit
+    computes the difference to the profile Hatchbuck returned and sends it
+    as one update request (or none if nothing changed).
+    """
+
+    listdictkeys = dict(
+        Hatchbuck.listdictkeys,
+        instantMessaging=["address"],
+        website=["websiteUrl"],
+        customFields=["name"],
+    )
+
+    def __init__(self, client, phones=None):
+        super().__init__(client.key, noop=True)
+        self.client = client
+        self.phones = phones
+        self.originals = {}
+        self.profiles = {}
+        self.ids = itertools.count(1)
+        # number of updates sent to Hatchbuck and refused by Hatchbuck
+        self.updates = 0
+        self.failures = 0
+
+    def checkout(self, profile):
+        """Return a local copy of a profile to apply changes to"""
+        self.originals[profile["contactId"]] = profile
+        local = copy.deepcopy(profile)
+        self.profiles[profile["contactId"]] = local
+        return local
+
+    def _format_phone_number(self, number, country=None):
+        """Format a phone number using the shared cache, if there is one"""
+        if self.phones is None:
+            return super()._format_phone_number(number, country)
+        return self.phones.format(self._cleanup_phone_number(number), country)
+
+    def clean_all_phone_numbers(self, profile):
+        """
+        Format and deduplicate all phone numbers like
+        Hatchbuck.clean_all_phone_numbers, using a PhoneIndex instead of
+        comparing every number with all others
+        """
+        countrycode = self._get_countrycode(profile)
+        phones = profile.get("phones", [])
+        exact = collections.Counter(num["number"] for num in phones)
+        index = PhoneIndex(num["number"] for num in phones)
+
+        for num in list(phones):
+            number = num["number"]
+            formatted = self._format_phone_number(number)
+            if formatted is None and countrycode is not None:
+                formatted = self._format_phone_number(number, countrycode)
+            if formatted is None:
+                # local number and unknown country? ignore and continue
+                formatted = self._cleanup_phone_number(number)
+
+            same = exact[formatted] - (1 if number == formatted else 0)
+            if same > 0 or (
+                formatted.startswith("0")
+                and index.has_suffix(formatted[1:], exclude=number)
+            ):
+                # a duplicate or the local version of an existing
+                # international number
+                logging.debug(
+                    "%s: phone number %s is a duplicate, removing",
+                    self.short_contact(profile),
+                    number,
+                )
+                profile = self.silent_update(
+                    profile,
+                    {"phones": [{"number": "", "id": num["id"], "type": num["type"]}]},
+                )
+                exact[number] -= 1
+                index.remove(number)
+            elif formatted != number:
+                logging.debug(
+                    "%s: phone number %s formatted, updating",
+                    self.short_contact(profile),
+                    formatted,
+                )
+                profile = self.silent_update(
+                    profile,
+                    {
+                        "phones": [
+                            {"number": formatted, "id": num["id"], "type": num["type"]}
+                        ]
+                    },
+                )
+                exact[number] -= 1
+                exact[formatted] += 1
+                index.remove(number)
+                index.add(formatted)
+        return profile
+
+    @staticmethod
+    def _get_countrycode(profile):
+        """
+        Extract the country code from the addresses using the country index
+
+        :return: two-letter country code or None if not unambiguous or unknown
+        """
+        found = set(
+            addr["country"].strip().lower()
+            for addr in profile.get("addresses", [])
+            if addr.get("country", False)
+        )
+        if len(found) == 1:
+            return country_code(found.pop())
+        return None
+
+    def _clean_address(self, address):
+        """
+        Clean up an address like Hatchbuck._clean_address
+
+        The country is resolved using the memoized fuzzy search, the rest
+        of the address is cleaned by Hatchbuck without a country.
+        """
+        country = address.pop("country", None) or ""
+        if country:
+            match = search_country(self._clean_country_name(country))
+            if match is not None:
+                country = match.name
+        address = super()._clean_address(address)
+        if not address["country"]:
+            # not derived from the city or the zip code
+            address["country"] = self._clean_country_name(country)
+        return address
+
+    def search_email(self, email):
+        """Searches are still answered by Hatchbuck"""
+        return self.client.search_email(email)
+
+    def update(self, contact_id, profile):
+        """Apply an update to the local copy of the profile"""
+        return self.safe_update(self.profiles[contact_id], profile)
+
+    def safe_update(self, profile, update):
+        """Apply an update to the local copy of the profile"""
+        for key, value in update.items():
+            if isinstance(value, list):
+                profile.setdefault(key, [])
+        profile = super().safe_update(profile, update)
+        # list entries added locally don't have an id yet
+        for value in profile.values():
+            if isinstance(value, list):
+                for item in value:
+                    if isinstance(item, dict) and "id" not in item:
+                        item["id"] = LOCAL_ID + str(next(self.ids))
+        self.profiles[profile["contactId"]] = profile
+        return profile
+
+    def commit(self, profile):
+        """Send the local changes of a profile to Hatchbuck in a single update"""
+        delta = profile_delta(self.originals[profile["contactId"]], profile)
+        if not delta:
+            logging.debug("%s is up to date", self.short_contact(profile))
+            return profile
+        logging.debug("updating %s with %s", self.short_contact(profile), delta)
+        self.updates += 1
+        updated = self.client.update(profile["contactId"], delta)
+        if updated is None:
+            self.failures += 1
+        if updated is None or self.client.noop:
+            return profile
+        return updated
+
+
+def profile_delta(original, profile):
+    """
+    Compute the minimal update turning the original profile into profile
+
+    :param original: profile as returned by Hatchbuck
+    :param profile: locally modified copy of the profile
+    :return: dict with the changed fields, empty if nothing changed
+    """
+    delta = {}
+    for key, value in profile.items():
+        old = original.get(key)
+        if isinstance(value, list):
+            items = _list_delta(key, old or [], value)
+            if items:
+                delta[key] = items
+        elif value != old:
+            delta[key] = value
+    return delta
+
+
+def _list_delta(key, old, new):
+    """Compute the added, changed and deleted entries of a list field"""
+    old_items = {item["id"]: item for item in old if item.get("id")}
+    old_values = [_without_id(item) for item in old]
+    items = []
+    for item in new:
+        ident = item.get("id")
+        if not ident or str(ident).startswith(LOCAL_ID):
+            value = _without_id(item)
+            if value not in old_values:
+                items.append(value)
+        elif item != old_items.get(ident):
+            items.append(item)
+    kept = set(item.get("id") for item in new)
+    for ident, item in old_items.items():
+        if ident not in kept:
+            # empty "primary key" fields delete the entry
+            deleted = {"id": ident, "type": item.get("type", "Other")}
+            for field in LocalHatchbuck.listdictkeys.get(key, []):
+                deleted[field] = ""
+            items.append(deleted)
+    return items
+
+
+def _without_id(item):
+    """Return a list entry without its id, to compare entries by value"""
+    return {name: val for name, val in item.items() if name != "id"}
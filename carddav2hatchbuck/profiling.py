@@ -0,0 +1,137 @@
+"""
+Per-card timing spans and a report of the slowest cards of a sync
+"""
+import contextlib
+import cProfile
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+# phases of syncing a card, in the order of the report columns
+PHASES = ("parse", "phones", "lookup", "update", "tag", "notify")
+
+_current = threading.local()
+
+
+class CardSpan:  # pylint: disable=too-few-public-methods
+    """The time spent per phase and the API requests sent for one card"""
+
+    __slots__ = ("file", "uid", "seconds", "phases", "requests")
+
+    def __init__(self, file, uid):
+        self.file = file
+        self.uid = uid
+        self.seconds = 0.0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.requests = 0
+
+
+def count_request():
+    """Count an API request for the card synced by the current thread"""
+    span = getattr(_current, "span", None)
+    if span is not None:
+        span.requests += 1
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Add the duration of the with block to a phase of the current card"""
+    span = getattr(_current, "span", None)
+    if span is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        span.phases[name] += time.perf_counter() - started
+
+
+class Profiler:
+    """
+    Keeps the top slowest cards of a sync, optionally profiling with cProfile.
+
+    Safe to share between the parsers of all address books. Cards are timed
+    by wrapping their sync in card(), the steps in phase(); API requests
+    are counted by the client through count_request().
+    """
+
+    def __init__(self, top=20, stats=None):
+        """
+        :param top: number of cards in the report
+        :param stats: file to dump the cProfile statistics of run() to
+        """
+        self.top = top
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.slowest = []
+        self.order = itertools.count()
+        self.cards = 0
+
+    @contextlib.contextmanager
+    def card(self, file, uid, parsed=0.0, phones=()):
+        """
+        Time the sync of a card in the with block
+
+        :param parsed: seconds spent parsing the card before, including phones
+        :param phones: seconds spent normalizing each phone number
+        """
+        span = CardSpan(file, uid)
+        span.phases["phones"] = sum(phones)
+        span.phases["parse"] = parsed - span.phases["phones"]
+        _current.span = span
+        started = time.perf_counter()
+        try:
+            yield span
+        finally:
+            _current.span = None
+            span.seconds = parsed + time.perf_counter() - started
+            with self.lock:
+                self.cards += 1
+                item = (span.seconds, next(self.order), span)
+                if len(self.slowest) < self.top:
+                    heapq.heappush(self.slowest, item)
+                else:
+                    heapq.heappushpop(self.slowest, item)
+
+    @contextlib.contextmanager
+    def run(self):
+        """Profile the with block with cProfile if a stats file is set"""
+        if not self.stats:
+            yield
+            return
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(self.stats)
+            logging.info("profile written to %s", self.stats)
+
+    def report(self):
+        """Return the lines of the slowest cards report"""
+        with self.lock:
+            spans = [span for _, _, span in sorted(self.slowest, reverse=True)]
+            cards = self.cards
+        lines = [
+            "%s slowest of %s cards" % (len(spans), cards),
+            "\t".join(("seconds", "requests") + PHASES + ("uid", "file")),
+        ]
+        for span in spans:
+            lines.append(
+                "\t".join(
+                    ["%.4f" % span.seconds, str(span.requests)]
+                    + ["%.4f" % span.phases[name] for name in PHASES]
+                    + [str(span.uid), span.file]
+                )
+            )
+        return lines
+
+    def write(self, path):
+        """Write the slowest cards report to a file"""
+        with open(path, "w", encoding="utf-8") as file:
+            file.write("\n".join(self.report()) + "\n")
+        logging.info("slowest cards written to %s", path)
@@ -0,0 +1,36 @@
+"""
+Rate limiting of the Hatchbuck API requests shared by all workers
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    A thread safe token bucket.
+
+    Tokens are refilled at `rate` per second up to `capacity`, each request
+    takes one token and blocks until one is available.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, wait until one is available if necessary"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,136 @@
+"""
+Sharding of the address books across sync workers sharing one sync state
+"""
+import bisect
+import hashlib
+import logging
+import sqlite3
+import threading
+
+# points per worker on the ring, more spread the address books more evenly
+REPLICAS = 64
+
+
+def _hash(value):
+    """Return a stable position on the ring, unlike hash() between processes"""
+    return int(hashlib.sha1(value.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """
+    Consistent hashing of keys to members.
+
+    Each member owns the keys following its points on the ring, so if a
+    member leaves only its keys move to the remaining members.
+    """
+
+    def __init__(self, members, replicas=REPLICAS):
+        self.points = sorted(
+            (_hash("%s#%s" % (member, replica)), member)
+            for member in members
+            for replica in range(replicas)
+        )
+        self.positions = [position for position, _ in self.points]
+
+    def owner(self, key):
+        """Return the member owning key, None without members"""
+        if not self.points:
+            return None
+        index = bisect.bisect(self.positions, _hash(key)) % len(self.points)
+        return self.points[index][1]
+
+
+class Shard:
+    """
+    The address books a sync worker is responsible for.
+
+    Workers announce themselves with a heartbeat in the sync state, the live
+    workers form the ring deciding which worker owns an address book. A
+    worker missing its heartbeats for ttl seconds drops out of the ring and
+    the others take over its address books. Before syncing an address book
+    the owner takes a lease on it, so two workers never sync it at the same
+    time while the ring changes.
+    """
+
+    def __init__(self, state, worker_id, ttl):
+        self.state = state
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self.ring = HashRing([worker_id])
+
+    def refresh(self):
+        """Send a heartbeat and rebuild the ring from the live workers"""
+        members = self.state.heartbeat(self.worker_id, self.ttl)
+        self.ring = HashRing(members)
+        logging.info("worker %s sharing address books with %s", self.worker_id, members)
+
+    def owns(self, collection):
+        """Return whether the address book belongs to this worker"""
+        return self.ring.owner(collection) == self.worker_id
+
+    def claim(self, collection):
+        """Take or renew the lease of an owned address book"""
+        return self.owns(collection) and self.state.claim_lease(
+            collection, self.worker_id, self.ttl
+        )
+
+    def renew(self, collection):
+        """Send a heartbeat and renew the lease of an address book being synced"""
+        self.state.heartbeat(self.worker_id, self.ttl)
+        return self.state.claim_lease(collection, self.worker_id, self.ttl)
+
+    def hold(self, collection, stop=None):
+        """Return a Lease keeping a claimed address book while it is synced"""
+        return Lease(self, collection, stop)
+
+    def release(self):
+        """Leave the ring, handing the address books to the other workers"""
+        self.state.release_worker(self.worker_id)
+
+
+class Lease:
+    """
+    Keeps the lease of an address book during its sync.
+
+    Used as context manager, a thread renews the lease and the heartbeat
+    every third of the ttl, so a long sync isn't taken over by another
+    worker, and releases it when the sync is done. If a renewal fails the lease is lost and is_set returns True
+    like the wrapped stop event, the sync stops after the current cards.
+    """
+
+    def __init__(self, shard, collection, stop=None):
+        self.shard = shard
+        self.collection = collection
+        self.stop = stop
+        self.lost = threading.Event()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.renew, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.done.set()
+        self.thread.join()
+        # the ring may have moved the address book, let its owner sync it
+        self.shard.state.release_lease(self.collection, self.shard.worker_id)
+
+    def is_set(self):
+        """Return whether the sync must stop, like threading.Event.is_set"""
+        return self.lost.is_set() or (self.stop is not None and self.stop.is_set())
+
+    def renew(self):
+        """Renew the lease until the sync is done or the lease is lost"""
+        while not self.done.wait(self.shard.ttl / 3):
+            try:
+                renewed = self.shard.renew(self.collection)
+            except sqlite3.Error as error:
+                logging.error("renewing the lease failed: %s", error)
+                renewed = False
+            if not renewed:
+                logging.warning(
+                    "lost the lease of %s, stopping its sync", self.collection
+                )
+                self.lost.set()
+                return
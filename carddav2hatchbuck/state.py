@@ -0,0 +1,408 @@
+"""
+Persistent sync state, remembers which vCards were already synced to Hatchbuck
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+class SyncState:
+    """
+    A SQLite backed store of the vCards synced in previous runs.
+
+    Each card is identified by its address book (collection) and UID and
+    remembers a hash of its content and the Hatchbuck contactId it resolved to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cards ("
+            " collection TEXT NOT NULL,"
+            " uid TEXT NOT NULL,"
+            " hash TEXT NOT NULL,"
+            " contact_id TEXT,"
+            " synced REAL NOT NULL,"
+            " PRIMARY KEY (collection, uid))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " collection TEXT NOT NULL,"
+            " path TEXT NOT NULL,"
+            " mtime INTEGER NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " PRIMARY KEY (collection, path))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS collections ("
+            " collection TEXT PRIMARY KEY,"
+            " ctag TEXT,"
+            " sync_token TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            " collection TEXT NOT NULL,"
+            " href TEXT NOT NULL,"
+            " etag TEXT,"
+            " PRIMARY KEY (collection, href))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS phones ("
+            " number TEXT NOT NULL,"
+            " country TEXT NOT NULL,"
+            " formatted TEXT,"
+            " PRIMARY KEY (number, country))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS mirror ("
+            " contact_id TEXT PRIMARY KEY,"
+            " profile TEXT NOT NULL,"
+            " fetched REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS mirror_emails ("
+            " email TEXT PRIMARY KEY,"
+            " contact_id TEXT NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS imports ("
+            " emails TEXT PRIMARY KEY,"
+            " contact_id TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS applied ("
+            " plan TEXT NOT NULL,"
+            " action TEXT NOT NULL,"
+            " contact_id TEXT,"
+            " PRIMARY KEY (plan, action))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS duplicates ("
+            " cluster TEXT PRIMARY KEY,"
+            " reported REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS workers ("
+            " worker_id TEXT PRIMARY KEY,"
+            " expires REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            " collection TEXT PRIMARY KEY,"
+            " worker_id TEXT NOT NULL,"
+            " expires REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def card_hash(text, *settings):
+        """Hash the card content together with the settings that affect the sync"""
+        digest = hashlib.sha1(text.encode("utf-8"))
+        for setting in settings:
+            digest.update(b"\0" + str(setting).encode("utf-8"))
+        return digest.hexdigest()
+
+    def unchanged(self, collection, uid, digest):
+        """Return True if the card was synced before with the same content"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT hash FROM cards WHERE collection = ? AND uid = ?",
+                (collection, uid),
+            ).fetchone()
+        return row is not None and row[0] == digest
+
+    def mark_synced(self, collection, uid, digest, contact_ids):
+        """Remember that a card was synced successfully"""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cards VALUES (?, ?, ?, ?, ?)",
+                (
+                    collection,
+                    uid,
+                    digest,
+                    ",".join(cid for cid in contact_ids if cid),
+                    time.time(),
+                ),
+            )
+            self.connection.commit()
+        logging.debug("marked %s/%s as synced", collection, uid)
+
+    def files(self, collection):
+        """Return the files of a collection as of the last complete sync"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path, mtime, size FROM files WHERE collection = ?",
+                (collection,),
+            ).fetchall()
+        return {path: (mtime, size) for path, mtime, size in rows}
+
+    def save_files(self, collection, files):
+        """
+        Remember the files of a collection after a complete sync
+
+        :param files: dict of path to (modification time in ns, size)
+        """
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM files WHERE collection = ?", (collection,)
+            )
+            self.connection.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?)",
+                [
+                    (collection, path, mtime, size)
+                    for path, (mtime, size) in files.items()
+                ],
+            )
+            self.connection.commit()
+
+    def collection(self, collection):
+        """Return ctag and sync token of an address book as of the last download"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT ctag, sync_token FROM collections WHERE collection = ?",
+                (collection,),
+            ).fetchone()
+        return tuple(row) if row is not None else (None, None)
+
+    def save_collection(self, collection, ctag, sync_token):
+        """Remember ctag and sync token of a downloaded address book"""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO collections VALUES (?, ?, ?)",
+                (collection, ctag, sync_token),
+            )
+            self.connection.commit()
+
+    def items(self, collection):
+        """Return the ETags of the downloaded vCards of an address book"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT href, etag FROM items WHERE collection = ?", (collection,)
+            ).fetchall()
+        return dict(rows)
+
+    def save_item(self, collection, href, etag):
+        """Remember the ETag of a downloaded vCard"""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO items VALUES (?, ?, ?)",
+                (collection, href, etag),
+            )
+            self.connection.commit()
+
+    def delete_item(self, collection, href):
+        """Forget a vCard deleted on the server"""
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM items WHERE collection = ? AND href = ?",
+                (collection, href),
+            )
+            self.connection.commit()
+
+    def phone(self, number, country):
+        """
+        Look up a phone number formatted in a previous run
+
+        :return: tuple of found and the formatted number (None if unparsable)
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT formatted FROM phones WHERE number = ? AND country = ?",
+                (number, country or ""),
+            ).fetchone()
+        return (True, row[0]) if row is not None else (False, None)
+
+    def save_phone(self, number, country, formatted):
+        """Remember a formatted phone number"""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO phones VALUES (?, ?, ?)",
+                (number, country or "", formatted),
+            )
+            self.connection.commit()
+
+    def mirrored_contact(self, contact_id):
+        """
+        Return a mirrored Hatchbuck contact
+
+        :return: tuple of profile and the time it was fetched, or None
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT profile, fetched FROM mirror WHERE contact_id = ?",
+                (contact_id,),
+            ).fetchone()
+        return (json.loads(row[0]), row[1]) if row is not None else None
+
+    def mirrored_email(self, email):
+        """Return the contactId of a mirrored email address, or None"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT contact_id FROM mirror_emails WHERE email = ?",
+                (email.lower(),),
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def save_mirror(self, profile, emails, fetched=None):
+        """
+        Mirror a Hatchbuck contact
+
+        :param emails: lower case email addresses to find the contact by
+        """
+        contact_id = profile["contactId"]
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO mirror VALUES (?, ?, ?)",
+                (contact_id, json.dumps(profile), fetched or time.time()),
+            )
+            self.connection.execute(
+                "DELETE FROM mirror_emails WHERE contact_id = ?", (contact_id,)
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO mirror_emails VALUES (?, ?)",
+                [(email, contact_id) for email in emails],
+            )
+            self.connection.commit()
+
+    def drop_mirror(self, contact_id):
+        """Forget a mirrored contact"""
+        with self.lock:
+            for table in ("mirror", "mirror_emails"):
+                self.connection.execute(
+                    "DELETE FROM %s WHERE contact_id = ?" % table, (contact_id,)
+                )
+            self.connection.commit()
+
+    def import_checkpoint(self, emails):
+        """
+        Look up a contact of an initial import
+
+        :param emails: the lower case email addresses of the contact
+        :return: tuple of found and the contactId, which is None if the
+                 import was interrupted while creating the contact
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT contact_id FROM imports WHERE emails = ?",
+                (",".join(sorted(emails)),),
+            ).fetchone()
+        return (True, row[0]) if row is not None else (False, None)
+
+    def save_import(self, emails, contact_id=None):
+        """Checkpoint a contact of an initial import, None before creating it"""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO imports VALUES (?, ?)",
+                (",".join(sorted(emails)), contact_id),
+            )
+            self.connection.commit()
+
+    def clear_imports(self):
+        """Forget the checkpoints of a completed initial import"""
+        with self.lock:
+            self.connection.execute("DELETE FROM imports")
+            self.connection.commit()
+
+    def applied_actions(self, plan):
+        """
+        Look up the changes of a plan sent to Hatchbuck before
+
+        :param plan: digest of the plan file
+        :return: dict of action to the contactId it created, or None
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT action, contact_id FROM applied WHERE plan = ?", (plan,)
+            ).fetchall()
+        return dict(rows)
+
+    def save_applied(self, plan, action, contact_id=None):
+        """Checkpoint a change of a plan sent to Hatchbuck"""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO applied VALUES (?, ?, ?)",
+                (plan, action, contact_id),
+            )
+            self.connection.commit()
+
+    def reported_duplicates(self):
+        """Return the clusters of duplicate contactIds reported before as sets"""
+        with self.lock:
+            rows = self.connection.execute("SELECT cluster FROM duplicates").fetchall()
+        return [set(row[0].split(",")) for row in rows]
+
+    def save_duplicates(self, clusters):
+        """Remember reported clusters of duplicate contactIds"""
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO duplicates VALUES (?, ?)",
+                [(",".join(sorted(cluster)), time.time()) for cluster in clusters],
+            )
+            self.connection.commit()
+
+    def heartbeat(self, worker_id, ttl):
+        """
+        Announce a sync worker as alive for ttl seconds
+
+        :return: the sorted ids of all live workers
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO workers VALUES (?, ?)", (worker_id, now + ttl)
+            )
+            self.connection.execute("DELETE FROM workers WHERE expires < ?", (now,))
+            rows = self.connection.execute(
+                "SELECT worker_id FROM workers ORDER BY worker_id"
+            ).fetchall()
+            self.connection.commit()
+        return [row[0] for row in rows]
+
+    def claim_lease(self, collection, worker_id, ttl):
+        """
+        Take or renew the lease of an address book for ttl seconds
+
+        :return: whether the worker holds the lease, False while another
+                 worker's lease has not expired
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO leases VALUES (?, ?, ?)",
+                (collection, worker_id, now + ttl),
+            )
+            claimed = self.connection.execute(
+                "UPDATE leases SET worker_id = ?, expires = ?"
+                " WHERE collection = ? AND (worker_id = ? OR expires < ?)",
+                (worker_id, now + ttl, collection, worker_id, now),
+            ).rowcount
+            self.connection.commit()
+        return claimed == 1
+
+    def release_lease(self, collection, worker_id):
+        """Give up the lease of an address book, if the worker still holds it"""
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM leases WHERE collection = ? AND worker_id = ?",
+                (collection, worker_id),
+            )
+            self.connection.commit()
+
+    def release_worker(self, worker_id):
+        """Remove a stopping sync worker and its leases"""
+        with self.lock:
+            for table in ("workers", "leases"):
+                self.connection.execute(
+                    "DELETE FROM %s WHERE worker_id = ?" % table, (worker_id,)
+                )
+            self.connection.commit()
+
+    def close(self):
+        """Close the underlying database"""
+        with self.lock:
+            self.connection.close()
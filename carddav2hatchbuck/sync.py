@@ -10,76 +10,245 @@ import logging
 import os
 import os.path
 import pathlib
-import subprocess
+import signal
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-import sentry_sdk
-
-from .carddavsync import HatchbuckParser
+from .carddav import CardDAVClient, fetch_address_books
+from .carddavsync import (
+    ContactTable,
+    HatchbuckParser,
+    create_client,
+    create_profiler,
+    finish_plan,
+    finish_profile,
+    report_duplicates,
+)
 from .cli import parse_arguments
+from .duplicates import DuplicateDetector
+from .metrics import Metrics
+from .mirror import ContactMirror
+from .notifications import NotificationService
+from .phones import PhoneCache
+from .shard import Shard
+from .state import SyncState
+
 
+# pylint: disable=too-many-arguments
+def run_carddav_sync(
+    args,
+    hatchbuck=None,
+    state=None,
+    stop=None,
+    carddav=None,
+    metrics=None,
+    notifications=None,
+    shard=None,
+):
+    """
+    Fetch contacts from CardDAV source and sync with Hatchbuck
 
-def run_carddav_sync(args):
-    """Fetch contacts from CardDAV source and sync with Hatchbuck"""
+    The Hatchbuck client, sync state, stop event, CardDAV client, metrics,
+    notification service and shard are passed on to share them between runs
+    in daemon mode. With args.worker_id only the address books of the
+    worker's shard are fetched and synced.
+    """
     now = time.strftime("%Y-%m-%d %H:%M:%S")
     logging.info("Starting carddav sync at %s with arguments: %s", now, args)
 
     carddav_dir = pathlib.Path("carddav")
     carddav_dir.mkdir(parents=True, exist_ok=True)
+    if not args.state:
+        args.state = str(carddav_dir / ".sync-state.sqlite")
 
-    sync_template = "vdirsyncer.config.template"
-    sync_config = "vdirsyncer.config"
-
-    with open(sync_template, "r") as template:
-        content = template.read()
-        content = content.replace("VDIRSYNC_URL", args.vdirsync_url)
-        content = content.replace("VDIRSYNC_USER", args.vdirsync_user)
-        content = content.replace("VDIRSYNC_PASS", args.vdirsync_pass)
-
-    with open(sync_config, "w") as config_file:
-        config_file.write(content)
-
-    # NOTE: This should be done with Python module calls
-    # see https://github.com/pimutils/vdirsyncer/issues/770
-    subprocess.run(
-        "yes | vdirsyncer -c vdirsyncer.config discover",
-        shell=True,
-        check=True,
-        stdout=subprocess.PIPE,
-    )
+    owned_state = state is None
+    if owned_state:
+        state = SyncState(args.state)
+    batch = metrics is None
+    if batch:
+        metrics = Metrics()
+    if shard is None and args.worker_id:
+        shard = create_shard(args, state)
+    try:
+        with metrics.time("carddav2hatchbuck_sync_run_seconds"):
+            if shard is not None:
+                shard.refresh()
+            if carddav is None:
+                carddav = create_carddav_client(args)
+            fetch_address_books(
+                carddav,
+                state,
+                str(carddav_dir),
+                include=shard.owns if shard is not None else None,
+            )
+
+            logging.info("CardDAV sync done, starting carddavsync")
+            sync_address_books(
+                args, hatchbuck, state, stop, metrics, notifications, shard
+            )
+    finally:
+        if owned_state:
+            state.close()
+        if batch and args.metrics_file:
+            metrics.write_json(args.metrics_file)
+
+
+def create_carddav_client(args):
+    """Create the CardDAV client for the configured address book server"""
+    return CardDAVClient(args.vdirsync_url, args.vdirsync_user, args.vdirsync_pass)
 
-    subprocess.run(
-        "vdirsyncer -c vdirsyncer.config sync",
-        shell=True,
-        check=True,
-        stdout=subprocess.PIPE,
-    )
 
-    os.remove(sync_config)
+def create_shard(args, state):
+    """Create the shard of sync worker args.worker_id"""
+    ttl = args.lease_ttl or 3 * args.interval
+    return Shard(state, args.worker_id, ttl)
 
-    logging.info("CardDAV sync done, starting carddavsync")
 
-    files_list = os.listdir(carddav_dir.name)
+# pylint: disable=too-many-arguments
+def sync_address_books(
+    args, hatchbuck, state, stop, metrics=None, notifications=None, shard=None
+):
+    """
+    Sync the vcf files changed since the last sync to Hatchbuck
 
-    for file_name in files_list:
+    Up to args.books address books are synced in parallel, sharing the
+    Hatchbuck client with its rate limiter and the contact lookup table.
+    Duplicates found in any address book are reported once at the end.
+    With a shard only the address books leased by this worker are synced,
+    the lease is renewed until the address book is done.
+    """
+    books = []
+    for file_name in sorted(os.listdir("carddav")):
         file_detail = file_name.split("_")
         if len(file_detail) == 4:
-            firstname, _, lastname, _ = file_detail
-            args.tag = "Adressbuch-%s" % firstname
-            args.user = "%s.%s" % (firstname, lastname)
-            args.dir = [os.path.join("carddav", file_name)]
-            parser = HatchbuckParser(args)
-            parser.main()
-        else:
+            books.append(file_name)
+        elif not file_name.startswith("."):
             logging.info(
                 "File naming scheme not compatible." " Skipping: %s", file_detail
             )
-            continue
+    if not books:
+        return
+
+    if metrics is None:
+        metrics = Metrics()
+    if hatchbuck is None:
+        hatchbuck = create_client(args, metrics)
+    shared = {
+        "table": ContactTable(),
+        "metrics": metrics,
+        "phones": PhoneCache(store=state),
+        "mirror": (
+            ContactMirror(hatchbuck, state, args.mirror_ttl) if args.mirror else None
+        ),
+        "duplicates": DuplicateDetector(),
+        "profiler": create_profiler(args),
+    }
+
+    def sync_book(file_name):
+        """Sync one address book"""
+        if shard is None:
+            sync_address_book(args, file_name, hatchbuck, state, stop, shared)
+            return
+        if not shard.claim(file_name):
+            logging.debug("%s belongs to another worker, skipping", file_name)
+            return
+        with shard.hold(file_name, stop) as lease:
+            # stops syncing the address book if the lease is lost
+            sync_address_book(args, file_name, hatchbuck, state, lease, shared)
+
+    def sync_books():
+        """Sync all address books"""
+        workers = max(1, min(args.books, len(books)))
+        if workers == 1:
+            for file_name in books:
+                sync_book(file_name)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # list() re-raises the first exception of a failed address book
+                list(pool.map(sync_book, books))
+
+    profiler = shared["profiler"]
+    if profiler is not None:
+        with profiler.run():
+            sync_books()
+        finish_profile(profiler, args)
+    else:
+        sync_books()
+    if args.plan:
+        finish_plan(shared["duplicates"], state, args, hatchbuck)
+    else:
+        report_duplicates(shared["duplicates"], state, args.noop, notifications)
+
+
+# pylint: disable=too-many-arguments
+def sync_address_book(args, file_name, hatchbuck, state, stop, shared):
+    """
+    Sync the changed vcf files of the address book <first>_x_<last>_y
+
+    :param shared: HatchbuckParser arguments shared by all address books
+    """
+    if stop is not None and stop.is_set():
+        return
+    firstname, _, lastname, _ = file_name.split("_")
+
+    book_dir = os.path.join("carddav", file_name)
+    files = snapshot_files(book_dir)
+    previous = state.files(file_name)
+    changed = sorted(
+        path for path, stamp in files.items() if previous.get(path) != stamp
+    )
+    deleted = len(set(previous) - set(files))
+    logging.info(
+        "%s: %s vCards added or modified, %s deleted",
+        file_name,
+        len(changed),
+        deleted,
+    )
+    failed = set()
+    if changed:
+        parser = HatchbuckParser(
+            args,
+            hatchbuck=hatchbuck,
+            state=state,
+            stop=stop,
+            tag="Adressbuch-%s" % firstname,
+            user="%s.%s" % (firstname, lastname),
+            files=changed,
+            dirs=[book_dir],
+            **shared
+        )
+        parser.main()
+        if stop is not None and stop.is_set():
+            # not all files were synced, try again next time
+            return
+        failed = parser.failed_files
+    if args.noop:
+        # nothing was sent to Hatchbuck, the files are synced next time
+        return
+    # files with cards that could not be synced are tried again next time
+    state.save_files(
+        file_name,
+        {path: stamp for path, stamp in files.items() if path not in failed},
+    )
+
+
+def snapshot_files(directory):
+    """Return modification time and size of the vcf files in a directory"""
+    files = {}
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".vcf") and entry.is_file():
+            stat = entry.stat()
+            files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+    return files
 
 
 def run():
     """Main entry point"""
     args = parse_arguments()
+    # imported after parsing the arguments, --help doesn't wait for it
+    import sentry_sdk  # pylint: disable=import-outside-toplevel
+
     args.update = True
     sentry_sdk.init(release=os.environ.get("OPENSHIFT_BUILD_NAME"))
     logformat = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -94,7 +263,78 @@ def run():
         logging.getLogger("requests.packages.urllib3.connectionpool").setLevel(
             logging.WARNING
         )
-    run_carddav_sync(args)
+    if args.apply:
+        # the plan holds the changes of all address books, post them once
+        parser = HatchbuckParser(args)
+        parser.main()
+        parser.show_summary()
+    elif args.daemon:
+        run_daemon(args)
+    else:
+        run_carddav_sync(args)
+
+
+def run_daemon(args):
+    """
+    Run the sync every args.interval seconds until SIGTERM or SIGINT
+
+    The process, Hatchbuck client, sync state, metrics and RocketChat
+    session are kept between runs, a signal stops the sync after the cards
+    currently being synced. With args.metrics_port the metrics are served
+    for Prometheus. With args.worker_id the worker leaves its shard when
+    stopping.
+    """
+    stop = threading.Event()
+
+    def shutdown(signum, _frame):
+        """Signal handler stopping the daemon"""
+        logging.info("received signal %s, shutting down", signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    pathlib.Path("carddav").mkdir(parents=True, exist_ok=True)
+    if not args.state:
+        args.state = os.path.join("carddav", ".sync-state.sqlite")
+    metrics = Metrics()
+    server = metrics.serve(args.metrics_port) if args.metrics_port else None
+    hatchbuck = create_client(args, metrics)
+    carddav = create_carddav_client(args)
+    state = SyncState(args.state)
+    notifications = NotificationService()
+    shard = create_shard(args, state) if args.worker_id else None
+    try:
+        while not stop.is_set():
+            started = time.monotonic()
+            try:
+                run_carddav_sync(
+                    args,
+                    hatchbuck=hatchbuck,
+                    state=state,
+                    stop=stop,
+                    carddav=carddav,
+                    metrics=metrics,
+                    notifications=notifications,
+                    shard=shard,
+                )
+            except Exception:  # pylint: disable=broad-except
+                # keep the daemon running, the next run may succeed
+                logging.exception("carddav sync failed")
+                metrics.inc("carddav2hatchbuck_errors_total", kind="sync")
+                import sentry_sdk  # pylint: disable=import-outside-toplevel
+
+                sentry_sdk.capture_exception()
+            stop.wait(max(0, args.interval - (time.monotonic() - started)))
+    finally:
+        if shard is not None:
+            shard.release()
+        notifications.close()
+        state.close()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    logging.info("carddav sync daemon stopped")
 
 
 if __name__ == "__main__":
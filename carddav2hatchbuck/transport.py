@@ -0,0 +1,208 @@
+"""
+HTTP transport of the Hatchbuck client: keep-alive, timeouts, retries
+"""
+import email.utils
+import logging
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+# responses worth retrying, the request failed
+RETRY_STATUS = (429, 502, 503, 504)
+# responses refusing the request, a gateway's 502 and 504 may follow a
+# processed request and are only retried for idempotent requests
+REFUSED_STATUS = (429, 503)
+# query strings in error messages, they carry the api_key
+QUERY_PATTERN = re.compile(r"\?[^\s'\")]*")
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Hatchbuck failed repeatedly, requests are refused for a while"""
+
+
+class Transport:
+    """
+    A pooled keep-alive HTTP session that retries failed requests.
+
+    Connection errors, timeouts of idempotent requests and responses with a
+    status in RETRY_STATUS are retried up to retries times, waiting
+    exponentially longer with full jitter or as long as the Retry-After
+    header asks (up to max_backoff seconds). A Retry-After pauses all
+    threads using the transport. pool_size connections are kept alive, as
+    many as threads send requests at a time.
+    After failure_threshold requests failed in a row the circuit opens and
+    requests fail fast with CircuitOpenError for reset_timeout seconds,
+    then a single request probes whether Hatchbuck is back.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(
+        self,
+        timeout=30,
+        retries=4,
+        backoff=0.5,
+        max_backoff=60,
+        failure_threshold=5,
+        reset_timeout=60,
+        pool_size=10,
+        sleep=time.sleep,
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.sleep = sleep
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.paused_until = 0.0
+
+    def request(self, method, url, idempotent=True, **kwargs):
+        """
+        Send a request, retrying failures
+
+        :param idempotent: False if a request that timed out or got a 502 or
+                           504 may have been processed and must not be sent
+                           again
+        :return: the requests.Response, also for failed requests
+        :raise requests.exceptions.RequestException: no response, or
+               CircuitOpenError
+        """
+        self._enter()
+        attempt = 0
+        while True:
+            self._wait_for_pause()
+            try:
+                response = self.session.request(
+                    method, url, timeout=self.timeout, **kwargs
+                )
+            except requests.exceptions.RequestException as error:
+                retry = isinstance(
+                    error,
+                    (requests.exceptions.ConnectionError, requests.exceptions.Timeout),
+                ) and (idempotent or _unsent(error))
+                if not retry or attempt >= self.retries:
+                    self._failed()
+                    raise
+                logging.warning(
+                    "%s %s failed: %s, retrying",
+                    method,
+                    urlsplit(url).path,
+                    QUERY_PATTERN.sub("", str(error)),
+                )
+                delay = self._backoff(attempt)
+            else:
+                if response.status_code not in RETRY_STATUS:
+                    self._succeeded()
+                    return response
+                retry = idempotent or response.status_code in REFUSED_STATUS
+                if not retry or attempt >= self.retries:
+                    self._failed()
+                    return response
+                delay = _retry_after(response)
+                if delay is None:
+                    delay = self._backoff(attempt)
+                else:
+                    delay = min(delay, self.max_backoff)
+                    self._pause(delay)
+                logging.warning(
+                    "%s %s answered %s, retrying in %.1fs",
+                    method,
+                    urlsplit(url).path,
+                    response.status_code,
+                    delay,
+                )
+            attempt += 1
+            self.sleep(delay)
+
+    def close(self):
+        """Close the pooled connections"""
+        self.session.close()
+
+    def _backoff(self, attempt):
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def _pause(self, delay):
+        """Hold back the requests of all threads for delay seconds"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def _wait_for_pause(self):
+        """Wait until a Retry-After of any thread has passed"""
+        while True:
+            with self.lock:
+                wait = self.paused_until - time.monotonic()
+            if wait <= 0:
+                return
+            self.sleep(wait)
+
+    def _enter(self):
+        """Fail fast while the circuit is open, let one probe through after"""
+        with self.lock:
+            if self.opened is None:
+                return
+            if self.probing or time.monotonic() - self.opened < self.reset_timeout:
+                raise CircuitOpenError("Hatchbuck is failing, not sending requests")
+            self.probing = True
+
+    def _succeeded(self):
+        """Close the circuit"""
+        with self.lock:
+            if self.opened is not None:
+                logging.info("Hatchbuck is back, circuit closed")
+            self.failures = 0
+            self.opened = None
+            self.probing = False
+
+    def _failed(self):
+        """Count a failed request, open the circuit after too many"""
+        with self.lock:
+            self.failures += 1
+            if self.probing or (
+                self.opened is None and self.failures >= self.failure_threshold
+            ):
+                logging.error(
+                    "%s Hatchbuck requests failed, pausing for %ss",
+                    self.failures,
+                    self.reset_timeout,
+                )
+                self.opened = time.monotonic()
+            self.probing = False
+
+
+def _unsent(error):
+    """Return True if a request failed before it reached the server"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def _retry_after(response):
+    """Return the seconds a Retry-After header asks to wait, None if absent"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
@@ -0,0 +1,167 @@
+"""
+A fast vCard tokenizer reading only the properties the sync maps.
+
+tokenize_card unfolds the lines of a vCard 3.0 or 4.0 and decodes the
+parameters and values of the mapped properties the way vobject does, all
+other properties are only listed by name. Cards using anything it doesn't
+handle exactly like vobject (quoted-printable, quoted parameters, backslash
+escapes in mapped values, nested components, ...) are left to vobject.
+"""
+import codecs
+import collections
+import re
+
+# properties read by normalize.normalize_contents
+MAPPED = frozenset(
+    (
+        "uid",
+        "n",
+        "email",
+        "tel",
+        "adr",
+        "title",
+        "org",
+        "url",
+        "bday",
+        "x-skype",
+        "x-msn",
+        "x-msnim",
+        "x-twitter",
+        "x-socialprofile",
+    )
+)
+# binary properties vobject decodes, only checked for decoding errors
+BINARY = frozenset(("photo", "logo", "sound", "key"))
+
+Name = collections.namedtuple(
+    "Name", ("family", "given", "additional", "prefix", "suffix")
+)
+Address = collections.namedtuple(
+    "Address", ("box", "extended", "street", "city", "region", "code", "country")
+)
+
+# a line break followed by a space or tab continues the previous line
+FOLD_PATTERN = re.compile(r"(?:\r\n|\r|\n)[\t ]")
+LINE_END_PATTERN = re.compile(r"\r\n|\r|\n")
+# group, name, parameters without quotes, value
+LINE_PATTERN = re.compile(
+    r"(?:[A-Za-z0-9_-]+\.)?([A-Za-z0-9_-]+)"
+    r"((?:;[A-Za-z0-9_-]+(?:=[^\";:,]*(?:,[^\";:,]*)*)?)*)"
+    r":(.*)",
+    re.DOTALL,
+)
+
+
+class Property:  # pylint: disable=too-few-public-methods
+    """A content line with the attributes of vobject's ContentLine we read"""
+
+    __slots__ = ("value", "params", "singletons")
+
+    def __init__(self, value, params, singletons):
+        self.value = value
+        self.params = params
+        self.singletons = singletons
+
+    @property
+    def type_paramlist(self):
+        """The values of the TYPE parameters, AttributeError without any"""
+        try:
+            return self.params["TYPE"]
+        except KeyError:
+            raise AttributeError("type_paramlist") from None
+
+
+def tokenize_card(text):
+    """
+    Extract the mapped properties of a vCard
+
+    :param text: a single vCard
+    :return: dict of lower case property names to lists of Property like
+             vobject's contents, all other names with empty lists; None if
+             the card must be parsed by vobject
+    """
+    if "QUOTED-PRINTABLE" in text.upper():
+        return None
+    lines = [
+        line for line in LINE_END_PATTERN.split(FOLD_PATTERN.sub("", text)) if line
+    ]
+    if (
+        len(lines) < 2
+        or lines[0].upper() != "BEGIN:VCARD"
+        or lines[-1].upper() != "END:VCARD"
+    ):
+        return None
+    content = {}
+    for line in lines[1:-1]:
+        match = LINE_PATTERN.fullmatch(line)
+        if match is None:
+            return None
+        name, params, value = match.groups()
+        name = name.replace("_", "-").lower()
+        if name in ("begin", "end"):
+            return None
+        properties = content.setdefault(name, [])
+        if name not in MAPPED and not (params and name in BINARY):
+            continue
+        prop = _property(params, value)
+        if name in BINARY:
+            _check_binary(prop)
+            continue
+        if "\\" in value or "ENCODING" in prop.params or "BASE64" in prop.singletons:
+            return None
+        properties.append(_decode(name, prop))
+    return content
+
+
+def _property(params, value):
+    """Decode the parameters of a content line"""
+    named = {}
+    singletons = []
+    for param in params.split(";")[1:]:
+        name, _, values = param.partition("=")
+        values = [item for item in values.split(",") if item]
+        if values:
+            named.setdefault(name.upper(), []).extend(values)
+        else:
+            singletons.append(name)
+    return Property(value, named, singletons)
+
+
+def _check_binary(prop):
+    """Raise binascii.Error for a broken base64 value like vobject"""
+    encoding = prop.params.get("ENCODING", [None])
+    if "BASE64" in prop.singletons or encoding and encoding[0]:
+        codecs.decode(prop.value.encode("utf-8"), "base64")
+
+
+def _decode(name, prop):
+    """Turn the value into the native value vobject would return"""
+    if name == "n":
+        prop.value = Name(*_fields(prop.value, Name._fields))
+    elif name == "adr":
+        prop.value = Address(*_fields(prop.value, Address._fields))
+    elif name == "org":
+        prop.value = [_list_or_string(field) for field in _split(prop.value, ";")]
+    else:
+        prop.value = _split(prop.value, ",")[0]
+    return prop
+
+
+def _fields(value, names):
+    """Split a structured value, missing fields are empty"""
+    fields = [_list_or_string(field) for field in _split(value, ";")]
+    return (fields + [""] * len(names))[: len(names)]
+
+
+def _list_or_string(value):
+    """A field of a structured value, a list if it has several values"""
+    values = _split(value, ",")
+    return values[0] if len(values) == 1 else values
+
+
+def _split(value, separator):
+    """Split an unescaped value like vobject, ignoring a trailing separator"""
+    values = value.split(separator)
+    if len(values) > 1 and not values[-1]:
+        values.pop()
+    return values
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+Benchmark of HatchbuckParser against a local Hatchbuck stand-in
+
+Generates a synthetic address book, syncs it to FakeHatchbuckServer and
+reports cards/sec, API calls per card, peak RSS and the time per stage.
+
+    python tests/benchmark.py --cards 1000 --latency 0.02 --workers 8
+
+With --startup it reports the slowest imports of the command line help.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+from carddav2hatchbuck import carddavsync  # noqa: E402
+from carddav2hatchbuck.carddavsync import HatchbuckParser  # noqa: E402
+from fake_hatchbuck import FakeHatchbuckServer  # noqa: E402
+
+FIRST_NAMES = ["Anna", "Beat", "Chantal", "Daniel", "Eva", "Fritz", "Gina", "Hans"]
+LAST_NAMES = ["Meier", "Müller", "Schmid", "Keller", "Weber", "Huber", "Graf"]
+STREETS = ["Bahnhofstrasse", "Hauptstrasse", "Dorfstrasse", "Seestrasse"]
+CITIES = [("8001", "Zürich", "Switzerland"), ("3011", "Bern", "Switzerland")]
+CITIES += [("10115", "Berlin", "Germany"), ("1010", "Wien", "Austria")]
+
+# the same numbers written the ways people write them into address books
+PHONE_FORMATS = [
+    "+41 44 {a} {b} {c}",
+    "+41{a}{b}{c}44",
+    "0041 44 {a} {b} {c}",
+    "+0041 (44) {a}-{b}-{c}",
+    "044 {a} {b} {c}",
+    "(044) {a}-{b}-{c}",
+    "044\xa0{a}\xa0{b}\xa0{c}",
+]
+
+# packages only syncing needs, the command line interface must not import them
+SYNC_IMPORTS = (
+    "hatchbuck",
+    "phonenumbers",
+    "pycountry",
+    "requests",
+    "rocketchat_API",
+    "sentry_sdk",
+    "vobject",
+)
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def generate_corpus(
+    directory,
+    cards=100,
+    emails=1,
+    phones=2,
+    addresses=1,
+    duplicates=0.1,
+    cards_per_file=1,
+    seed=1,
+):
+    """
+    Write a synthetic address book of vcf files
+
+    :param cards: number of vCards
+    :param emails, phones, addresses: number of each per card
+    :param duplicates: share of cards repeating the email of an earlier card
+    :param cards_per_file: vCards per vcf file
+    :return: list of the written files
+    """
+    rand = random.Random(seed)
+    vcards = []
+    people = []
+    for index in range(cards):
+        person = index
+        if index and rand.random() < duplicates:
+            person = rand.randrange(index)
+            first, last = people[person]
+        else:
+            first, last = rand.choice(FIRST_NAMES), rand.choice(LAST_NAMES)
+        people.append((first, last))
+        lines = [
+            "BEGIN:VCARD",
+            "VERSION:3.0",
+            "UID:card-%s" % index,
+            "N:%s;%s;;;" % (last, first),
+            "FN:%s %s" % (first, last),
+            "ORG:Firma %s" % (person % 17),
+        ]
+        for number in range(emails):
+            lines.append(
+                "EMAIL;TYPE=%s:%s.%s.%s@example%s.com"
+                % (rand.choice(["WORK", "HOME"]), first, person, number, number)
+            )
+        for _ in range(phones):
+            lines.append(
+                "TEL;TYPE=%s:%s"
+                % (
+                    rand.choice(["WORK", "HOME", "CELL"]),
+                    rand.choice(PHONE_FORMATS).format(
+                        a=rand.randint(100, 999),
+                        b=rand.randint(10, 99),
+                        c=rand.randint(10, 99),
+                    ),
+                )
+            )
+        for _ in range(addresses):
+            zip_code, city, country = rand.choice(CITIES)
+            lines.append(
+                "ADR;TYPE=WORK:;;%s %s;%s;;%s;%s"
+                % (rand.choice(STREETS), rand.randint(1, 99), city, zip_code, country)
+            )
+        lines.append("END:VCARD")
+        vcards.append("\r\n".join(lines) + "\r\n")
+
+    files = []
+    for start in range(0, len(vcards), cards_per_file):
+        path = os.path.join(directory, "card-%05d.vcf" % start)
+        with open(path, "w", encoding="utf-8") as file:
+            file.write("".join(vcards[start : start + cards_per_file]))
+        files.append(path)
+    return files
+
+
+class TimedParser(HatchbuckParser):
+    """HatchbuckParser adding up the time spent per stage"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings = {"read": 0.0, "normalize": 0.0, "resolve": 0.0, "sync": 0.0}
+
+    def timed(self, stage, items):
+        """Add the time spent producing the items to the stage"""
+        items = iter(items)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                elapsed = time.perf_counter() - started
+                with self.lock:
+                    self.timings[stage] += elapsed
+            yield item
+
+    def read_cards(self):
+        """Time reading the files"""
+        return self.timed("read", super().read_cards())
+
+    def normalize(self, cards):
+        """Time parsing the cards, reading time excluded"""
+        stage = self.timed("normalize", super().normalize(cards))
+        read_before = self.timings["read"]
+        for item in stage:
+            yield item
+        self.timings["normalize"] -= self.timings["read"] - read_before
+
+    def resolve_emails(self, entries):
+        """Time the email lookups"""
+        started = time.perf_counter()
+        super().resolve_emails(entries)
+        self.timings["resolve"] += time.perf_counter() - started
+
+    def sync_entry(self, entry):
+        """Time syncing a card"""
+        started = time.perf_counter()
+        try:
+            return super().sync_entry(entry)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.timings["sync"] += elapsed
+
+
+class BenchmarkArgs(argparse.Namespace):
+    """The command line arguments HatchbuckParser needs"""
+
+    def __init__(self, files, **kwargs):
+        super().__init__(
+            hatchbuck="benchmark",
+            source="benchmark-source",
+            tag="Adressbuch-benchmark",
+            user="bench.mark",
+            verbose=False,
+            update=True,
+            noop=False,
+            state=None,
+            workers=1,
+            books=1,
+            processes=1,
+            rate=None,
+            mirror=False,
+            mirror_ttl=86400,
+            initial_import=False,
+            timeout=30,
+            retries=4,
+            plan=None,
+            apply=None,
+            fast_vcard=False,
+            profile=None,
+            profile_top=20,
+            profile_stats=None,
+            file=files,
+            dir=[],
+        )
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+def run_benchmark(files, server, **options):
+    """
+    Sync the files to the server and measure the run
+
+    :param options: HatchbuckParser arguments, e.g. workers or state
+    :return: dict with cards, seconds, cards_per_sec, api_calls,
+             calls_per_card, requests, stages, process_peak_rss_kb, stats and
+             the metrics of the run
+    """
+    args = BenchmarkArgs(files, **options)
+    parser = TimedParser(args)
+    parser.init_hatchbuck()
+    parser.hatchbuck.url = server.url
+    calls_before = server.api_calls()
+    requests_before = dict(server.requests)
+
+    started = time.perf_counter()
+    with mock.patch.object(carddavsync, "NotificationService"):
+        parser.main()
+    seconds = time.perf_counter() - started
+
+    cards = 0
+    for file in files:
+        with open(file, encoding="utf-8") as handle:
+            cards += sum(1 for line in handle if line.strip() == "BEGIN:VCARD")
+    api_calls = server.api_calls() - calls_before
+    return {
+        "cards": cards,
+        "seconds": round(seconds, 3),
+        "cards_per_sec": round(cards / seconds, 1) if seconds else None,
+        "api_calls": api_calls,
+        "calls_per_card": round(api_calls / cards, 2) if cards else None,
+        "requests": {
+            key: count - requests_before.get(key, 0)
+            for key, count in server.requests.items()
+            if count - requests_before.get(key, 0)
+        },
+        "stages": {key: round(value, 3) for key, value in parser.timings.items()},
+        # high-water mark of the whole process, not of this run alone
+        "process_peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "stats": {
+            key: parser.stats[key]
+            for key in (
+                "valid",
+                "noname",
+                "noemail",
+                "imported",
+                "created",
+                "updated",
+                "unchanged",
+            )
+            if key in parser.stats
+        },
+        "metrics": parser.metrics.to_dict(),
+    }
+
+
+def import_times(*argv):
+    """
+    Run python with argv and measure the imports
+
+    :return: dict of module name to cumulative import time in microseconds
+             as reported by python -X importtime
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime"] + list(argv),
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=False,
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1])
+    return times
+
+
+def main():
+    """Generate a corpus, sync it twice (create, then update) and report"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cards", type=int, default=500)
+    parser.add_argument("--emails", type=int, default=1)
+    parser.add_argument("--phones", type=int, default=2)
+    parser.add_argument("--addresses", type=int, default=1)
+    parser.add_argument("--duplicates", type=float, default=0.1)
+    parser.add_argument("--cards-per-file", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--state", action="store_true", help="use a sync state")
+    parser.add_argument(
+        "--fast-vcard", action="store_true", help="use the fast vCard tokenizer"
+    )
+    parser.add_argument(
+        "--startup", action="store_true", help="report the imports of --help"
+    )
+    options = parser.parse_args()
+    if options.startup:
+        times = import_times("-m", "carddav2hatchbuck.sync", "--help")
+        slowest = sorted(times.items(), key=lambda item: item[1], reverse=True)
+        print(json.dumps({"startup_us": dict(slowest[:20])}, indent=2))
+        return
+    # the sync warns about every unparsable phone number
+    logging.getLogger().setLevel(logging.ERROR)
+
+    server = FakeHatchbuckServer(latency=options.latency).start()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            files = generate_corpus(
+                directory,
+                cards=options.cards,
+                emails=options.emails,
+                phones=options.phones,
+                addresses=options.addresses,
+                duplicates=options.duplicates,
+                cards_per_file=options.cards_per_file,
+            )
+            state = os.path.join(directory, "state.sqlite") if options.state else None
+            for run in ("create", "update"):
+                result = run_benchmark(
+                    files,
+                    server,
+                    workers=options.workers,
+                    processes=options.processes,
+                    state=state,
+                    fast_vcard=options.fast_vcard,
+                )
+                print(json.dumps({run: result}, indent=2, sort_keys=True))
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
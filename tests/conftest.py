@@ -0,0 +1,13 @@
+"""
+Fixtures shared by the tests
+"""
+import pytest
+from fake_hatchbuck import FakeHatchbuckServer
+
+
+@pytest.fixture(name="server")
+def fixture_server():
+    """Run the Hatchbuck stand-in in a thread"""
+    server = FakeHatchbuckServer().start()
+    yield server
+    server.stop()
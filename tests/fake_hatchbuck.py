@@ -0,0 +1,275 @@
+"""
+A local stand-in for the Hatchbuck REST API, for tests and benchmarks
+
+Implements the endpoints used by the hatchbuck bindings (contact search,
+create, update and tags), injects a fixed latency per request and faults
+(error responses, slow responses, dropped connections) and counts the
+requests per endpoint and the connections.
+"""
+import collections
+import copy
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from hatchbuck import Hatchbuck
+
+
+class FakeHatchbuckServer(ThreadingMixIn, HTTPServer):
+    """
+    In-memory Hatchbuck contact store served over HTTP
+
+    Use url as Hatchbuck.url of the client under test.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0):
+        super().__init__(("127.0.0.1", 0), FakeHatchbuckHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.contacts = {}
+        self.requests = collections.Counter()
+        self.connections = 0
+        self.faults = collections.deque()
+        self.ids = itertools.count(1)
+        countries = Hatchbuck("")
+        countries._country_lookup(None)  # pylint: disable=protected-access
+        self.country_ids = {
+            name: key for key, name in countries.hatchbuck_countries.items()
+        }
+        self.thread = None
+
+    @property
+    def url(self):
+        """Base URL of the API"""
+        return "http://127.0.0.1:%s/api/v1/" % self.server_port
+
+    def start(self):
+        """Serve requests in a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket"""
+        self.shutdown()
+        self.server_close()
+
+    def inject(  # pylint: disable=too-many-arguments
+        self,
+        status=None,
+        retry_after=None,
+        delay=0.0,
+        drop=False,
+        times=1,
+        request=None,
+    ):
+        """
+        Let the next requests fail
+
+        :param status: respond with this status instead of handling the request
+        :param retry_after: value of the Retry-After header of the response
+        :param delay: seconds to wait before handling the request
+        :param drop: close the connection without responding
+        :param times: number of requests to fail this way
+        :param request: only fail requests counted under this key, like
+                        "PUT contact", instead of the next requests of any kind
+        """
+        with self.lock:
+            for _ in range(times):
+                self.faults.append((request, status, retry_after, delay, drop))
+
+    def api_calls(self):
+        """Total number of API requests served"""
+        return sum(self.requests.values())
+
+    def add_contact(self, profile):
+        """Store a contact, assigning ids like Hatchbuck does"""
+        with self.lock:
+            contact_id = "contact-%s" % next(self.ids)
+            contact = {
+                "contactId": contact_id,
+                "contactUrl": "https://app.hatchbuck.com/Contact/%s" % contact_id,
+                "firstName": "",
+                "lastName": "",
+                "emails": [],
+                "phones": [],
+                "addresses": [],
+                "tags": [],
+            }
+            self._merge(contact, profile)
+            self.contacts[contact_id] = contact
+            return copy.deepcopy(contact)
+
+    def update_contact(self, update):
+        """Apply an update to a stored contact, None if it doesn't exist"""
+        with self.lock:
+            contact = self.contacts.get(update.get("contactId"))
+            if contact is None:
+                return None
+            self._merge(contact, update)
+            return copy.deepcopy(contact)
+
+    def search(self, query):
+        """Return the contact with the contactId or having one of the emails"""
+        addresses = set(email["address"].lower() for email in query.get("emails", []))
+        with self.lock:
+            if "contactId" in query:
+                contact = self.contacts.get(query["contactId"])
+                return [copy.deepcopy(contact)] if contact else []
+            return [
+                copy.deepcopy(contact)
+                for contact in self.contacts.values()
+                if any(
+                    email["address"].lower() in addresses for email in contact["emails"]
+                )
+            ]
+
+    def add_tags(self, contact_id, tags):
+        """Add tags to a stored contact, False if it doesn't exist"""
+        with self.lock:
+            contact = self.contacts.get(contact_id)
+            if contact is None:
+                return False
+            for tag in tags:
+                if tag not in contact["tags"]:
+                    contact["tags"].append(tag)
+            return True
+
+    def _merge(self, contact, update):
+        """Apply the fields of an update like the Hatchbuck API"""
+        for key, value in update.items():
+            if key in ("contactId", "contactUrl"):
+                continue
+            if isinstance(value, list) and all(isinstance(item, str) for item in value):
+                # text fields like company, vobject splits ORG into a list
+                contact[key] = ";".join(value)
+                continue
+            if not isinstance(value, list):
+                contact[key] = value
+                continue
+            items = contact.setdefault(key, [])
+            for item in value:
+                item = self._store_country(dict(item))
+                existing = [old for old in items if item.get("id") == old.get("id")]
+                if not item.get("id") or not existing:
+                    item["id"] = "%s-%s" % (key, next(self.ids))
+                    items.append(item)
+                elif all(
+                    field in ("id", "type") or not val for field, val in item.items()
+                ):
+                    # empty fields delete the entry
+                    items.remove(existing[0])
+                else:
+                    existing[0].update(item)
+
+    def _store_country(self, item):
+        """Hatchbuck stores country ids instead of country names"""
+        if "country" in item:
+            item["countryId"] = self.country_ids.get(item.pop("country"))
+        return item
+
+
+class FakeHatchbuckHandler(BaseHTTPRequestHandler):
+    """Answers the Hatchbuck API requests"""
+
+    # keep-alive, without waiting for delayed ACKs between header and body
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Keep the output clean"""
+
+    def setup(self):
+        """Count the connections"""
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def respond(self, status, body=None, headers=None):
+        """Send a JSON response"""
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def endpoint(self):
+        """
+        Count the request, wait for the latency and parse path and body
+
+        :return: name, path parts and body, None if a fault was injected
+        """
+        path = self.path.split("?")[0]
+        parts = path.split("/")[3:]
+        if len(parts) == 3 and parts[2] == "Tags":
+            name = "tags"
+        else:
+            name = "/".join(parts)
+        key = "%s %s" % (self.command, name)
+        with self.server.lock:
+            self.server.requests[key] += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length).decode("utf-8")) if length else None
+        with self.server.lock:
+            fault = next(
+                (
+                    fault
+                    for fault in self.server.faults
+                    if fault[0] is None or fault[0] == key
+                ),
+                None,
+            )
+            if fault is not None:
+                self.server.faults.remove(fault)
+        if fault is None:
+            return name, parts, body
+        _, status, retry_after, delay, drop = fault
+        time.sleep(delay)
+        if drop:
+            self.close_connection = True
+            return None
+        if status is None:
+            return name, parts, body
+        headers = {"Retry-After": str(retry_after)} if retry_after is not None else {}
+        self.respond(status, {"error": "injected"}, headers)
+        return None
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Search, create contacts and add tags"""
+        request = self.endpoint()
+        if request is None:
+            return
+        name, parts, body = request
+        if name == "contact/search":
+            found = self.server.search(body)
+            self.respond(200 if found else 404, found)
+        elif name == "contact":
+            self.respond(200, self.server.add_contact(body))
+        elif name == "tags":
+            self.respond(201 if self.server.add_tags(parts[1], body) else 404, None)
+        else:
+            self.respond(404)
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        """Update contacts"""
+        request = self.endpoint()
+        if request is None:
+            return
+        name, _, body = request
+        updated = self.server.update_contact(body) if name == "contact" else None
+        self.respond(200 if updated else 400, updated)
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        """Tags are counted but not removed"""
+        if self.endpoint() is not None:
+            self.respond(201)
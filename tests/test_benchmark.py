@@ -0,0 +1,268 @@
+"""
+Throughput guards using the benchmark harness and the Hatchbuck stand-in
+"""
+import pstats
+import sys
+
+import pytest
+from benchmark import SYNC_IMPORTS, generate_corpus, import_times, run_benchmark
+from fake_hatchbuck import FakeHatchbuckServer
+
+from carddav2hatchbuck import carddavsync
+from carddav2hatchbuck.state import SyncState
+
+
+def test_generate_corpus(tmp_path):
+    """
+    The corpus has the requested number of cards, files and fields
+    """
+    files = generate_corpus(
+        str(tmp_path), cards=10, emails=2, phones=3, addresses=1, cards_per_file=4
+    )
+    assert len(files) == 3
+    text = ""
+    for file in files:
+        with open(file, encoding="utf-8", newline="") as handle:
+            text += handle.read()
+    assert text.count("BEGIN:VCARD") == 10
+    assert text.count("\r\nEMAIL;") == 20
+    assert text.count("\r\nTEL;") == 30
+    assert text.count("\r\nADR;") == 10
+
+
+def test_api_calls_per_card(server, tmp_path):
+    """
+    New cards cost a search and a create, changed cards a single update,
+    unchanged cards no API calls at all
+    """
+    files = generate_corpus(str(tmp_path), cards=20, duplicates=0, cards_per_file=5)
+    state = str(tmp_path / "state.sqlite")
+
+    created = run_benchmark(files, server)
+    assert created["cards"] == 20
+    assert created["requests"] == {"POST contact/search": 20, "POST contact": 20}
+    assert created["stats"]["created"] == 20
+
+    # the created contacts lack phones, addresses and the tag
+    updated = run_benchmark(files, server, workers=4, state=state)
+    assert updated["requests"] == {
+        "POST contact/search": 20,
+        "PUT contact": 20,
+        "POST tags": 20,
+    }
+    assert updated["stats"]["updated"] == 20
+    assert set(updated["stages"]) == {"read", "normalize", "resolve", "sync"}
+    latency = updated["metrics"]["histograms"]["carddav2hatchbuck_api_request_seconds"]
+    assert sorted((item["labels"]["endpoint"], item["count"]) for item in latency) == [
+        ("add_tag", 20),
+        ("search", 20),
+        ("update", 20),
+    ]
+    assert updated["process_peak_rss_kb"] > 0
+
+    unchanged = run_benchmark(files, server, state=state)
+    assert unchanged["stats"] == {"unchanged": 20}
+    assert unchanged["api_calls"] == 0
+
+
+def test_refused_updates_are_retried(server, tmp_path):
+    """
+    Cards whose update Hatchbuck refused are synced again in the next run
+    """
+    files = generate_corpus(str(tmp_path), cards=1, duplicates=0)
+    state = str(tmp_path / "state.sqlite")
+    run_benchmark(files, server)
+
+    server.inject(status=400, request="PUT contact")
+    refused = run_benchmark(files, server, state=state)
+    assert refused["requests"]["PUT contact"] == 1
+
+    retried = run_benchmark(files, server, state=state)
+    assert retried["requests"]["PUT contact"] == 1
+
+    unchanged = run_benchmark(files, server, state=state)
+    assert unchanged["api_calls"] == 0
+
+
+def test_contacts_are_updated_by_one_card_at_a_time(tmp_path):
+    """
+    Cards with different emails of the same contact don't update it at once
+    """
+    server = FakeHatchbuckServer(latency=0.05).start()
+    try:
+        server.add_contact(
+            {
+                "firstName": "Jane",
+                "lastName": "Doe",
+                "emails": [
+                    {"address": "jane@example.com", "type": "Work"},
+                    {"address": "jane.doe@example.com", "type": "Home"},
+                ],
+            }
+        )
+        book = tmp_path / "book.vcf"
+        book.write_text(
+            "".join(
+                "BEGIN:VCARD\r\nVERSION:3.0\r\nUID:%s\r\nN:Doe;Jane;;;\r\n"
+                "FN:Jane Doe\r\nEMAIL;TYPE=WORK:%s\r\nEND:VCARD\r\n" % item
+                for item in (
+                    ("card-1", "jane@example.com"),
+                    ("card-2", "jane.doe@example.com"),
+                )
+            )
+        )
+        result = run_benchmark([str(book)], server, workers=2)
+    finally:
+        server.stop()
+    # the second card sees the contact tagged by the first and writes nothing
+    assert result["requests"] == {"POST contact/search": 2, "POST tags": 1}
+    assert result["stats"] == {"valid": 2, "updated": 1, "unchanged": 1}
+
+
+@pytest.mark.parametrize("chunk_size", [carddavsync.CHUNK_SIZE, 3])
+def test_duplicates_are_searched_once(server, tmp_path, monkeypatch, chunk_size):
+    """
+    Every distinct email address is searched once per run, also if cards
+    sharing it are synced in different chunks
+    """
+    monkeypatch.setattr(carddavsync, "CHUNK_SIZE", chunk_size)
+    files = generate_corpus(str(tmp_path), cards=20, duplicates=0.5)
+    emails = set()
+    for file in files:
+        with open(file, encoding="utf-8") as handle:
+            emails.update(
+                line.split(":", 1)[1].strip().lower()
+                for line in handle
+                if line.startswith("EMAIL")
+            )
+    assert len(emails) < 20
+
+    result = run_benchmark(files, server)
+    assert result["requests"]["POST contact/search"] == len(emails)
+    assert result["requests"]["POST contact"] == len(emails)
+
+
+def test_mirror_saves_searches(server, tmp_path):
+    """
+    With the mirror, changed cards of contacts synced before cost no search
+    """
+    files = generate_corpus(str(tmp_path), cards=20, duplicates=0)
+    state = str(tmp_path / "state.sqlite")
+
+    created = run_benchmark(files, server, state=state, mirror=True)
+    assert created["requests"]["POST contact/search"] == 20
+
+    for file in files:
+        with open(file, encoding="utf-8", newline="") as handle:
+            text = handle.read()
+        with open(file, "w", encoding="utf-8", newline="") as handle:
+            handle.write(text.replace("ORG:Firma", "ORG:Company"))
+    updated = run_benchmark(files, server, state=state, mirror=True)
+    assert "POST contact/search" not in updated["requests"]
+    assert updated["stats"]["updated"] == 20
+
+
+@pytest.mark.parametrize("chunk_size", [carddavsync.CHUNK_SIZE, 3])
+def test_initial_import(server, tmp_path, monkeypatch, chunk_size):
+    """
+    The initial import creates every person once, an interrupted import
+    doesn't create the contacts created before again
+    """
+    monkeypatch.setattr(carddavsync, "CHUNK_SIZE", chunk_size)
+    files = generate_corpus(str(tmp_path), cards=20, duplicates=0.5)
+    state_file = str(tmp_path / "state.sqlite")
+
+    # interrupted after creating the first contact, before the checkpoint
+    with open(files[0], encoding="utf-8") as handle:
+        email = [line for line in handle if line.startswith("EMAIL")][0]
+    email = email.split(":", 1)[1].strip()
+    server.add_contact({"emails": [{"address": email, "type": "Work"}]})
+    state = SyncState(state_file)
+    state.save_import([email.lower()])
+    state.close()
+
+    result = run_benchmark(
+        files, server, workers=4, state=state_file, initial_import=True
+    )
+    assert result["stats"]["imported"] == result["requests"]["POST contact"]
+    assert len(server.contacts) == result["stats"]["imported"] + 1
+    assert "created" not in result["stats"]
+    assert result["stats"]["updated"] == 20
+    state = SyncState(state_file)
+    assert state.import_checkpoint([email.lower()]) == (False, None)
+    state.close()
+
+
+def test_cards_are_streamed(server, tmp_path, monkeypatch):
+    """
+    Cards are synced while the following cards are still being parsed
+    """
+    monkeypatch.setattr(carddavsync, "CHUNK_SIZE", 5)
+    normalized = []
+    synced = []
+    normalize_entry = carddavsync.normalize_entry
+    sync_entry = carddavsync.HatchbuckParser.sync_entry
+
+    def count_normalized(card, fast=False):
+        normalized.append(card)
+        return normalize_entry(card, fast)
+
+    def count_synced(parser, entry):
+        synced.append(len(normalized))
+        return sync_entry(parser, entry)
+
+    monkeypatch.setattr(carddavsync, "normalize_entry", count_normalized)
+    monkeypatch.setattr(carddavsync.HatchbuckParser, "sync_entry", count_synced)
+    files = generate_corpus(str(tmp_path), cards=20, duplicates=0)
+    run_benchmark(files, server)
+
+    assert len(synced) == 20
+    assert max(count - index for index, count in enumerate(synced)) <= 5
+
+
+def test_slowest_cards_report(server, tmp_path):
+    """
+    The profile lists the slowest cards with their API requests and phases
+    """
+    (tmp_path / "small").mkdir()
+    (tmp_path / "big").mkdir()
+    files = generate_corpus(str(tmp_path / "small"), cards=10, phones=1, duplicates=0)
+    files += generate_corpus(str(tmp_path / "big"), cards=1, phones=40, seed=2)
+    report = tmp_path / "slowest.tsv"
+    stats = tmp_path / "sync.pstats"
+
+    run_benchmark(
+        files, server, profile=str(report), profile_top=11, profile_stats=str(stats)
+    )
+    lines = report.read_text().splitlines()
+    assert lines[0] == "11 slowest of 11 cards"
+    header = lines[1].split("\t")
+    rows = [dict(zip(header, line.split("\t"))) for line in lines[2:]]
+    assert [float(row["seconds"]) for row in rows] == sorted(
+        (float(row["seconds"]) for row in rows), reverse=True
+    )
+    # the searches are sent for all cards before syncing them
+    assert {row["requests"] for row in rows} == {"1"}
+    slowest_phones = max(rows, key=lambda row: float(row["phones"]))
+    assert slowest_phones["file"] == files[-1]
+    assert pstats.Stats(str(stats)).total_calls > 0
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="needs python -X importtime")
+@pytest.mark.parametrize(
+    "argv",
+    [
+        ["-c", "import carddav2hatchbuck.sync, carddav2hatchbuck.carddavsync"],
+        ["-m", "carddav2hatchbuck.sync", "--help"],
+        ["-m", "carddav2hatchbuck.carddavsync", "--help"],
+    ],
+)
+def test_startup_imports(argv):
+    """
+    The command line help doesn't wait for the packages only syncing needs
+    """
+    times = import_times(*argv)
+    assert "carddav2hatchbuck.cli" in times
+    assert (
+        sorted(module for module in times if module.split(".")[0] in SYNC_IMPORTS) == []
+    )
@@ -0,0 +1,193 @@
+"""
+Tests for module "carddav", using a local stand-in CardDAV server
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from carddav2hatchbuck.carddav import CardDAVClient, fetch_address_books
+from carddav2hatchbuck.state import SyncState
+
+BOOK = "/dav/jane_x_doe_y/"
+
+
+def vcard(uid, name):
+    """A minimal vCard"""
+    return "BEGIN:VCARD\r\nVERSION:3.0\r\nUID:%s\r\nFN:%s\r\nEND:VCARD\r\n" % (
+        uid,
+        name,
+    )
+
+
+class CardDAVServer(HTTPServer):
+    """
+    An in-memory CardDAV server with a single address book.
+
+    Every change increases the version, which is used as ctag, sync token
+    and ETag of the changed card.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), CardDAVHandler)
+        self.cards = {}
+        self.log = []
+        self.version = 0
+        self.requests = []
+
+    def put(self, name, text):
+        """Add or change a card"""
+        self.version += 1
+        self.cards[BOOK + name] = (str(self.version), text)
+        self.log.append((self.version, BOOK + name))
+
+    def delete(self, name):
+        """Delete a card"""
+        self.version += 1
+        del self.cards[BOOK + name]
+        self.log.append((self.version, BOOK + name))
+
+
+class CardDAVHandler(BaseHTTPRequestHandler):
+    """Answers the PROPFIND and REPORT requests of CardDAVClient"""
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Keep the test output clean"""
+
+    def respond(self, responses, token=""):
+        """Send a multistatus response"""
+        body = (
+            '<?xml version="1.0"?><d:multistatus xmlns:d="DAV:"'
+            ' xmlns:c="urn:ietf:params:xml:ns:carddav"'
+            ' xmlns:cs="http://calendarserver.org/ns/">%s%s</d:multistatus>'
+            % ("".join(responses), token)
+        ).encode("utf-8")
+        self.send_response(207)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def ok(href, prop):
+        """A response element with status 200"""
+        return (
+            "<d:response><d:href>%s</d:href><d:propstat><d:prop>%s</d:prop>"
+            "<d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>"
+            % (href, prop)
+        )
+
+    def do_PROPFIND(self):  # pylint: disable=invalid-name
+        """List the address books or the ETags of the cards"""
+        server = self.server
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        server.requests.append(("PROPFIND", self.path))
+        if self.path == "/dav/":
+            self.respond(
+                [
+                    self.ok(
+                        "/dav/", "<d:resourcetype><d:collection/></d:resourcetype>"
+                    ),
+                    self.ok(
+                        BOOK,
+                        "<d:resourcetype><d:collection/><c:addressbook/>"
+                        "</d:resourcetype><cs:getctag>%s</cs:getctag>"
+                        "<d:sync-token>%s</d:sync-token>"
+                        % (server.version, server.version),
+                    ),
+                ]
+            )
+        else:
+            assert "getetag" in body
+            self.respond(
+                [self.ok(BOOK, "")]
+                + [
+                    self.ok(href, "<d:getetag>%s</d:getetag>" % etag)
+                    for href, (etag, _) in server.cards.items()
+                ]
+            )
+
+    def do_REPORT(self):  # pylint: disable=invalid-name
+        """Answer addressbook-multiget and sync-collection reports"""
+        server = self.server
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        if "sync-collection" in body:
+            token = int(body.split("<d:sync-token>")[1].split("<")[0])
+            server.requests.append(("sync-collection", token))
+            responses = []
+            for href in sorted(
+                set(href for version, href in server.log if version > token)
+            ):
+                if href in server.cards:
+                    responses.append(
+                        self.ok(
+                            href, "<d:getetag>%s</d:getetag>" % server.cards[href][0]
+                        )
+                    )
+                else:
+                    responses.append(
+                        "<d:response><d:href>%s</d:href>"
+                        "<d:status>HTTP/1.1 404 Not Found</d:status></d:response>"
+                        % href
+                    )
+            self.respond(responses, "<d:sync-token>%s</d:sync-token>" % server.version)
+        else:
+            hrefs = [part.split("</d:href>")[0] for part in body.split("<d:href>")[1:]]
+            server.requests.append(("multiget", sorted(hrefs)))
+            self.respond(
+                [
+                    self.ok(
+                        href,
+                        "<d:getetag>%s</d:getetag><c:address-data>%s</c:address-data>"
+                        % server.cards[href],
+                    )
+                    for href in hrefs
+                ]
+            )
+
+
+@pytest.fixture(name="server")
+def fixture_server():
+    """Run the stand-in CardDAV server in a thread"""
+    server = CardDAVServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_only_changes(server, tmp_path):
+    """
+    Only changed address books and vCards are downloaded
+    """
+    server.put("a.vcf", vcard("a", "Jane Doe"))
+    server.put("b.vcf", vcard("b", "Richard Roe"))
+    client = CardDAVClient(
+        "http://127.0.0.1:%s/dav/" % server.server_port, "user", "pass"
+    )
+    state = SyncState(str(tmp_path / "state.sqlite"))
+    book_dir = tmp_path / "jane_x_doe_y"
+
+    assert fetch_address_books(client, state, str(tmp_path)) == {"jane_x_doe_y": 2}
+    assert sorted(path.name for path in book_dir.iterdir()) == ["a.vcf", "b.vcf"]
+    assert "Richard Roe" in (book_dir / "b.vcf").read_text()
+
+    # nothing changed: the ctag is the same, the cards are not listed
+    del server.requests[:]
+    assert fetch_address_books(client, state, str(tmp_path)) == {"jane_x_doe_y": 0}
+    assert server.requests == [("PROPFIND", "/dav/")]
+
+    # one card changed, one deleted: only the changed card is downloaded
+    server.put("b.vcf", vcard("b", "Richard Roe-Doe"))
+    server.delete("a.vcf")
+    del server.requests[:]
+    assert fetch_address_books(client, state, str(tmp_path)) == {"jane_x_doe_y": 1}
+    assert server.requests == [
+        ("PROPFIND", "/dav/"),
+        ("sync-collection", 2),
+        ("multiget", [BOOK + "b.vcf"]),
+    ]
+    assert sorted(path.name for path in book_dir.iterdir()) == ["b.vcf"]
+    assert "Richard Roe-Doe" in (book_dir / "b.vcf").read_text()
+    state.close()
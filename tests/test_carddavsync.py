@@ -2,6 +2,7 @@
 Tests for module "carddavsync"
 """
 from carddav2hatchbuck.carddavsync import HatchbuckParser
+from carddav2hatchbuck.normalize import normalize_card
 
 
 class HatchbuckArgsMock:  # pylint: disable=too-few-public-methods
@@ -17,12 +18,44 @@ class HatchbuckArgsMock:  # pylint: disable=too-few-public-methods
     source = None
     dir = None
     file = None
+    tag = None
+    user = None
+    state = None
+    workers = 1
+    books = 1
+    processes = 1
+    rate = None
+    mirror = False
+    initial_import = False
+    timeout = 30
+    retries = 4
+    plan = None
+    fast_vcard = False
+    profile = None
+    profile_top = 20
+    profile_stats = None
+    apply = None
 
     def __str__(self):
         """Show the content of this class nicely when printed"""
         return str(self.__dict__)
 
 
+class HatchbuckMock:  # pylint: disable=too-few-public-methods
+    """
+    Replacement for the Hatchbuck client recording the email searches
+    """
+
+    def __init__(self, contacts):
+        self.contacts = contacts
+        self.searches = []
+
+    def search_email(self, email):
+        """Return the contact stored for the address"""
+        self.searches.append(email)
+        return self.contacts.get(email.lower())
+
+
 def test_instantion():
     """
     Tests each of two instances, HatchbuckParser and HatchbuckArgs
@@ -32,3 +65,23 @@ def test_instantion():
 
     parser = HatchbuckParser(args)
     assert isinstance(parser, HatchbuckParser)
+
+
+def test_resolve_emails():
+    """
+    Every distinct address of the cards with a name is looked up once
+    """
+    jane = {"contactId": "jane"}
+    hatchbuck = HatchbuckMock({"jane@example.com": jane})
+    parser = HatchbuckParser(HatchbuckArgsMock(), hatchbuck=hatchbuck)
+    cards = (
+        "BEGIN:VCARD\r\nVERSION:3.0\r\nN:Doe;Jane;;;\r\nFN:Jane Doe\r\n"
+        "EMAIL:jane@example.com\r\nEMAIL:john@example.com\r\nEND:VCARD\r\n",
+        "BEGIN:VCARD\r\nVERSION:3.0\r\nN:Doe;Jane;;;\r\nFN:Jane Doe\r\n"
+        "EMAIL:Jane@Example.com\r\nEMAIL:jäne@example.com\r\nEND:VCARD\r\n",
+        "BEGIN:VCARD\r\nVERSION:3.0\r\nFN:Nobody\r\n"
+        "EMAIL:nobody@example.com\r\nEND:VCARD\r\n",
+    )
+    parser.resolve_emails([("book.vcf", normalize_card(card), None) for card in cards])
+    assert sorted(hatchbuck.searches) == ["jane@example.com", "john@example.com"]
+    assert parser.table.contacts == {"jane@example.com": jane, "john@example.com": None}
@@ -0,0 +1,105 @@
+"""
+Tests for module "duplicates"
+"""
+from unittest import mock
+
+from carddav2hatchbuck import carddavsync
+from carddav2hatchbuck.duplicates import DuplicateDetector, UnionFind
+from carddav2hatchbuck.state import SyncState
+
+
+def contact(contact_id, first, last, emails=(), phones=(), company=""):
+    """A Hatchbuck profile"""
+    return {
+        "contactId": contact_id,
+        "contactUrl": "https://app.hatchbuck.com/Contact/%s" % contact_id,
+        "firstName": first,
+        "lastName": last,
+        "company": company,
+        "emails": [{"address": email} for email in emails],
+        "phones": [{"number": phone} for phone in phones],
+    }
+
+
+def test_union_find():
+    """
+    Sets are merged transitively
+    """
+    sets = UnionFind()
+    sets.union("a", "b")
+    sets.union("c", "d")
+    sets.union("b", "d")
+    sets.find("e")
+    assert sorted(sorted(group) for group in sets.groups()) == [
+        ["a", "b", "c", "d"],
+        ["e"],
+    ]
+
+
+def test_clusters():
+    """
+    Contacts sharing an email, a phone and last name or a name and company
+    are clustered across files, contacts only sharing a switchboard aren't
+    """
+    detector = DuplicateDetector()
+    detector.add([contact("1", "Jane", "Doe", ["jane@example.com"])], "a.vcf")
+    detector.add([contact("2", "Jane", "Doe", ["JANE@example.com"])], "b.vcf")
+    detector.add(
+        [contact("3", "J.", "Doe", ["j@example.com"], ["+41 44 123 45 67"])], "c.vcf"
+    )
+    detector.add([contact("4", "Jane", "Doe", phones=["+41441234567"])], "d.vcf")
+    detector.add([contact("5", "Jon", "Roe", phones=["+41441234567"])], "e.vcf")
+    detector.add(
+        [
+            contact("6", "Max", "Muster", company="VSHN"),
+            contact("7", "Max", "Muster", ["max@example.com"]),
+        ],
+        "f.vcf",
+    )
+    detector.add([contact("8", "Max", "Muster", company="vshn ")], "g.vcf")
+
+    assert detector.clusters() == [["1", "2"], ["3", "4"], ["6", "7", "8"]]
+    assert detector.describe(["1", "2"]) == (
+        "Duplicates: Jane Doe (jane@example.com, , "
+        "https://app.hatchbuck.com/Contact/1), Jane Doe (JANE@example.com, , "
+        "https://app.hatchbuck.com/Contact/2) from files: a.vcf, b.vcf"
+    )
+
+
+def test_report_once(tmp_path):
+    """
+    Every cluster is sent as a message, with a sync state only once it was
+    posted
+    """
+    state = SyncState(str(tmp_path / "state.sqlite"))
+    detector = DuplicateDetector()
+    detector.add([contact("1", "Jane", "Doe", ["jane@example.com"])], "a.vcf")
+    detector.add([contact("2", "Jane", "Doe", ["jane@example.com"])], "b.vcf")
+    detector.add([contact("3", "Jon", "Roe", ["jon@example.com"])], "c.vcf")
+    detector.add([contact("4", "Jon", "Roe", ["jon@example.com"])], "d.vcf")
+
+    with mock.patch.object(carddavsync, "NotificationService") as service:
+        send_message = service.return_value.send_message
+        # not posted, e.g. RocketChat is down
+        carddavsync.report_duplicates(detector, state)
+        assert send_message.call_count == 2
+        assert state.reported_duplicates() == []
+
+        send_message.side_effect = lambda message, on_sent: on_sent()
+        carddavsync.report_duplicates(detector, state)
+        assert send_message.call_count == 4
+        carddavsync.report_duplicates(detector, state)
+        assert send_message.call_count == 4
+
+        # a part of a reported cluster isn't new either
+        partial = DuplicateDetector()
+        partial.add([contact("1", "Jane", "Doe", ["jane@example.com"])], "a.vcf")
+        partial.add([contact("2", "Jane", "Doe", ["jane@example.com"])], "b.vcf")
+        carddavsync.report_duplicates(partial, state)
+        assert send_message.call_count == 4
+
+        detector.add([contact("5", "Jon", "Roe", ["jon@example.com"])], "e.vcf")
+        carddavsync.report_duplicates(detector, state)
+        assert send_message.call_count == 5
+        assert "Contact/5" in send_message.call_args[0][0]
+    state.close()
@@ -0,0 +1,28 @@
+"""
+Tests for module "ingest"
+"""
+from carddav2hatchbuck.ingest import card_uid, iter_cards, iter_files
+
+EXPORT = (
+    "BEGIN:VCARD\r\nVERSION:3.0\r\nUID:first\r\nN:Doe;Jane;;;\r\nEND:VCARD\r\n"
+    "\r\n"
+    "BEGIN:VCARD\r\nVERSION:3.0\r\nN:Roe;Richard;;;\r\nEND:VCARD\r\n"
+)
+
+
+def test_iter_cards(tmp_path):
+    """
+    A multi-card export is split into single cards
+    """
+    (tmp_path / "export.vcf").write_bytes(EXPORT.encode("utf-8"))
+    (tmp_path / "notes.txt").write_text("not a vCard")
+
+    files = list(iter_files([str(tmp_path)]))
+    assert files == [str(tmp_path / "export.vcf")]
+
+    cards = list(iter_cards(files[0]))
+    assert len(cards) == 2
+    assert cards[1].startswith("BEGIN:VCARD")
+    assert cards[1].rstrip().endswith("END:VCARD")
+    assert card_uid(cards[0]) == "first"
+    assert card_uid(cards[1]) is None
@@ -0,0 +1,67 @@
+"""
+Tests for module "metrics"
+"""
+import json
+import urllib.request
+
+from carddav2hatchbuck.metrics import Metrics
+
+
+def test_prometheus_text():
+    """
+    Counters and histograms are rendered in the Prometheus text format
+    """
+    metrics = Metrics()
+    metrics.inc("carddav2hatchbuck_cards_total", result="created")
+    metrics.inc("carddav2hatchbuck_cards_total", 2, result="created")
+    metrics.observe("carddav2hatchbuck_api_request_seconds", 0.02, endpoint="search")
+    metrics.observe("carddav2hatchbuck_api_request_seconds", 3, endpoint="search")
+
+    assert metrics.value("carddav2hatchbuck_cards_total", result="created") == 3
+    lines = metrics.to_prometheus().splitlines()
+    assert "# TYPE carddav2hatchbuck_cards_total counter" in lines
+    assert 'carddav2hatchbuck_cards_total{result="created"} 3' in lines
+    assert "# TYPE carddav2hatchbuck_api_request_seconds histogram" in lines
+    prefix = "carddav2hatchbuck_api_request_seconds"
+    assert prefix + '_bucket{endpoint="search",le="0.01"} 0' in lines
+    assert prefix + '_bucket{endpoint="search",le="0.025"} 1' in lines
+    assert prefix + '_bucket{endpoint="search",le="+Inf"} 2' in lines
+    assert prefix + '_sum{endpoint="search"} 3.02' in lines
+    assert prefix + '_count{endpoint="search"} 2' in lines
+
+
+def test_json_file(tmp_path):
+    """
+    Batch runs write the metrics to a JSON file
+    """
+    metrics = Metrics()
+    metrics.inc("carddav2hatchbuck_errors_total", kind="parse")
+    with metrics.time("carddav2hatchbuck_sync_run_seconds"):
+        pass
+    metrics.write_json(str(tmp_path / "metrics.json"))
+
+    data = json.loads((tmp_path / "metrics.json").read_text())
+    assert data["counters"]["carddav2hatchbuck_errors_total"] == [
+        {"labels": {"kind": "parse"}, "value": 1}
+    ]
+    (run,) = data["histograms"]["carddav2hatchbuck_sync_run_seconds"]
+    assert run["count"] == 1
+    assert run["buckets"][-1] == ["+Inf", 1]
+
+
+def test_serve():
+    """
+    The daemon serves the metrics over HTTP for Prometheus
+    """
+    metrics = Metrics()
+    metrics.inc("carddav2hatchbuck_cards_total", result="parsed")
+    server = metrics.serve(0, host="127.0.0.1")
+    try:
+        with urllib.request.urlopen(
+            "http://127.0.0.1:%s/metrics" % server.server_port
+        ) as response:
+            body = response.read().decode("utf-8")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert 'carddav2hatchbuck_cards_total{result="parsed"} 1' in body
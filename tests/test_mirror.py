@@ -0,0 +1,82 @@
+"""
+Tests for module "mirror"
+"""
+import pytest
+
+from carddav2hatchbuck.client import Client
+from carddav2hatchbuck.mirror import ContactMirror
+from carddav2hatchbuck.state import SyncState
+
+
+@pytest.fixture(name="mirror")
+def fixture_mirror(server, tmp_path):
+    """A mirror backed by a sync state and the stand-in"""
+    client = Client("key")
+    client.url = server.url
+    state = SyncState(str(tmp_path / "state.sqlite"))
+    yield ContactMirror(client, state, ttl=3600)
+    state.close()
+
+
+def add_jane(server):
+    """Store a contact with an email address and a phone number"""
+    return server.add_contact(
+        {
+            "firstName": "Jane",
+            "lastName": "Doe",
+            "emails": [{"address": "Jane.Doe@example.com", "type": "Work"}],
+            "phones": [{"number": "+41 44 123 45 67", "type": "Work"}],
+        }
+    )
+
+
+def test_search_email_from_mirror(server, mirror):
+    """
+    A found contact is answered from the mirror the next time
+    """
+    jane = add_jane(server)
+
+    assert mirror.search_email("jane.doe@example.com")["contactId"] == jane["contactId"]
+    assert server.requests["POST contact/search"] == 1
+    assert mirror.search_email("JANE.DOE@example.com")["contactId"] == jane["contactId"]
+    assert server.requests["POST contact/search"] == 1
+    assert mirror.hits == 1
+
+    assert mirror.search_email("john.doe@example.com") is None
+    assert server.requests["POST contact/search"] == 2
+
+
+def test_stale_contact_refreshed(server, mirror):
+    """
+    Contacts older than the ttl are fetched again by contactId
+    """
+    jane = add_jane(server)
+    mirror.search_email("jane.doe@example.com")
+    mirror.ttl = 0
+    server.update_contact({"contactId": jane["contactId"], "title": "Dr."})
+
+    assert mirror.search_email("jane.doe@example.com")["title"] == "Dr."
+    assert mirror.refreshed == 1
+    assert server.requests["POST contact/search"] == 2
+
+
+def test_deleted_contact_dropped(server, mirror):
+    """
+    Contacts deleted in Hatchbuck disappear from the mirror
+    """
+    jane = add_jane(server)
+    mirror.search_email("jane.doe@example.com")
+    mirror.ttl = 0
+    with server.lock:
+        del server.contacts[jane["contactId"]]
+
+    assert mirror.search_email("jane.doe@example.com") is None
+    assert mirror.state.mirrored_contact(jane["contactId"]) is None
+
+
+def test_unsaved_contact_ignored(mirror):
+    """
+    Contacts created in noop mode have no contactId and aren't mirrored
+    """
+    mirror.save({"emails": [{"address": "jane.doe@example.com"}]})
+    assert mirror.state.mirrored_email("jane.doe@example.com") is None
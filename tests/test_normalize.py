@@ -0,0 +1,78 @@
+"""
+Tests for module "normalize"
+"""
+import pickle
+
+from carddav2hatchbuck.normalize import (
+    NormalizedContact,
+    normalize_card,
+    normalize_phone,
+)
+
+CARD = (
+    "BEGIN:VCARD\r\n"
+    "VERSION:3.0\r\n"
+    "UID:card-1\r\n"
+    "N:Doe;Jane;;;\r\n"
+    "FN:Jane Doe\r\n"
+    "EMAIL;TYPE=WORK:jane@example.com\r\n"
+    "EMAIL:jäne@example.com\r\n"
+    "TEL;TYPE=HOME:+41 (0)44 123 45 67\r\n"
+    "TEL:044 123 45 67\r\n"
+    "X-TWITTER:@jane\r\n"
+    "URL:www.example.com\r\n"
+    "BDAY:1980-02-03\r\n"
+    "END:VCARD\r\n"
+)
+
+
+def test_normalize_card():
+    """
+    All synced fields are extracted into a plain record
+    """
+    record = normalize_card(CARD)
+
+    assert record.skip is None
+    assert record.uid == "card-1"
+    assert (record.given, record.family) == ("Jane", "Doe")
+    assert record.emails == [{"address": "jane@example.com", "type": "Work"}]
+    assert [phone["formatted"] for phone in record.phones] == [
+        "+41 44 123 45 67",
+        None,
+    ]
+    assert record.phones[0]["type"] == "Home"
+    assert record.social_networks == [
+        {"address": "http://twitter.com/jane", "type": "Twitter"}
+    ]
+    assert record.websites == ["http://www.example.com"]
+    assert record.birthdays == [{"year": "1980", "month": "02", "day": "03"}]
+
+
+def test_normalize_card_skip():
+    """
+    Cards without name or valid email address are not synced
+    """
+    assert normalize_card(CARD.replace("N:Doe;Jane;;;\r\n", "")).skip == "noname"
+    assert normalize_card(CARD.replace("jane@", "jane")).skip == "noemail"
+
+
+def test_normalize_phone():
+    """
+    Numbers are cleaned up, local numbers can't be formatted without country
+    """
+    assert normalize_phone("+0041 (44) 123-45-67") == (
+        "+41 44 1234567",
+        "+41 44 123 45 67",
+    )
+    assert normalize_phone("044 123 45 67") == ("044 123 45 67", None)
+
+
+def test_normalized_contact_pickles():
+    """
+    Records are sent from worker processes, they must survive pickling
+    """
+    record = normalize_card(CARD)
+    copy = pickle.loads(pickle.dumps(record))
+    assert isinstance(copy, NormalizedContact)
+    assert not hasattr(copy, "__dict__")
+    assert repr(copy) == repr(record)
@@ -0,0 +1,121 @@
+"""
+Tests for module "notifications"
+"""
+from unittest import mock
+
+from carddav2hatchbuck import notifications
+from carddav2hatchbuck.notifications import NotificationService
+
+
+def test_digest_and_repeats(monkeypatch):
+    """
+    Queued messages are posted as one digest with a single login,
+    repeats within the window are dropped
+    """
+    rocketchat = mock.Mock()
+    monkeypatch.setattr(notifications, "_rocketchat_client", rocketchat)
+    service = NotificationService(batch_delay=0.5, repeat_window=60)
+
+    service.send_message("Duplicates: Jane")
+    service.send_message("Duplicates: John")
+    service.send_message("Duplicates: Jane")
+    service.flush()
+    post = rocketchat.return_value.chat_post_message
+    assert post.call_count == 1
+    assert post.call_args[0][0] == "Duplicates: Jane\n\nDuplicates: John"
+
+    service.send_message("Duplicates: Jane")
+    service.send_message("Duplicates: Max")
+    service.close()
+    assert post.call_count == 2
+    assert post.call_args[0][0] == "Duplicates: Max"
+    assert rocketchat.call_count == 1
+
+
+def test_long_digests_are_split(monkeypatch):
+    """
+    Digests stay below the message size limit of RocketChat
+    """
+    rocketchat = mock.Mock()
+    monkeypatch.setattr(notifications, "_rocketchat_client", rocketchat)
+    service = NotificationService(batch_delay=0.5)
+
+    for index in range(3):
+        service.send_message("%s%s" % (index, "x" * (notifications.MAX_LENGTH // 2)))
+    service.close()
+    post = rocketchat.return_value.chat_post_message
+    assert post.call_count == 3
+
+
+def test_posted_messages_are_confirmed(monkeypatch):
+    """
+    on_sent is called once a message is posted or was posted before
+    """
+    rocketchat = mock.Mock()
+    post = rocketchat.return_value.chat_post_message
+    post.return_value.json.side_effect = [{"success": True}, {"success": False}]
+    monkeypatch.setattr(notifications, "_rocketchat_client", rocketchat)
+    service = NotificationService(batch_delay=0.5, repeat_window=60)
+    posted = []
+
+    service.send_message("Duplicates: Jane", lambda: posted.append("Jane"))
+    service.flush()
+    service.send_message("Duplicates: Jane", lambda: posted.append("Jane"))
+    service.send_message("Duplicates: John", lambda: posted.append("John"))
+    service.close()
+    assert posted == ["Jane", "Jane"]
+    assert post.call_count == 2
+
+
+def test_long_messages_are_cut(monkeypatch):
+    """
+    A single message longer than the limit is cut to fit
+    """
+    rocketchat = mock.Mock()
+    monkeypatch.setattr(notifications, "_rocketchat_client", rocketchat)
+    service = NotificationService(batch_delay=0)
+
+    service.send_message("x" * (2 * notifications.MAX_LENGTH))
+    service.close()
+    text = rocketchat.return_value.chat_post_message.call_args[0][0]
+    assert len(text) == notifications.MAX_LENGTH
+    assert text.endswith("...")
+
+
+def test_refused_messages_are_sent_again(monkeypatch):
+    """
+    Messages RocketChat refused are not suppressed as repeats, the next
+    message logs in again
+    """
+    rocketchat = mock.Mock()
+    post = rocketchat.return_value.chat_post_message
+    post.return_value.json.side_effect = [
+        {"success": False, "error": "You must be logged in to do this."},
+        {"success": True},
+    ]
+    monkeypatch.setattr(notifications, "_rocketchat_client", rocketchat)
+    service = NotificationService(batch_delay=0, repeat_window=60)
+
+    service.send_message("Duplicates: Jane")
+    service.flush()
+    service.send_message("Duplicates: Jane")
+    service.close()
+    assert post.call_count == 2
+    assert rocketchat.call_count == 2
+
+
+def test_failures_dont_break_the_sync(monkeypatch):
+    """
+    Errors are logged, the next message logs in again
+    """
+    rocketchat = mock.Mock()
+    rocketchat.return_value.chat_post_message.side_effect = [OSError, mock.Mock()]
+    monkeypatch.setattr(notifications, "_rocketchat_client", rocketchat)
+    service = NotificationService(batch_delay=0)
+
+    service.send_message("Duplicates: Jane")
+    service.flush()
+    service.send_message("Duplicates: Jane")
+    service.close()
+    assert rocketchat.return_value.chat_post_message.call_count == 2
+    assert rocketchat.call_count == 2
@@ -0,0 +1,71 @@
+"""
+Tests for module "phones"
+"""
+from carddav2hatchbuck import phones
+from carddav2hatchbuck.phones import PhoneCache, PhoneIndex, country_code
+from carddav2hatchbuck.state import SyncState
+
+
+def test_country_code():
+    """
+    Names, codes and local names resolve to alpha-2 codes
+    """
+    assert country_code("Switzerland") == "CH"
+    assert country_code(" switzerland ") == "CH"
+    assert country_code("CHE") == "CH"
+    assert country_code("Swiss Confederation") == "CH"
+    assert country_code("Deutschland") == "DE"
+    assert country_code("Narnia") is None
+    assert country_code("") is None
+
+
+def test_phone_cache_lru():
+    """
+    Numbers are formatted once, the least recently used are evicted
+    """
+    cache = PhoneCache(maxsize=2)
+    assert cache.format("+41441234567") == "+41 44 123 45 67"
+    assert cache.format("0441234567", "CH") == "+41 44 123 45 67"
+    assert cache.format("0441234567") is None
+    assert (cache.hits, cache.misses) == (0, 3)
+
+    assert cache.format("0441234567") is None
+    assert cache.format("+41441234567") == "+41 44 123 45 67"
+    assert (cache.hits, cache.misses) == (1, 4)
+    assert list(cache.entries) == [("0441234567", None), ("+41441234567", None)]
+
+
+def test_phone_cache_store(tmp_path, monkeypatch):
+    """
+    Numbers formatted in a previous run are read from the sync state
+    """
+    state = SyncState(str(tmp_path / "state.sqlite"))
+    assert PhoneCache(store=state).format("0441234567", "CH") == "+41 44 123 45 67"
+    assert PhoneCache(store=state).format("0441234567") is None
+
+    def format_number(*_args):
+        raise AssertionError("number formatted again")
+
+    monkeypatch.setattr(phones, "format_number", format_number)
+    cache = PhoneCache(store=state)
+    assert cache.format("0441234567", "CH") == "+41 44 123 45 67"
+    assert cache.format("0441234567") is None
+    state.close()
+
+
+def test_phone_index():
+    """
+    Numbers and their suffixes are found in digit-only form
+    """
+    index = PhoneIndex(["+41 44 123 45 67", "079/555 11 22"])
+    assert "+41441234567" in index
+    assert "044 123 45 67" not in index
+    assert index.has_suffix("44 123 45 67")
+    assert index.has_suffix("795551122")
+    assert not index.has_suffix("44 123 45 68")
+    assert not index.has_suffix("441234567", exclude="+41 44 123 45 67")
+
+    index.remove("+41 44 123 45 67")
+    assert not index.has_suffix("441234567")
+    index.add("+41 44 123 45 67")
+    assert index.has_suffix("441234567")
@@ -0,0 +1,97 @@
+"""
+Tests for module "plan"
+"""
+import json
+
+from benchmark import generate_corpus, run_benchmark
+
+from carddav2hatchbuck.plan import PLAN_ID, Plan
+from carddav2hatchbuck.state import SyncState
+
+
+def test_plan_merges_changes():
+    """
+    Changes to a planned contact end up in its create, changes to other
+    contacts in one update each
+    """
+    plan = Plan()
+    created = plan.create(
+        {"firstName": "Jane", "emails": [{"address": "jane@example.com"}]}
+    )
+    assert created["contactId"].startswith(PLAN_ID)
+    email_id = created["emails"][0]["id"]
+    plan.update(
+        created["contactId"],
+        {
+            "title": "Dr.",
+            "emails": [{"id": email_id, "address": "jane@example.com", "type": "Work"}],
+            "phones": [{"number": "+41 44 123 45 67", "type": "Work"}],
+        },
+    )
+    plan.update("abc", {"phones": [{"number": "+41 44 123 45 67"}]})
+    plan.update("abc", {"title": "Dr.", "phones": [{"number": "+41 44 765 43 21"}]})
+    plan.tag("abc", "Adressbuch-jane")
+    plan.tag("abc", "Adressbuch-jane")
+
+    data = plan.to_dict()
+    assert data["creates"] == {
+        created["contactId"]: {
+            "firstName": "Jane",
+            "title": "Dr.",
+            "emails": [{"address": "jane@example.com", "type": "Work"}],
+            "phones": [{"number": "+41 44 123 45 67", "type": "Work"}],
+        }
+    }
+    assert data["updates"] == {
+        "abc": {
+            "title": "Dr.",
+            "phones": [{"number": "+41 44 123 45 67"}, {"number": "+41 44 765 43 21"}],
+        }
+    }
+    assert data["tags"] == {"abc": ["Adressbuch-jane"]}
+
+
+def test_plan_and_apply(server, tmp_path):
+    """
+    Planning only searches, applying only writes
+    """
+    files = generate_corpus(str(tmp_path), cards=10, duplicates=0)
+    plan_file = str(tmp_path / "plan.json")
+
+    planned = run_benchmark(files, server, plan=plan_file, noop=True)
+    assert planned["requests"] == {"POST contact/search": 10}
+    with open(plan_file, encoding="utf-8") as file:
+        plan = json.load(file)
+    assert len(plan["creates"]) == 10
+    assert not server.contacts
+
+    applied = run_benchmark(files, server, apply=plan_file, workers=4)
+    assert applied["requests"] == {"POST contact": 10}
+    assert applied["stats"]["created"] == 10
+
+    # the new contacts lack phones, addresses and the tag
+    planned = run_benchmark(files, server, plan=plan_file, noop=True)
+    assert planned["requests"] == {"POST contact/search": 10}
+    applied = run_benchmark(files, server, apply=plan_file, workers=4)
+    assert applied["requests"] == {"PUT contact": 10, "POST tags": 10}
+    assert applied["stats"]["updated"] == 10
+
+
+def test_apply_resumes(server, tmp_path):
+    """
+    With a sync state applying a plan again only sends the failed changes
+    """
+    files = generate_corpus(str(tmp_path), cards=3, duplicates=0)
+    plan_file = str(tmp_path / "plan.json")
+    state = str(tmp_path / "state.sqlite")
+    run_benchmark(files, server, plan=plan_file, noop=True)
+
+    server.inject(status=400, request="POST contact")
+    failed = run_benchmark(files, server, apply=plan_file, state=state)
+    assert failed["requests"] == {"POST contact": 3}
+    assert failed["stats"]["created"] == 2
+
+    retried = run_benchmark(files, server, apply=plan_file, state=state)
+    assert retried["requests"] == {"POST contact": 1}
+    assert len(server.contacts) == 3
+    assert len(SyncState(state).applied_actions(Plan.load(plan_file).digest)) == 3
@@ -0,0 +1,99 @@
+"""
+Tests for module "profile"
+"""
+from carddav2hatchbuck.profile import LocalHatchbuck, profile_delta
+
+
+class ClientMock:
+    """
+    Replacement for the Hatchbuck client recording the updates sent.
+    """
+
+    key = "key"
+    noop = False
+
+    def __init__(self):
+        self.updates = []
+
+    def update(self, contact_id, profile):
+        """Record the update instead of sending it"""
+        self.updates.append((contact_id, profile))
+        return profile
+
+
+def hatchbuck_profile():
+    """A contact profile as returned by Hatchbuck"""
+    return {
+        "contactId": "abc",
+        "firstName": "",
+        "lastName": "Doe",
+        "emails": [{"id": "e1", "address": "jane@example.com", "type": "Work"}],
+        "phones": [
+            {"id": "p1", "number": "+41 44 123 45 67", "type": "Work"},
+            {"id": "p2", "number": "044 123 45 67", "type": "Work"},
+        ],
+        "addresses": [],
+        "customFields": [],
+    }
+
+
+def test_commit_single_update():
+    """
+    All changes of a contact are sent as one update with the minimal delta
+    """
+    client = ClientMock()
+    local = LocalHatchbuck(client)
+    profile = local.checkout(hatchbuck_profile())
+
+    profile = local.profile_add(profile, "firstName", None, "Jane")
+    profile = local.profile_add(profile, "lastName", None, "Doe")
+    profile = local.profile_add(
+        profile, "phones", "number", "+41 79 123 45 67", {"type": "Home"}
+    )
+    profile = local.clean_all_phone_numbers(profile)
+    profile = local.profile_add_birthday(
+        profile, {"year": "1980", "month": "02", "day": "03"}
+    )
+    local.commit(profile)
+
+    assert client.updates == [
+        (
+            "abc",
+            {
+                "firstName": "Jane",
+                "phones": [
+                    {"number": "+41 79 123 45 67", "type": "Home"},
+                    {"id": "p2", "number": "", "type": "Work"},
+                ],
+                "customFields": [{"name": "Birthday", "value": "02/03/1980"}],
+            },
+        )
+    ]
+
+
+def test_commit_unchanged():
+    """
+    Nothing is sent if the profile did not change
+    """
+    client = ClientMock()
+    local = LocalHatchbuck(client)
+    profile = local.checkout(hatchbuck_profile())
+    profile = local.profile_add(profile, "lastName", None, "Doe")
+    profile = local.profile_add(
+        profile, "emails", "address", "jane@example.com", {"type": "Work"}
+    )
+
+    assert profile_delta(hatchbuck_profile(), profile) == {}
+    assert local.commit(profile) == profile
+    assert not client.updates
+
+
+def test_entries_without_id_compared_by_value():
+    """
+    Entries without an id are only sent if the original lacks them
+    """
+    original = dict(hatchbuck_profile(), tags=[{"name": "Adressbuch-jane"}])
+    profile = dict(original, tags=[{"name": "Adressbuch-jane"}, {"name": "new"}])
+
+    assert profile_delta(original, original) == {}
+    assert profile_delta(original, profile) == {"tags": [{"name": "new"}]}
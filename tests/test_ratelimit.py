@@ -0,0 +1,21 @@
+"""
+Tests for module "ratelimit"
+"""
+import time
+
+from carddav2hatchbuck.ratelimit import TokenBucket
+
+
+def test_burst_then_throttle():
+    """
+    A full bucket allows a burst, afterwards requests are spaced by the rate
+    """
+    bucket = TokenBucket(50, capacity=5)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.05
+
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.08
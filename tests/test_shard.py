@@ -0,0 +1,96 @@
+"""
+Tests for module "shard"
+"""
+import time
+
+from carddav2hatchbuck.shard import HashRing, Shard
+from carddav2hatchbuck.state import SyncState
+
+BOOKS = ["user%s_x_doe_y" % number for number in range(100)]
+
+
+def test_ring_moves_only_keys_of_leaving_member():
+    """
+    Ownership is deterministic and only a leaving member's keys move
+    """
+    ring = HashRing(["a", "b", "c"])
+    owners = {book: ring.owner(book) for book in BOOKS}
+    assert owners == {book: HashRing(["c", "b", "a"]).owner(book) for book in BOOKS}
+    assert set(owners.values()) == {"a", "b", "c"}
+
+    smaller = HashRing(["a", "c"])
+    for book, owner in owners.items():
+        if owner != "b":
+            assert smaller.owner(book) == owner
+    assert HashRing([]).owner(BOOKS[0]) is None
+
+
+def test_rebalance_when_worker_disappears(tmp_path):
+    """
+    The address books of a worker missing its heartbeats are taken over
+    """
+    path = str(tmp_path / "state.sqlite")
+    first = Shard(SyncState(path), "worker-a", 60)
+    second = Shard(SyncState(path), "worker-b", 0.1)
+    second.refresh()
+    first.refresh()
+    assert first.state.heartbeat("worker-a", 60) == ["worker-a", "worker-b"]
+    owned = [book for book in BOOKS if first.owns(book)]
+    assert 0 < len(owned) < len(BOOKS)
+
+    time.sleep(0.2)
+    first.refresh()
+    assert all(first.owns(book) for book in BOOKS)
+
+
+def test_leases_are_exclusive(tmp_path):
+    """
+    An address book leased by one worker is not synced by another one until
+    the lease expires or the worker stops
+    """
+    path = str(tmp_path / "state.sqlite")
+    first, second = SyncState(path), SyncState(path)
+    assert first.claim_lease(BOOKS[0], "worker-a", 0.1)
+    assert first.claim_lease(BOOKS[0], "worker-a", 0.1)
+    assert not second.claim_lease(BOOKS[0], "worker-b", 60)
+
+    time.sleep(0.2)
+    assert second.claim_lease(BOOKS[0], "worker-b", 60)
+    assert not first.claim_lease(BOOKS[0], "worker-a", 60)
+
+    second.release_worker("worker-b")
+    assert first.claim_lease(BOOKS[0], "worker-a", 60)
+
+
+def test_lease_is_kept_during_sync(tmp_path):
+    """
+    A sync taking longer than the ttl keeps its lease, a lost lease stops it
+    """
+    path = str(tmp_path / "state.sqlite")
+    first = Shard(SyncState(path), "worker-a", 0.3)
+    second = SyncState(path)
+    first.refresh()
+    assert first.claim(BOOKS[0])
+    with first.hold(BOOKS[0]) as lease:
+        time.sleep(0.6)
+        assert not second.claim_lease(BOOKS[0], "worker-b", 60)
+        assert not lease.is_set()
+
+        first.release()
+        assert second.claim_lease(BOOKS[0], "worker-b", 60)
+        time.sleep(0.2)
+        assert lease.is_set()
+
+
+def test_lease_is_released_after_sync(tmp_path):
+    """
+    Another worker can take over an address book right after its sync
+    """
+    path = str(tmp_path / "state.sqlite")
+    first = Shard(SyncState(path), "worker-a", 60)
+    second = SyncState(path)
+    first.refresh()
+    assert first.claim(BOOKS[0])
+    with first.hold(BOOKS[0]):
+        assert not second.claim_lease(BOOKS[0], "worker-b", 60)
+    assert second.claim_lease(BOOKS[0], "worker-b", 60)
@@ -0,0 +1,21 @@
+"""
+Tests for module "state"
+"""
+from carddav2hatchbuck.state import SyncState
+
+
+def test_unchanged(tmp_path):
+    """
+    A card is unchanged only after it was synced with the same content
+    """
+    state = SyncState(str(tmp_path / "state.sqlite"))
+    digest = SyncState.card_hash("BEGIN:VCARD", "Adressbuch-Jane", "jane.doe")
+
+    assert not state.unchanged("jane_x_doe_y", "uid-1", digest)
+    state.mark_synced("jane_x_doe_y", "uid-1", digest, ["abc", None])
+    assert state.unchanged("jane_x_doe_y", "uid-1", digest)
+
+    other = SyncState.card_hash("BEGIN:VCARD", "Adressbuch-John", "john.doe")
+    assert not state.unchanged("jane_x_doe_y", "uid-1", other)
+    assert not state.unchanged("john_x_doe_y", "uid-1", digest)
+    state.close()
@@ -0,0 +1,256 @@
+"""
+Tests for module "sync"
+"""
+import os
+import signal
+import sys
+
+from fake_hatchbuck import FakeHatchbuckServer
+
+from carddav2hatchbuck import sync
+from carddav2hatchbuck.client import Client
+from carddav2hatchbuck.plan import Plan
+from carddav2hatchbuck.state import SyncState
+
+
+class SyncArgsMock:  # pylint: disable=too-few-public-methods
+    """
+    Replacement for argparse command line arguments of the sync command.
+    """
+
+    hatchbuck = "key"
+    vdirsync_url = "http://localhost/dav/"
+    vdirsync_user = "user"
+    vdirsync_pass = "pass"
+    noop = True
+    rate = None
+    interval = 0
+    workers = 1
+    books = 1
+    mirror = False
+    timeout = 30
+    retries = 4
+    plan = None
+    fast_vcard = False
+    profile = None
+    profile_top = 20
+    profile_stats = None
+    worker_id = None
+    lease_ttl = None
+    metrics_port = None
+    metrics_file = None
+
+    def __init__(self, state):
+        self.state = state
+
+
+def test_daemon_stops_on_sigterm(tmp_path, monkeypatch):
+    """
+    The daemon shares client and state between runs and stops on SIGTERM
+    """
+    monkeypatch.chdir(tmp_path)
+    runs = []
+
+    # pylint: disable=too-many-arguments
+    def run_carddav_sync(
+        _args,
+        hatchbuck=None,
+        state=None,
+        stop=None,
+        carddav=None,
+        metrics=None,
+        notifications=None,
+        shard=None,
+    ):
+        """Record the run, ask the daemon to stop after the second one"""
+        runs.append((hatchbuck, state, stop, carddav, metrics, notifications, shard))
+        if len(runs) == 2:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    monkeypatch.setattr(sync, "run_carddav_sync", run_carddav_sync)
+    previous = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+    try:
+        sync.run_daemon(SyncArgsMock(str(tmp_path / "state.sqlite")))
+    finally:
+        signal.signal(signal.SIGTERM, previous[0])
+        signal.signal(signal.SIGINT, previous[1])
+
+    assert len(runs) == 2
+    assert runs[0] == runs[1]
+
+
+class ParserMock:  # pylint: disable=too-few-public-methods
+    """Replacement for HatchbuckParser recording the address books to parse"""
+
+    parsed = []
+    # names of the files with a card that fails to sync
+    failing = set()
+
+    def __init__(self, args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.failed_files = set()
+
+    def main(self):
+        """Record the files and settings instead of parsing them"""
+        self.parsed.append(
+            (
+                self.kwargs["tag"],
+                self.kwargs["user"],
+                sorted(os.path.basename(file) for file in self.kwargs["files"]),
+                self.kwargs["hatchbuck"],
+                self.kwargs["table"],
+            )
+        )
+        self.failed_files = set(
+            file
+            for file in self.kwargs["files"]
+            if os.path.basename(file) in self.failing
+        )
+
+
+def write_book(tmp_path, name, *cards):
+    """Create an address book directory with one vcf file per card name"""
+    book = tmp_path / "carddav" / name
+    book.mkdir(parents=True)
+    for card in cards:
+        (book / card).write_text("BEGIN:VCARD\r\nEND:VCARD\r\n")
+    return book
+
+
+def test_only_changed_files_are_synced(tmp_path, monkeypatch):
+    """
+    Address books are only parsed for files changed since the last sync
+    """
+    monkeypatch.chdir(tmp_path)
+    book = write_book(tmp_path, "jane_x_doe_y", "a.vcf", "b.vcf")
+    monkeypatch.setattr(sync, "HatchbuckParser", ParserMock)
+    monkeypatch.setattr(ParserMock, "parsed", [])
+    args = SyncArgsMock(str(tmp_path / "state.sqlite"))
+    args.noop = False
+    state = SyncState(args.state)
+
+    sync.sync_address_books(args, None, state, None)
+    sync.sync_address_books(args, None, state, None)
+    (book / "b.vcf").write_text("BEGIN:VCARD\r\nUID:b\r\nEND:VCARD\r\n")
+    sync.sync_address_books(args, None, state, None)
+
+    assert [files for _, _, files, _, _ in ParserMock.parsed] == [
+        ["a.vcf", "b.vcf"],
+        ["b.vcf"],
+    ]
+    assert ParserMock.parsed[0][:2] == ("Adressbuch-jane", "jane.doe")
+    assert not hasattr(args, "tag")
+
+
+def test_unsynced_files_are_synced_again(tmp_path, monkeypatch):
+    """
+    Files are synced again after a dry run or if one of their cards failed
+    """
+    monkeypatch.chdir(tmp_path)
+    write_book(tmp_path, "jane_x_doe_y", "a.vcf", "b.vcf")
+    monkeypatch.setattr(sync, "HatchbuckParser", ParserMock)
+    monkeypatch.setattr(ParserMock, "parsed", [])
+    monkeypatch.setattr(ParserMock, "failing", {"b.vcf"})
+    args = SyncArgsMock(str(tmp_path / "state.sqlite"))
+    state = SyncState(args.state)
+
+    sync.sync_address_books(args, None, state, None)
+    args.noop = False
+    sync.sync_address_books(args, None, state, None)
+    ParserMock.failing.clear()
+    sync.sync_address_books(args, None, state, None)
+    sync.sync_address_books(args, None, state, None)
+
+    assert [files for _, _, files, _, _ in ParserMock.parsed] == [
+        ["a.vcf", "b.vcf"],
+        ["a.vcf", "b.vcf"],
+        ["b.vcf"],
+    ]
+
+
+def test_address_books_are_synced_in_parallel(tmp_path, monkeypatch):
+    """
+    Address books are synced concurrently with their own settings, sharing
+    the Hatchbuck client and the contact lookup table
+    """
+    monkeypatch.chdir(tmp_path)
+    write_book(tmp_path, "jane_x_doe_y", "a.vcf")
+    write_book(tmp_path, "max_x_muster_y", "b.vcf")
+    monkeypatch.setattr(sync, "HatchbuckParser", ParserMock)
+    monkeypatch.setattr(ParserMock, "parsed", [])
+    args = SyncArgsMock(str(tmp_path / "state.sqlite"))
+    args.books = 2
+    state = SyncState(args.state)
+    hatchbuck = object()
+
+    sync.sync_address_books(args, hatchbuck, state, None)
+
+    parsed = sorted(ParserMock.parsed, key=lambda book: book[0])
+    assert [book[:3] for book in parsed] == [
+        ("Adressbuch-jane", "jane.doe", ["a.vcf"]),
+        ("Adressbuch-max", "max.muster", ["b.vcf"]),
+    ]
+    assert parsed[0][3] is parsed[1][3] is hatchbuck
+    assert parsed[0][4] is parsed[1][4]
+
+
+def test_workers_split_address_books(tmp_path, monkeypatch):
+    """
+    Workers sharing the sync state each sync their own address books
+    """
+    monkeypatch.chdir(tmp_path)
+    names = ["user%s_x_doe_y" % number for number in range(8)]
+    for name in names:
+        write_book(tmp_path, name, "a.vcf")
+    monkeypatch.setattr(sync, "HatchbuckParser", ParserMock)
+    monkeypatch.setattr(ParserMock, "parsed", [])
+    args = SyncArgsMock(str(tmp_path / "state.sqlite"))
+    states = [SyncState(args.state), SyncState(args.state)]
+    shards = [
+        sync.Shard(states[0], "worker-a", 60),
+        sync.Shard(states[1], "worker-b", 60),
+    ]
+    for shard in shards + shards:
+        shard.refresh()
+
+    synced = []
+    for state, shard in zip(states, shards):
+        sync.sync_address_books(args, None, state, None, shard=shard)
+        synced.append({tag for tag, _, _, _, _ in ParserMock.parsed})
+        ParserMock.parsed.clear()
+    assert synced[0] and synced[1]
+    assert not synced[0] & synced[1]
+    assert len(synced[0] | synced[1]) == len(names)
+
+
+def test_plan_is_applied_once(tmp_path, monkeypatch):
+    """
+    sync --apply posts the plan once, without fetching the address books
+    """
+    monkeypatch.chdir(tmp_path)
+    for name in ("jane_x_doe_y", "max_x_muster_y", "erika_x_muster_y"):
+        write_book(tmp_path, name, "a.vcf")
+    plan = Plan()
+    plan.create({"firstName": "Jane", "emails": [{"address": "jane@example.com"}]})
+    plan.write(str(tmp_path / "plan.json"))
+    fetched = []
+    monkeypatch.setattr(
+        sync, "fetch_address_books", lambda *args, **_: fetched.append(args)
+    )
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["sync", "--hatchbuck", "key", "-s", "source", "--vdirsync-user", "user"]
+        + ["--vdirsync-pass", "pass", "--vdirsync-url", "http://localhost/dav/"]
+        + ["--books", "3", "--apply", "plan.json"],
+    )
+    server = FakeHatchbuckServer().start()
+    try:
+        monkeypatch.setattr(Client, "url", server.url)
+        sync.run()
+    finally:
+        server.stop()
+
+    assert not fetched
+    assert server.requests == {"POST contact": 1}
@@ -0,0 +1,138 @@
+"""
+Tests for module "transport" against the fault injecting Hatchbuck stand-in
+"""
+import time
+
+import pytest
+import requests
+
+from carddav2hatchbuck.client import Client
+from carddav2hatchbuck.transport import CircuitOpenError, Transport
+
+
+def client_for(server, **options):
+    """A client of the stand-in with a transport waiting only briefly"""
+    options.setdefault("backoff", 0.01)
+    client = Client("key", transport=Transport(**options))
+    client.url = server.url
+    return client
+
+
+def add_jane(server):
+    """Store a contact"""
+    return server.add_contact(
+        {"emails": [{"address": "jane@example.com", "type": "Work"}]}
+    )
+
+
+def test_keep_alive(server):
+    """
+    All requests are sent over one connection
+    """
+    add_jane(server)
+    client = client_for(server)
+    for _ in range(5):
+        assert client.search_email("jane@example.com") is not None
+    assert server.connections == 1
+
+
+def test_retry_throttled(server):
+    """
+    429 and 503 responses are retried, honouring Retry-After
+    """
+    add_jane(server)
+    client = client_for(server)
+    server.inject(status=429, retry_after=0.2)
+    server.inject(status=503)
+
+    started = time.monotonic()
+    assert client.search_email("jane@example.com") is not None
+    assert time.monotonic() - started >= 0.2
+    assert server.requests["POST contact/search"] == 3
+
+
+def test_give_up(server):
+    """
+    After the retries the failed response is handled like before
+    """
+    add_jane(server)
+    client = client_for(server, retries=2)
+    server.inject(status=503, times=3)
+    assert client.search_email("jane@example.com") is None
+    assert server.requests["POST contact/search"] == 3
+
+
+def test_timeouts(server):
+    """
+    Searches timing out are retried, creates are not sent twice
+    """
+    add_jane(server)
+    client = client_for(server, timeout=0.2)
+    server.inject(delay=0.5)
+    assert client.search_email("jane@example.com") is not None
+
+    server.inject(delay=0.5)
+    with pytest.raises(requests.exceptions.Timeout):
+        client.create({"emails": [{"address": "john@example.com", "type": "Work"}]})
+    time.sleep(0.5)
+    assert server.requests["POST contact"] == 1
+
+
+def test_gateway_errors(server):
+    """
+    Creates are retried after a 503, but not after a 502 or 504 from a
+    gateway that may have passed them on
+    """
+    client = client_for(server)
+    john = {"emails": [{"address": "john@example.com", "type": "Work"}]}
+    server.inject(status=503)
+    assert client.create(dict(john)) is not None
+    assert server.requests["POST contact"] == 2
+
+    for status in (502, 504):
+        server.inject(status=status)
+        assert client.create(dict(john)) is None
+    assert server.requests["POST contact"] == 4
+
+
+def test_dropped_connection(server):
+    """
+    Idempotent requests are retried on a new connection
+    """
+    jane = add_jane(server)
+    client = client_for(server)
+    server.inject(drop=True)
+    assert client.update(jane["contactId"], {"title": "Dr."})["title"] == "Dr."
+    assert server.requests["PUT contact"] == 2
+
+
+def test_api_key_not_logged(server, caplog):
+    """
+    Retries are logged without the query string carrying the api_key
+    """
+    add_jane(server)
+    client = Client("secret-api-key", transport=Transport(backoff=0.01))
+    client.url = server.url
+    server.inject(status=503)
+    server.inject(drop=True)
+    assert client.search_email("jane@example.com") is not None
+    assert caplog.text.count("POST /api/v1/contact/search") == 2
+    assert "secret-api-key" not in caplog.text
+
+
+def test_circuit_breaker(server):
+    """
+    Requests fail fast after repeated failures until a probe succeeds
+    """
+    add_jane(server)
+    client = client_for(server, retries=0, failure_threshold=2, reset_timeout=0.2)
+    server.inject(status=503, times=2)
+    assert client.search_email("jane@example.com") is None
+    assert client.search_email("jane@example.com") is None
+    with pytest.raises(CircuitOpenError):
+        client.search_email("jane@example.com")
+    assert server.requests["POST contact/search"] == 2
+
+    time.sleep(0.2)
+    assert client.search_email("jane@example.com") is not None
+    assert client.search_email("jane@example.com") is not None
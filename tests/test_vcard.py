@@ -0,0 +1,121 @@
+"""
+Tests for module "vcard", differential against vobject
+"""
+import binascii
+
+import pytest
+from benchmark import generate_corpus
+
+from carddav2hatchbuck.ingest import iter_cards
+from carddav2hatchbuck.normalize import normalize_card
+from carddav2hatchbuck.vcard import tokenize_card
+
+CARD = (
+    "BEGIN:VCARD\r\n"
+    "VERSION:3.0\r\n"
+    "UID:card-1\r\n"
+    "N:Doe;Jane;;;\r\n"
+    "FN:Jane Doe\r\n"
+    "ORG:Firma;Abteilung;\r\n"
+    "TITLE:CEO\\, Founder\r\n"
+    "EMAIL;TYPE=WORK:jane@example.com\r\n"
+    "EMAIL:jäne@example.com\r\n"
+    "TEL;TYPE=HOME:+41 (0)44 123 45 67\r\n"
+    "TEL:044 123 45 67\r\n"
+    "ADR;TYPE=WORK:;;Bahnhofstrasse 1;Zürich;;8001;Switzerland\r\n"
+    "X-TWITTER:@jane\r\n"
+    "URL:www.example.com\r\n"
+    "BDAY:1980-02-03\r\n"
+    "END:VCARD\r\n"
+)
+
+# cards the tokenizer reads itself
+VARIANTS = [
+    ("TITLE:CEO\\, Founder", "TITLE:CEO, Founder"),
+    ("N:Doe;Jane;;;", "N:Doe;Jane,Janet"),
+    ("N:Doe;Jane;;;", "N:Doe"),
+    ("N:Doe;Jane;;;", "n:Doe;Jane;;;;;;"),
+    ("N:Doe;Jane;;;\r\n", ""),
+    ("jane@example.com", "jane@example"),
+    ("ORG:Firma;Abteilung;", "ORG:Firma"),
+    ("ORG:Firma;Abteilung;", "ORG:"),
+    ("ORG:Firma;Abteilung;", "ORG:Acme,Inc;Dept"),
+    ("EMAIL;TYPE=WORK:", "item1.EMAIL;type=work,WORK;TYPE=:"),
+    ("EMAIL;TYPE=WORK:", "EMAIL;WORK;INTERNET:"),
+    ("EMAIL;TYPE=WORK:", "EMAIL;TYPE=HOME;PREF=1:"),
+    ("TEL;TYPE=HOME:", "TEL;TYPE=WORK,VOICE:"),
+    ("TEL:044 123 45 67", "TEL:044 123 45 67,55"),
+    ("ADR;TYPE=WORK:;;Bahnhofstrasse 1;Zürich;;8001;Switzerland", "ADR:;;Street"),
+    ("X-TWITTER:@jane", "X_TWITTER:https://twitter.com/jane\r\nX-SKYPE:jane"),
+    ("URL:www.example.com", "URL:https://facebook.com/jane\r\nX-MSN:jane"),
+    ("URL:www.example.com", "X-SOCIALPROFILE;TYPE=twitter:twitter.com/jane"),
+    ("BDAY:1980-02-03", "BDAY:--0203\r\nX-MSNIM:jane"),
+    ("UID:card-1", "UID:card,1"),
+    ("UID:card-1\r\n", ""),
+    ("VERSION:3.0", "VERSION:4.0"),
+    ("FN:Jane Doe", "FN:Jane\r\n  Doe\r\nNOTE:a long\n\tnote"),
+    ("FN:Jane Doe\r\n", "FN:Jane Doe\r\n\r\n"),
+    ("FN:Jane Doe", "PHOTO;ENCODING=b;TYPE=JPEG:aGVsbG8="),
+    ("FN:Jane Doe", "PHOTO;BASE64:aGVsbG8="),
+]
+
+# cards left to vobject
+FALLBACKS = [
+    ("TITLE:CEO\\, Founder", "TITLE:CEO\\, Founder"),
+    ("TEL;TYPE=HOME:", 'TEL;TYPE="home,voice":'),
+    ("N:Doe;Jane;;;", "N;ENCODING=QUOTED-PRINTABLE:Doe;J=C3=A4ne;;;"),
+    ("TITLE:CEO\\, Founder", "TITLE;ENCODING=b:Q0VP"),
+    ("FN:Jane Doe", "AGENT:\r\nBEGIN:VCARD\r\nFN:Max\r\nEND:VCARD"),
+    ("FN:Jane Doe", "FN;;TYPE=x:Jane Doe"),
+]
+
+
+def normalized(text, fast):
+    """The normalized card without the timings"""
+    record = normalize_card(text, fast)
+    record.timings = None
+    return repr(record)
+
+
+@pytest.mark.parametrize("old, new", VARIANTS)
+def test_same_as_vobject(old, new):
+    """
+    Cards read by the tokenizer are normalized exactly like with vobject
+    """
+    card = CARD.replace("TITLE:CEO\\, Founder", "TITLE:CEO").replace(old, new)
+    assert tokenize_card(card) is not None
+    assert normalized(card, True) == normalized(card, False)
+
+
+@pytest.mark.parametrize("old, new", FALLBACKS)
+def test_fallback_to_vobject(old, new):
+    """
+    Cards the tokenizer doesn't handle are parsed by vobject
+    """
+    card = CARD.replace(old, new)
+    assert tokenize_card(card) is None
+    assert normalized(card, True) == normalized(card, False)
+
+
+def test_broken_photo():
+    """
+    A broken base64 value fails like with vobject
+    """
+    card = CARD.replace("FN:Jane Doe", "PHOTO;ENCODING=b:abc")
+    with pytest.raises(binascii.Error):
+        normalize_card(card)
+    with pytest.raises(binascii.Error):
+        normalize_card(card, fast=True)
+
+
+def test_corpus(tmp_path):
+    """
+    The cards of the benchmark corpus are all read by the tokenizer
+    """
+    files = generate_corpus(
+        str(tmp_path), cards=200, emails=2, phones=3, addresses=2, cards_per_file=50
+    )
+    for file in files:
+        for card in iter_cards(file):
+            assert tokenize_card(card) is not None
+            assert normalized(card, True) == normalized(card, False)